@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio, hashlib, os
+import logging
+
+from .EdsConnector import EdsConnector
+from .EdsAsyncConnector import EdsAsyncConnector
+from .EdsHelper import EdsHelper, DEFAULT_STORAGE_DIR
+from .EdsMetrics import EdsMetrics
+from .EdsStore import EdsStore
+
+_LOGGER = logging.getLogger(__name__)
+
+_ACCOUNTS = {}
+
+class EdsAccount():
+    """
+    Every supply (CUPS) of an e-Distribución account, sharing a single connector, login and store.
+
+    Each CUPS gets its own EdsHelper (with its own state), and all of them are refreshed concurrently:
+    >>> account = EdsAccount.get(user, password)
+    >>> helper = account.helper('ES0031...')
+    >>> await account.async_update()
+    """
+
+    def __init__(self, user, password, short_interval=None, long_interval=None, storage_dir=None, pvpc_source=None, meter_budget=None, store=None):
+        self._username = user
+        self._password = password
+        self._short_interval = short_interval
+        self._long_interval = long_interval
+        self._storage_dir = storage_dir
+        self._pvpc_source = pvpc_source
+        self._meter_budget = meter_budget
+        self._store = store if store is not None else EdsStore(storage_dir if storage_dir is not None else DEFAULT_STORAGE_DIR)
+        # both connectors of this account count into the same metrics, apart from other accounts
+        self._metrics = EdsMetrics()
+        # slow-changing responses survive restarts
+        cache_file = os.path.join(storage_dir if storage_dir is not None else DEFAULT_STORAGE_DIR, f'edistribucion.{self.key}.cache')
+        for connector, suffix in ((EdsConnector, '.sync'), (EdsAsyncConnector, '')):
+            eds = connector.shared(user, password, session_dir=storage_dir)
+            eds.metrics = self._metrics
+            eds.cache.persist(cache_file + suffix)
+        self._helpers = {}
+        self._cups_list = None
+        self._cups_lock = None
+        self._refresh = None
+
+    @classmethod
+    def get(cls, user, password, **kwargs):
+        """
+        Account registry, so platform entries sharing credentials share the account: the first one sets the
+        intervals, storage and meter budget, differing ones are warned about (and ignored)
+        """
+        account = _ACCOUNTS.get(user, None)
+        if account is not None and account._password == password:
+            differing = [x for x in ('short_interval', 'long_interval', 'storage_dir', 'pvpc_source', 'meter_budget') if x in kwargs and kwargs[x] != getattr(account, '_' + x)]
+            if len(differing) > 0:
+                _LOGGER.warning (f"Entries of {user} differ in {', '.join(differing)}, those of the first one are kept")
+            return account
+        if account is not None and kwargs.get('storage_dir', None) == account._storage_dir:
+            # new credentials, same store (and sqlite connection)
+            kwargs.setdefault('store', account._store)
+        _ACCOUNTS[user] = cls(user, password, **kwargs)
+        return _ACCOUNTS[user]
+
+    @property
+    def helpers(self):
+        return list(self._helpers.values())
+
+    def helper(self, cups=None):
+        if cups not in self._helpers:
+            self._helpers[cups] = EdsHelper(self._username, self._password, cups=cups, short_interval=self._short_interval, long_interval=self._long_interval, store=self._store, account=self, pvpc_source=self._pvpc_source, meter_budget=self._meter_budget)
+        return self._helpers[cups]
+
+    async def async_cups_list(self):
+        # fetched once (single-flight) for every helper of this account
+        if self._cups_lock is None:
+            self._cups_lock = asyncio.Lock()
+        async with self._cups_lock:
+            if self._cups_list is None or len(self._cups_list) == 0:
+                eds = EdsAsyncConnector.shared(self._username, self._password)
+                await eds.login()
+                self._cups_list = await eds.get_cups_list()
+        return self._cups_list
+
+    async def async_discover(self):
+        """Creates a helper for every supply returned by get_cups_list"""
+        for c in await self.async_cups_list():
+            self.helper(c.get('CUPS', None))
+        return self.helpers
+
+    async def async_update(self):
+        # concurrent callers share the same in-flight refresh
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.ensure_future(self._async_update())
+        await asyncio.shield(self._refresh)
+
+    async def _async_update(self):
+        eds = EdsAsyncConnector.shared(self._username, self._password)
+        await eds.login()
+        results = await asyncio.gather(*[h.async_update() for h in self.helpers], return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                _LOGGER.info (r)
+
+    async def async_backfill(self, start, end=None):
+        """Archives the hourly curve of every CUPS since start (a date), one CUPS after another"""
+        results = {}
+        for cups, h in self._helpers.items():
+            results[cups] = await h.async_backfill(start, end)
+        return results
+
+    async def async_history(self, start):
+        """Stores the daily and monthly history of every CUPS since start (a date), one CUPS after another"""
+        results = {}
+        for cups, h in self._helpers.items():
+            results[cups] = await h.async_history(start)
+        return results
+
+    def update(self):
+        for h in self.helpers:
+            h.update()
+
+    def diagnostics(self):
+        """Metrics snapshot (see EdsMetrics) and the remaining request budget of this account"""
+        eds = EdsConnector.shared(self._username, self._password)
+        diagnostics = self.metrics.snapshot()
+        diagnostics['budget'] = eds.budget()
+        return diagnostics
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def key(self):
+        """Short stable id of the account, safe for file and entity names"""
+        return hashlib.sha1(self._username.encode()).hexdigest()[:12]
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import aiohttp, asyncio, json, time
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse
+from yarl import URL
+import logging
+
+from .EdsConnector import EdsConnector, EdsBatch, DEFAULT_TIMEOUT, ACCEPT_ENCODING, CONNECT_RETRIES, RETRY_BACKOFF
+from .EdsCache import EdsCache
+from .EdsMetrics import EdsMetrics
+from .EdsSession import EdsSessionStore
+from .EdsScheduler import EdsScheduler, PRIORITY_LOGIN, PRIORITY_REFRESH
+
+_LOGGER = logging.getLogger(__name__)
+
+class EdsResponse():
+    """Already read aiohttp response, exposing the requests.Response fields used by EdsConnector"""
+
+    def __init__(self, url, status_code, headers, content, encoding='utf-8'):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.content.decode(self.encoding, errors='replace')
+        return self._text
+
+    def json(self):
+        return json.loads(self.content)
+
+class EdsAsyncBatch(EdsBatch):
+
+    async def send (self):
+        actions = self._prepare()
+        if len(actions) == 0:
+            return self.results
+        try:
+            response = await self._eds._batch_command(actions, self._priority)
+        except Exception as e:
+            response = e
+        return self._collect(response)
+
+class EdsAsyncConnector(EdsConnector):
+    """
+    asyncio version of EdsConnector, sharing its action builders.
+
+    Every command and getter is a coroutine, so independent requests can be awaited concurrently:
+    >>> cycles, maximeter = await asyncio.gather(eds.get_cycle_list(cont), eds.get_maximeter(cups, d0, d1))
+    """
+    POOL_LIMIT = 10
+    _connector = None
+
+    def __init__(self, user, password, debug_level=_LOGGER.debug, scheduler=None, base_url=None, metrics=None, session_dir=None):
+        self._set_urls(base_url if base_url is not None else self.BASE_URL)
+        self._session = None
+        self._scheduler = scheduler if scheduler is not None else EdsScheduler.default()
+        self.metrics = metrics if metrics is not None else EdsMetrics.default()
+        # cache files are rewritten by a worker thread, not on the event loop
+        self.cache = EdsCache(background=True)
+        self._credentials = {'user': user, 'password': password}
+        self._identities = {}
+        self._jar = None
+        # the same session as EdsConnector's, cookies included, read on the first login (off the event loop)
+        self._store = EdsSessionStore(session_dir if session_dir is not None else self.SESSION_DIR, user)
+
+    @property
+    def _cookies(self):
+        # aiohttp binds the jar to the running loop, so it is made on the loop (the connector may be built elsewhere)
+        if self._jar is None:
+            self._jar = aiohttp.CookieJar()
+        return self._jar
+
+    @classmethod
+    def _get_connector(cls):
+        # all the async connectors share a single connection pool
+        if cls._connector is None or cls._connector.closed:
+            EdsAsyncConnector._connector = aiohttp.TCPConnector(limit=cls.POOL_LIMIT)
+        return EdsAsyncConnector._connector
+
+    def _trace_config(self):
+        # connections opened by each request (the rest of the requests reused a pooled one)
+        async def on_connection_create_end(session, context, params):
+            self.metrics.connection('async', context.trace_request_ctx['host'], opened=1)
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(on_connection_create_end)
+        return trace
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=self._get_connector(), connector_owner=False, cookie_jar=self._cookies, trace_configs=[self._trace_config()])
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get_url(self, url,get=None,post=None,json=None,cookies=None,headers=None,priority=PRIORITY_LOGIN,timeout=DEFAULT_TIMEOUT):
+        _headers = {
+            'User-Agent':'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:77.0) Gecko/20100101 Firefox/77.0',
+            'Accept-Encoding': ACCEPT_ENCODING,
+        }
+        if (headers):
+            _headers.update(headers)
+        host = urlparse(url).netloc
+        await self._scheduler.async_acquire(self._credentials['user'], host, priority)
+        session = self._get_session()
+        kwargs = {'params': get, 'headers': _headers, 'cookies': cookies, 'timeout': aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1]), 'trace_request_ctx': {'host': host}}
+        for attempt in range(CONNECT_RETRIES + 1):
+            try:
+                if (post is None and json is None):
+                    request = session.get(url, **kwargs)
+                else:
+                    request = session.post(url, data=post, json=json, **kwargs)
+                async with request as r:
+                    content = await r.read()
+                    self.metrics.connection('async', host, requests=1)
+                    self._scheduler.report(self._credentials['user'], host, status=r.status)
+                    if r.status >= 400:
+                        raise self.EdsException ('Received status_code > 400')
+                    return EdsResponse(str(r.url), r.status, r.headers, content, r.get_encoding())
+            except aiohttp.ClientConnectorError:
+                # nothing was sent yet, as urllib3's connect retries on the sync side
+                if attempt == CONNECT_RETRIES:
+                    raise
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+    async def _command(self, command, post=None, dashboard=None, accept='*/*', content_type=None, batch=False, priority=PRIORITY_REFRESH, timeout=DEFAULT_TIMEOUT):
+
+        if dashboard is None: dashboard = self._dashboard
+
+        headers = self._prepare_command(post, accept, content_type)
+        started = time.perf_counter()
+        try:
+            r = await self._get_url(dashboard+command, post=post, headers=headers, priority=priority, timeout=timeout)
+        except Exception:
+            self._record(command, started)
+            raise
+        return self._timed_response(r, command, batch, started)
+
+    async def _batch_command (self, actions, priority=None):
+        command, data = self._batch_message(actions)
+        priority = priority if priority is not None else self._priority(actions)
+        timeout = self._timeout(actions)
+        try:
+            return await self._command(command, post=data, batch=True, priority=priority, timeout=timeout)
+        except self.EdsSessionExpired:
+            if self._in_login:
+                raise
+            await self.login()
+            return await self._command(command, post=data, batch=True, priority=priority, timeout=timeout)
+
+    async def _safe_action (self, action):
+        batch = self.batch()
+        batch.add(action['id'], action)
+        r = (await batch.send()).get(action['id'], None)
+        if r is None:
+            _LOGGER.info (batch.errors.get(action['id'], None))
+            r = {}
+        return r
+
+    def batch (self, priority=None):
+        return EdsAsyncBatch(self, priority)
+
+    def _get_cookies(self):
+        return [{'name': m.key, 'value': m.value, 'domain': m['domain'], 'path': m['path'], 'secure': bool(m['secure'])} for m in self._cookies]
+
+    def _set_cookies(self, cookies):
+        self._cookies.clear()
+        for c in cookies:
+            cookie = SimpleCookie()
+            cookie[c['name']] = c['value']
+            cookie[c['name']]['domain'] = c['domain']
+            cookie[c['name']]['path'] = c['path']
+            cookie[c['name']]['secure'] = c['secure']
+            self._cookies.update_cookies(cookie, URL(self.LANDING_URL))
+
+    async def login(self, retry=True):
+        if (not self._check_tokens()):
+            user = self._credentials['user']
+            # as in EdsConnector.login, no backoff is waited out while holding the lock
+            while self._scheduler.backoff(user) > 0:
+                await asyncio.sleep(self._scheduler.backoff(user))
+            async with self._store.async_lock(delay=lambda: self._scheduler.backoff(user)):
+                if self._check_tokens() or self._adopt(await asyncio.to_thread(self._store.load)):
+                    _LOGGER.debug('Reusing a concurrent login')
+                    return
+                await self._login(retry)
+
+    async def _login(self, retry=True):
+        _LOGGER.debug('Login')
+        self._in_login = True
+        try:
+            self._cookies.clear()
+            if self._context is None:
+                r = await self._get_url(self.LOGIN_URL)
+                self._scan_login_page(r.text)
+            _LOGGER.debug('Performing login routine')
+            r = await self._get_url(self._dashboard+'other.LightningLoginForm.login=1',post=self._login_data())
+            if (self._login_out_of_sync(r.text) and retry):
+                return await self._login(retry=False)
+            jr = self._check_login_response(r)
+            _LOGGER.debug('Accessing to frontdoor')
+            r = await self._get_url(jr['events'][0]['attributes']['values']['url'])
+            _LOGGER.debug('Accessing to landing page')
+            r = await self._get_url(self.LANDING_URL)
+            self._set_token(r.text)
+            _LOGGER.debug('Retrieving account info')
+            # a real request, so the new session gets checked
+            self.cache.invalidate('getLoginInfo')
+            self._set_identities(await self.get_login_info())
+            self._fresh_login = True
+            self._generation = await asyncio.to_thread(self._store.save, self._session_state())
+        finally:
+            self._in_login = False
+
+    # Getters, one POST each
+
+    async def get_login_info(self):
+        return await self._safe_action (self.login_info_action())
+
+    async def get_cups(self):
+        return await self._safe_action (self.cups_action())
+
+    async def get_cups_info(self, cups):
+        return await self._safe_action (self.cups_info_action(cups))
+
+    async def get_cups_all(self):
+        return await self._safe_action (self.cups_all_action())
+
+    async def get_cups_list(self):
+        return self.parse_cups_list (await self._safe_action (self.cups_list_action()))
+
+    async def get_meter(self, cups):
+        return (await self._safe_action (self.meter_action(cups))).get('data', None)
+
+    async def get_cups_detail(self, cups):
+        return await self._safe_action (self.cups_detail_action(cups))
+
+    async def get_cups_status(self, cups):
+        return await self._safe_action (self.cups_status_action(cups))
+
+    async def get_atr_detail(self, atr):
+        return (await self._safe_action (self.atr_detail_action(atr))).get('data', None)
+
+    async def get_solicitud_atr_detail(self, sol):
+        return await self._safe_action (self.solicitud_atr_detail_action(sol))
+
+    async def get_cycle_list(self, cont):
+        return (await self._safe_action (self.cycle_list_action(cont))).get('data', None)
+
+    async def get_cycle_curve(self, cont, range, value):
+        return (await self._safe_action (self.cycle_curve_action(cont, range, value))).get('data', None)
+
+    async def get_day_curve (self, cont, date_start):
+        return (await self._safe_action (self.day_curve_action(cont, date_start))).get('data', None)
+
+    async def get_week_curve (self, cont, date_start):
+        return (await self._safe_action (self.week_curve_action(cont, date_start))).get('data', None)
+
+    async def get_month_curve (self, cont, date_start):
+        return (await self._safe_action (self.month_curve_action(cont, date_start))).get('data', None)
+
+    async def get_custom_curve (self, cont, date_start, date_end):
+        return (await self._safe_action (self.custom_curve_action(cont, date_start, date_end))).get('data', None)
+
+    async def get_maximeter (self, cups, date_start, date_end):
+        return (await self._safe_action (self.maximeter_action(cups, date_start, date_end))).get('data', None)
+
+    async def reconnect_ICP(self, cups):
+        await self._safe_action (self.reconnect_ICP_action(cups))
+        return await self._safe_action (self.go_to_reconnect_ICP_action(cups))
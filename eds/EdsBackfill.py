@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from .EdsStore import month_range
+from .EdsParser import parse_hourly_points
+
+_LOGGER = logging.getLogger(__name__)
+
+# windows fetched at once (they are still subject to the account budget, see EdsScheduler)
+DEFAULT_CONCURRENCY = 3
+
+def month_windows(start, end):
+    """[start, end] (dates) split into calendar months, as (first, last) dates"""
+    windows = []
+    for month in month_range(start, end):
+        last = (month + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        windows.append((max(start, month), min(end, last)))
+    return windows
+
+async def fetch_window(eds, semaphore, action, save, progress, label):
+    """
+    Sends a curve action (once the semaphore allows) and hands its data to save, run in a thread (sqlite off the event
+    loop), counting the progress key save returns; a failed window is counted as 'failed' and left for the next run
+    """
+    async with semaphore:
+        try:
+            batch = eds.batch()
+            batch.add('curve', action)
+            await batch.send()
+            if 'curve' in batch.errors:
+                raise batch.errors['curve']
+            progress[await asyncio.to_thread(save, batch.results['curve'].get('data', {}))] += 1
+        except Exception as e:
+            _LOGGER.info (f'{label} failed: {e}')
+            progress['failed'] += 1
+
+class EdsBackfill():
+    """
+    Historical backfill of the hourly curve of a contract, by monthly windows fetched concurrently.
+
+    Every finished window is archived at the store and checkpointed once all of its days are final or it is older
+    than FINAL_DELAY, so an interrupted backfill resumes where it stopped (and recent incomplete windows are fetched
+    again):
+    >>> backfill = EdsBackfill(aeds, store, cont_id, date(2019, 1, 1))
+    >>> await backfill.run()
+    {'windows': 34, 'skipped': 0, 'done': 32, 'partial': 1, 'failed': 1}
+    """
+
+    def __init__(self, eds, store, cont_id, start, end=None, concurrency=DEFAULT_CONCURRENCY):
+        self._eds = eds
+        self._store = store
+        self._cont_id = cont_id
+        self._start = start
+        self._end = end if end is not None else datetime.today().date()
+        self._concurrency = concurrency
+        self.progress = None
+
+    def _save(self, data, first, last):
+        points = parse_hourly_points(data.get('mapHourlyPoints', {}))
+        return 'done' if self._store.save_backfill_window(self._cont_id, points, first, last) else 'partial'
+
+    def _window(self, semaphore, first, last):
+        action = self._eds.custom_curve_action(self._cont_id, first.strftime("%Y-%m-%d"), last.strftime("%Y-%m-%d"))
+        return fetch_window(self._eds, semaphore, action, lambda data: self._save(data, first, last), self.progress, f'Backfill window {first} - {last}')
+
+    async def run(self):
+        """Fetches every window not checkpointed yet, returns the progress counters"""
+        windows = month_windows(self._start, self._end)
+        done = await asyncio.to_thread(self._store.backfill_done, self._cont_id)
+        pending = [w for w in windows if w[0] not in done]
+        self.progress = {'windows': len(windows), 'skipped': len(windows) - len(pending), 'done': 0, 'partial': 0, 'failed': 0}
+        await self._eds.login()
+        semaphore = asyncio.Semaphore(self._concurrency)
+        # most recent windows first, they are the most likely to be used
+        await asyncio.gather(*[self._window(semaphore, first, last) for first, last in reversed(pending)])
+        _LOGGER.debug (f'Backfill finished: {self.progress}')
+        return self.progress
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json, os, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+FOREVER = float('inf')
+
+# time to live (seconds) by aura method, other methods are not cached
+DEFAULT_TTLS = {
+    'getLoginInfo': 24 * 3600,
+    'getListCups': 24 * 3600,
+    'getCUPSDetail': 24 * 3600,
+    'getATRDetail': 7 * 24 * 3600,
+    'getSolicitudATRDetail': 7 * 24 * 3600,
+    # curves of closed (invoiced) cycles never change
+    'getChartPoints': FOREVER,
+}
+
+DEFAULT_MAX_ENTRIES = 256
+
+class EdsCache():
+    """
+    Response cache for aura actions, keyed by (descriptor, params), with a TTL per method,
+    bounded LRU eviction and optional persistence to disk (rewritten by a worker thread with background, e.g.
+    for a connector running on an event loop).
+
+    For instance:
+    >>> cache.put(action, returnValue)
+    >>> cache.get(action)
+    >>> cache.invalidate('getListCups')
+    """
+
+    def __init__(self, ttls=None, max_entries=DEFAULT_MAX_ENTRIES, path=None, background=False):
+        self._ttls = ttls if ttls is not None else DEFAULT_TTLS
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._path = None
+        # a single writer keeps the saves in order, and those asked while one is pending are merged into it
+        self._writer = ThreadPoolExecutor(max_workers=1) if background else None
+        self._pending = False
+        if path is not None:
+            self.persist(path)
+
+    @staticmethod
+    def _method(descriptor):
+        return descriptor.split('$')[-1]
+
+    @staticmethod
+    def _key(action):
+        return action['descriptor'] + '|' + json.dumps(action.get('params', {}), sort_keys=True)
+
+    def cacheable(self, action):
+        return self._method(action['descriptor']) in self._ttls
+
+    def get(self, action):
+        if not self.cacheable(action):
+            return None
+        key = self._key(action)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, action, value):
+        if not self.cacheable(action):
+            return
+        with self._lock:
+            key = self._key(action)
+            self._entries[key] = (time.time() + self._ttls[self._method(action['descriptor'])], value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        self._save()
+
+    def invalidate(self, method=None, params=None):
+        """Drops every entry, or those of a method (e.g. 'getListCups'), optionally matching its params"""
+        with self._lock:
+            for key in list(self._entries):
+                descriptor, p = key.split('|', 1)
+                if method is not None and self._method(descriptor) != method and descriptor != method:
+                    continue
+                if params is not None and p != json.dumps(params, sort_keys=True):
+                    continue
+                del self._entries[key]
+        self._save()
+
+    def persist(self, path):
+        """Loads the cache from path, and keeps it saved there afterwards"""
+        self._path = path
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+            now = time.time()
+            with self._lock:
+                for key, expires, value in entries:
+                    if expires > now:
+                        self._entries[key] = (expires, value)
+        except FileNotFoundError:
+            _LOGGER.debug ('Cache file not found')
+        except Exception as e:
+            _LOGGER.info (e)
+
+    def _save(self):
+        if self._path is None:
+            return
+        if self._writer is None:
+            return self._write()
+        with self._lock:
+            if self._pending:
+                return
+            self._pending = True
+        self._writer.submit(self._write)
+
+    def _write(self):
+        try:
+            with self._lock:
+                self._pending = False
+                entries = [[key, self._entries[key][0], self._entries[key][1]] for key in self._entries]
+            # atomic write, so a crash never leaves a truncated cache
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self._path)
+        except Exception as e:
+            _LOGGER.info (e)
+
+    def __len__(self):
+        return len(self._entries)
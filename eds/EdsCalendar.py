@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from datetime import date
+from functools import lru_cache
+
+# 2.0TD periods
+P1 = 1
+P2 = 2
+P3 = 3
+
+HOURS_P1 = [10, 11, 12, 13, 18, 19, 20, 21]
+HOURS_P2 = [8, 9, 14, 15, 16, 17, 22, 23]
+
+# national holidays with a fixed date (the only ones considered by 2.0TD), as (month, day)
+NATIONAL_HOLIDAYS = [(1, 1), (1, 6), (5, 1), (8, 15), (10, 12), (11, 1), (12, 6), (12, 8), (12, 25)]
+
+_WORKDAY = bytes([P1 if h in HOURS_P1 else P2 if h in HOURS_P2 else P3 for h in range(24)])
+_HOLIDAY = bytes([P3] * 24)
+
+def is_holiday(day):
+    return day.weekday() >= 5 or (day.month, day.day) in NATIONAL_HOLIDAYS
+
+@lru_cache(maxsize=8)
+def period_calendar(year):
+    """
+    Period lookup table for a whole year, indexed by (day_of_year - 1) * 24 + hour.
+
+    For instance:
+    >>> period_calendar(2021)[(date(2021, 6, 1).timetuple().tm_yday - 1) * 24 + 10]
+    1
+    """
+    start = date(year, 1, 1).toordinal()
+    days = date(year + 1, 1, 1).toordinal() - start
+    return b''.join([_HOLIDAY if is_holiday(date.fromordinal(start + d)) else _WORKDAY for d in range(days)])
+
+def period_of(dt):
+    return period_calendar(dt.year)[(dt.timetuple().tm_yday - 1) * 24 + dt.hour]
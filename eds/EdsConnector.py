@@ -1,16 +1,52 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import requests, pickle, json, os, math
-from bs4 import BeautifulSoup as bs
-from urllib.parse import urlparse, unquote
+import importlib.util, json, re, html, threading, time
+from urllib.parse import unquote, urlparse
 import logging
-from datetime import datetime, timedelta
-from dateutil.tz import tzutc
+from datetime import datetime, timezone
 
-UTC = tzutc()
+from .EdsCache import EdsCache
+from .EdsMetrics import EdsMetrics
+from .EdsSession import EdsSessionStore
+from .EdsScheduler import EdsScheduler, PRIORITY_INTERACTIVE, PRIORITY_LOGIN, PRIORITY_REFRESH, PRIORITY_BULK
+
+UTC = timezone.utc
 
 _LOGGER = logging.getLogger(__name__)
 
+_CONNECTORS = {}
+
+# connections opened by the request being sent from each thread (see _counting_pool)
+_OPENED = threading.local()
+
+# connect and read timeouts (seconds), by aura method, DEFAULT_TIMEOUT otherwise
+DEFAULT_TIMEOUT = (10, 60)
+TIMEOUTS = {
+    'getChartPointsByRange': (10, 120),
+    'getHistogramPoints': (10, 90),
+    'consultarContador': (10, 90),
+}
+
+# connect errors are retried (nothing was sent yet), any other failure is left to the scheduler's backoff
+CONNECT_RETRIES = 2
+RETRY_BACKOFF = 0.5
+
+# brotli is only negotiated if a decoder is installed (both urllib3 and aiohttp look for the same modules)
+ACCEPT_ENCODING = 'gzip, deflate, br' if any([importlib.util.find_spec(m) is not None for m in ('brotli', 'brotlicffi')]) else 'gzip, deflate'
+
+# scheduling priority by aura method, PRIORITY_REFRESH otherwise
+PRIORITIES = {
+    'reconectarICP': PRIORITY_INTERACTIVE,
+    'goToReconectarICP': PRIORITY_INTERACTIVE,
+    'consultarContador': PRIORITY_INTERACTIVE,
+    'getLoginInfo': PRIORITY_LOGIN,
+    'getChartPoints': PRIORITY_BULK,
+    'getChartPointsByRange': PRIORITY_BULK,
+    'getHistogramPoints': PRIORITY_BULK,
+}
+
+RESOURCES_JS = re.compile(r'<script[^>]+src="([^"]*resources\.js[^"]*)"')
+
 def serialize_date(dt):
     """
     Serialize a date/time value into an ISO8601 text representation
@@ -24,58 +60,162 @@ def serialize_date(dt):
         dt = dt.astimezone(UTC).replace(tzinfo=None)
     return dt.isoformat() 
 
+def _counting_pool(pool_class):
+    # urllib3 opens connections in the thread sending the request, so they are counted for that request alone
+    class CountingPool(pool_class):
+        def _new_conn(self):
+            _OPENED.count = getattr(_OPENED, 'count', 0) + 1
+            return super()._new_conn()
+    return CountingPool
+
 class EdsConnector():
-    SESSION_FILE = '/tmp/edistribucion.session'
-    ACCESS_FILE = '/tmp/edistribucion.access'
+    SESSION_DIR = '/tmp'
+    POOL_HOSTS = 4
+    POOL_LIMIT = 10
+    _adapter = None
     _session = None
+    _store = None
+    _generation = None
     _token = 'undefined'
-    _credentials = {}
-    _dashboard = 'https://zonaprivada.edistribucion.com/areaprivada/s/sfsites/aura?'
+    _credentials = None
+    _dashboard = None
     _command_index = 0
-    _identities = {}
+    _identities = None
     _appInfo = None
     _context = None
     _access_date = datetime.now()
+    _in_login = False
+    # a token nothing succeeded with since the login that got it
+    _fresh_login = False
+    _scheduler = None
+    cache = None
+    metrics = None
+
+    BASE_URL = 'https://zonaprivada.edistribucion.com'
+    LOGIN_URL = None
+    LANDING_URL = None
     
     class EdsException (Exception):
         def _init_(self, message, where='EdsConnector'):
             self.message = message
             super()._init_(f'[{where}] {message}')
+
+    class EdsSessionExpired (EdsException):
+        pass
     
-    def __init__(self, user, password, debug_level=_LOGGER.debug):
-        self._session = requests.Session()
-        self._credentials['user'] = user
-        self._credentials['password'] = password
-        try:
-            with open(EdsConnector.SESSION_FILE, 'rb') as f:
-                self._session.cookies.update(pickle.load(f))
-        except FileNotFoundError:
-            _LOGGER.debug ('Session file not found')
-        try:
-            with open(EdsConnector.ACCESS_FILE, 'rb') as f:
-                d = json.load(f)
-                self._token = d['token']
-                self._identities = d['identities']
-                self._context = d['context']
-                self._access_date = datetime.fromisoformat(d['date'])
-        except FileNotFoundError:
-            _LOGGER.debug ('Access file not found')
+    def __init__(self, user, password, debug_level=_LOGGER.debug, scheduler=None, base_url=None, metrics=None, session_dir=None):
+        self._set_urls(base_url if base_url is not None else self.BASE_URL)
+        self._session = None
+        self._pending_cookies = []
+        self._scheduler = scheduler if scheduler is not None else EdsScheduler.default()
+        self.metrics = metrics if metrics is not None else EdsMetrics.default()
+        self.cache = EdsCache()
+        self._credentials = {'user': user, 'password': password}
+        self._identities = {}
+        # one session per account, shared with every other connector (and process) of the account
+        self._store = EdsSessionStore(session_dir if session_dir is not None else self.SESSION_DIR, user)
+        self._adopt(self._store.load())
+
+    def _set_urls(self, base_url):
+        self._dashboard = base_url + '/areaprivada/s/sfsites/aura?'
+        self.LOGIN_URL = base_url + '/areaprivada/s/login?ec=302&startURL=%2Fareaprivada%2Fs%2F'
+        self.LANDING_URL = base_url + '/areaprivada/s/'
+
+    @classmethod
+    def shared(cls, user, password, **kwargs):
+        """Connector registry: a single connector (and login) per account and connector class"""
+        key = (cls, user)
+        if key not in _CONNECTORS or _CONNECTORS[key]._credentials['password'] != password:
+            _CONNECTORS[key] = cls(user, password, **kwargs)
+        return _CONNECTORS[key]
+
+    def _adopt(self, state):
+        """Takes a saved session, unless it is the one already known (maybe expired) or it has no token"""
+        if state is None:
+            return False
+        if self._context is None and state.get('context', None) is not None:
+            # the context is still valid after an expiry, so a login can skip the login page
+            self._context = state['context']
+            self._appInfo = json.loads(self._context)
+        if state.get('token', 'undefined') == 'undefined' or state.get('generation', None) == self._generation:
+            return False
+        self._token = state['token']
+        self._fresh_login = False
+        self._identities = state.get('identities', {})
+        self._context = state.get('context', None)
+        self._appInfo = json.loads(self._context) if self._context is not None else None
+        self._access_date = datetime.fromtimestamp(state.get('date', time.time()))
+        self._generation = state['generation']
+        self._set_cookies(state.get('cookies', []))
+        return True
+
+    @classmethod
+    def _get_adapter(cls):
+        # all the sync connectors share a connection pool per host, kept across logins
+        if EdsConnector._adapter is None:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=CONNECT_RETRIES, connect=CONNECT_RETRIES, read=0, status=0, other=0, redirect=False, backoff_factor=RETRY_BACKOFF)
+            adapter = HTTPAdapter(pool_connections=cls.POOL_HOSTS, pool_maxsize=cls.POOL_LIMIT, max_retries=retry)
+            manager = adapter.poolmanager
+            manager.pool_classes_by_scheme = {scheme: _counting_pool(pool) for scheme, pool in manager.pool_classes_by_scheme.items()}
+            EdsConnector._adapter = adapter
+        return EdsConnector._adapter
+
+    def _get_session(self):
+        # requests is only imported once the sync connector is actually used
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+            self._session.mount('https://', self._get_adapter())
+            self._session.mount('http://', self._get_adapter())
+            self._set_cookies(self._pending_cookies)
+        return self._session
+
+
+    def _get_cookies(self):
+        if self._session is None:
+            return self._pending_cookies
+        return [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'secure': c.secure} for c in self._session.cookies]
+
+    def _set_cookies(self, cookies):
+        if self._session is None:
+            self._pending_cookies = cookies
+            return
+        self._session.cookies.clear()
+        for c in cookies:
+            self._session.cookies.set(c['name'], c['value'], domain=c['domain'], path=c['path'], secure=c['secure'])
         
-    def _get_url(self, url,get=None,post=None,json=None,cookies=None,headers=None):
+    def _get_url(self, url,get=None,post=None,json=None,cookies=None,headers=None,priority=PRIORITY_LOGIN,timeout=DEFAULT_TIMEOUT):
         _headers = {
             'User-Agent':'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:77.0) Gecko/20100101 Firefox/77.0',
+            'Accept-Encoding': ACCEPT_ENCODING,
         }
         if (headers):
             _headers.update(headers)
+        host = urlparse(url).netloc
+        self._scheduler.acquire(self._credentials['user'], host, priority)
+        # requests that did not open a connection of their own reused a pooled one
+        _OPENED.count = 0
         if (post is None and json is None):
-            r = self._session.get(url, params=get, headers=_headers, cookies=cookies)
+            r = self._get_session().get(url, params=get, headers=_headers, cookies=cookies, timeout=timeout)
         else:
-            r = self._session.post(url, data=post, json=json, params=get, headers=_headers, cookies=cookies)
+            r = self._get_session().post(url, data=post, json=json, params=get, headers=_headers, cookies=cookies, timeout=timeout)
+        self.metrics.connection('sync', host, requests=1, opened=_OPENED.count)
+        self._scheduler.report(self._credentials['user'], host, status=r.status_code)
         if r.status_code >= 400:
             raise self.EdsException ('Received status_code > 400')
         return r
-    
-    def _command(self, command, post=None, dashboard=None, accept='*/*', content_type=None):
+
+    def _timeout(self, actions):
+        # the longest connect and read timeouts of the actions
+        timeouts = [TIMEOUTS.get(a['descriptor'].split('$')[-1], DEFAULT_TIMEOUT) for a in actions]
+        return (max([t[0] for t in timeouts]), max([t[1] for t in timeouts]))
+
+    def _priority(self, actions):
+        return min([PRIORITIES.get(a['descriptor'].split('$')[-1], PRIORITY_REFRESH) for a in actions])
+
+    def _command(self, command, post=None, dashboard=None, accept='*/*', content_type=None, batch=False, priority=PRIORITY_REFRESH, timeout=DEFAULT_TIMEOUT):
 
         if dashboard is None: dashboard = self._dashboard 
 
@@ -83,6 +223,44 @@ class EdsConnector():
             command = 'r='+self._command_index+'&'
             self._command_index += 1
         
+        headers = self._prepare_command(post, accept, content_type)
+        started = time.perf_counter()
+        try:
+            r = self._get_url(dashboard+command, post=post, headers=headers, priority=priority, timeout=timeout)
+        except Exception:
+            self._record(command, started)
+            raise
+        return self._timed_response(r, command, batch, started)
+
+    def _timed_response(self, r, command, batch, started):
+        received = time.perf_counter()
+        try:
+            result = self._handle_response(r, command, batch)
+        except self.EdsSessionExpired:
+            self._record(command, started, received, r, redirected=True)
+            raise
+        except Exception:
+            self._record(command, started, received, r)
+            raise
+        self._record(command, started, received, r, result if batch else [{'state': 'SUCCESS'}])
+        return result
+
+    def _record(self, command, started, received=None, r=None, result=None, redirected=False):
+        # one record per action, labelled 'Controller.method' as in the command ('other.Controller.method=1&...')
+        descriptors = [x.split('=')[0].replace('other.', '', 1) for x in command.split('&') if x.startswith('other.')]
+        if len(descriptors) == 0:
+            return
+        now = time.perf_counter()
+        states = [x.get('state', None) for x in result] if isinstance(result, list) else []
+        for ix, d in enumerate(descriptors):
+            self.metrics.command(d,
+                latency=(received - started) if received is not None else None,
+                size=len(r.content) // len(descriptors) if r is not None else 0,
+                parse=(now - received) / len(descriptors) if received is not None else None,
+                failed=(ix >= len(states) or states[ix] != 'SUCCESS'),
+                redirected=redirected)
+
+    def _prepare_command(self, post, accept, content_type):
         if (post):
             post['aura.context'] = self._context
             post['aura.pageURI'] = '/areaprivada/s/wp-online-access'
@@ -92,142 +270,278 @@ class EdsConnector():
         headers['Accept'] = accept
         if content_type is not None:
             headers['Content-Type'] = content_type
+        return headers
 
-        r = self._get_url(dashboard+command, post=post, headers=headers)
-        if ('window.location.href' in r.text or 'clientOutOfSync' in r.text):
-                _LOGGER.info ('Redirection received. Aborting command.')
-        elif ('json' in r.headers['Content-Type']):
-            jr = r.json()
+    def _handle_response(self, r, command, batch):
+        # JSON bodies are decoded once, straight from bytes; redirections are only looked for otherwise
+        jr = None
+        if ('json' in r.headers.get('Content-Type', '')):
+            try:
+                jr = json.loads(r.content)
+            except ValueError:
+                jr = None
+        if (jr is not None and 'actions' in jr):
+            self._fresh_login = False
+            if batch:
+                return jr['actions']
             if (jr['actions'][0]['state'] != 'SUCCESS'):
                 _LOGGER.info ('Got an error. Aborting command.')
                 raise self.EdsException (f'Error processing command: {command}')
             return jr['actions'][0]['returnValue']
-        
+        elif ('window.location.href' in r.text or 'clientOutOfSync' in r.text or 'invalidSession' in r.text):
+            _LOGGER.info ('Redirection received. Session expired.')
+            if self._fresh_login:
+                # tokens do expire, but one that expires again right after a login is backed off from
+                self._scheduler.report(self._credentials['user'], urlparse(self._dashboard).netloc, expired=True)
+            self._token = 'undefined'
+            if ('clientOutOfSync' in r.text):
+                self._context = None
+            raise self.EdsSessionExpired (f'Session expired while processing command: {command}')
+
+        if batch:
+            raise self.EdsException (f'Unexpected response to command: {command}')
         return r
     
     def _check_tokens(self):
+        # the token is kept until the server signals its expiry (see _handle_response)
         _LOGGER.debug('Checking tokens')
-        return self._token != 'undefined' and self._access_date+timedelta(minutes=10) > datetime.now()
+        return self._token != 'undefined'
         
+    def _session_state(self):
+        self._access_date = datetime.now()
+        return {
+            'token': self._token,
+            'identities': self._identities,
+            'context': self._context,
+            'cookies': self._get_cookies(),
+        }
+
     def _save_state(self):
-        try:
-            with open(EdsConnector.SESSION_FILE, 'wb') as f:
-                pickle.dump(self._session.cookies, f)
-                _LOGGER.debug('Saving session')
-        except FileNotFoundError:
-            _LOGGER.debug ('Cannot save session file')
-        try:
-            t = {}
-            t['token'] = self._token
-            t['identities'] = self._identities
-            t['context'] = self._context
-            t['date'] = datetime.now()
-            with open(EdsConnector.ACCESS_FILE, 'w') as f:
-                json.dump(t, f, default=serialize_date)
-            _LOGGER.debug('Saving access to file')
-        except FileNotFoundError:
-            _LOGGER.debug ('Cannot save access file')
-        
-    def login(self):
+        self._generation = self._store.save(self._session_state())
+
+    def login(self, retry=True):
         if (not self._check_tokens()):
-            _LOGGER.debug('Login')
-            self._session = requests.Session()
-            r = self._get_url('https://zonaprivada.edistribucion.com/areaprivada/s/login?ec=302&startURL=%2Fareaprivada%2Fs%2F')
-            ix = r.text.find('auraConfig')
-            if (ix == -1):
-                raise self.EdsException ('auraConfig not found. Cannot continue')
-            soup = bs(r.text, 'html.parser')
-            scripts = soup.find_all('script')
-            _LOGGER.debug('Loading scripts')
-            for s in scripts:
-                src = s.get('src')
-                if (not src):
-                    continue
-                #print(s)
-                upr = urlparse(r.url)
-                r = self._get_url(upr.scheme+'://'+upr.netloc+src)
-                if ('resources.js' in src):
-                    unq = unquote(src)
-                    self._context = unq[unq.find('{'):unq.rindex('}')+1]
-                    self._appInfo = json.loads(self._context)
+            user = self._credentials['user']
+            # a backoff is waited out before taking the lock, and lock waiters wait as long as it lasts
+            while self._scheduler.backoff(user) > 0:
+                time.sleep(self._scheduler.backoff(user))
+            # single-flight: whoever holds the lock logs in, the others wait and reuse that session
+            with self._store.lock(delay=lambda: self._scheduler.backoff(user)):
+                if self._check_tokens() or self._adopt(self._store.load()):
+                    _LOGGER.debug('Reusing a concurrent login')
+                    return
+                self._login(retry)
+
+    def _login(self, retry=True):
+        _LOGGER.debug('Login')
+        self._in_login = True
+        try:
+            # a new login only drops the cookies, pooled connections are kept
+            self._set_cookies([])
+            if self._context is None:
+                # context (and fwuid) are taken from the login page once, and reused afterwards
+                r = self._get_url(self.LOGIN_URL)
+                self._scan_login_page(r.text)
             _LOGGER.debug('Performing login routine')
-            data = {
-                    'message':'{"actions":[{"id":"91;a","descriptor":"apex://LightningLoginFormController/ACTION$login","callingDescriptor":"markup://c:WP_LoginForm","params":{"username":"'+self._credentials['user']+'","password":"'+self._credentials['password']+'","startUrl":"/areaprivada/s/"}}]}',
-                    'aura.context':self._context,
-                    'aura.pageURI':'/areaprivada/s/login/?language=es&startURL=%2Fareaprivada%2Fs%2F&ec=302',
-                    'aura.token':'undefined',
-                    }
-            r = self._get_url(self._dashboard+'other.LightningLoginForm.login=1',post=data)
-            #print(r.text)
-            if ('/*ERROR*/' in r.text):
-                if ('invalidSession' in r.text):
-                    self._session = requests.Session()
-                    self.login()
-                raise self.EdsException ('Unexpected error in loginForm. Cannot continue')
-            jr = r.json()
-            if ('events' not in jr):
-                raise self.EdsException ('Wrong login response. Cannot continue')
-            
+            r = self._get_url(self._dashboard+'other.LightningLoginForm.login=1',post=self._login_data())
+            if (self._login_out_of_sync(r.text) and retry):
+                return self._login(retry=False)
+            jr = self._check_login_response(r)
             _LOGGER.debug('Accessing to frontdoor')
             r = self._get_url(jr['events'][0]['attributes']['values']['url'])
             _LOGGER.debug('Accessing to landing page')
-            r = self._get_url('https://zonaprivada.edistribucion.com/areaprivada/s/')
-            ix = r.text.find('auraConfig')
-            if (ix == -1):
-                raise self.EdsException ('auraConfig not found. Cannot continue')
-            ix = r.text.find('{',ix)
-            ed = r.text.find(';',ix)
-            try:
-                jr = json.loads(r.text[ix:ed])
-            except Exception:
-                jr = {}
-            if ('token' not in jr):
-                raise self.EdsException ('token not found. Cannot continue')
-            self._token = jr['token']
-            _LOGGER.debug('Token received!')
-            _LOGGER.debug(self._token)
+            r = self._get_url(self.LANDING_URL)
+            self._set_token(r.text)
             _LOGGER.debug('Retrieving account info')
-            r = self.get_login_info()
-            self._identities['account_id'] = r['visibility']['Id']
-            self._identities['name'] = r['Name']
-            _LOGGER.info('Received name: %s (%s)',r['Name'],r['visibility']['Visible_Account__r']['Identity_number__c'])
-            _LOGGER.debug('Account_id: %s', self._identities['account_id'])
+            # a real request, so the new session gets checked
+            self.cache.invalidate('getLoginInfo')
+            self._set_identities(self.get_login_info())
+            self._fresh_login = True
             self._save_state()
+        finally:
+            self._in_login = False
+
+    def _scan_login_page(self, text):
+        # a targeted scan: no DOM is built and no script is downloaded
+        if (text.find('auraConfig') == -1):
+            raise self.EdsException ('auraConfig not found. Cannot continue')
+        m = RESOURCES_JS.search(text)
+        if (m is None):
+            raise self.EdsException ('resources.js not found. Cannot continue')
+        self._set_context(html.unescape(m.group(1)))
 
-    def _safe_command (self, command, message):
+    def _login_out_of_sync(self, text):
+        if ('/*ERROR*/' in text and ('clientOutOfSync' in text or 'invalidSession' in text)):
+            _LOGGER.debug('Cached context is out of sync, fetching a new one')
+            self._context = None
+            return True
+        return False
+
+    def _check_login_response(self, r):
+        if ('/*ERROR*/' in r.text):
+            raise self.EdsException ('Unexpected error in loginForm. Cannot continue')
+        jr = r.json()
+        if ('events' not in jr):
+            raise self.EdsException ('Wrong login response. Cannot continue')
+        return jr
+
+    def _login_data(self):
+        return {
+                'message':'{"actions":[{"id":"91;a","descriptor":"apex://LightningLoginFormController/ACTION$login","callingDescriptor":"markup://c:WP_LoginForm","params":{"username":"'+self._credentials['user']+'","password":"'+self._credentials['password']+'","startUrl":"/areaprivada/s/"}}]}',
+                'aura.context':self._context,
+                'aura.pageURI':'/areaprivada/s/login/?language=es&startURL=%2Fareaprivada%2Fs%2F&ec=302',
+                'aura.token':'undefined',
+                }
+
+    def _set_context(self, src):
+        unq = unquote(src)
+        self._context = unq[unq.find('{'):unq.rindex('}')+1]
+        self._appInfo = json.loads(self._context)
+
+    def _set_token(self, text):
+        ix = text.find('auraConfig')
+        if (ix == -1):
+            raise self.EdsException ('auraConfig not found. Cannot continue')
+        ix = text.find('{',ix)
+        ed = text.find(';',ix)
         try:
-            data = {}
-            data['message'] = message
-            r = self._command(command, post=data)
-        except Exception as e:
-            _LOGGER.info (e)
+            jr = json.loads(text[ix:ed])
+        except Exception:
+            jr = {}
+        if ('token' not in jr):
+            raise self.EdsException ('token not found. Cannot continue')
+        self._token = jr['token']
+        _LOGGER.debug('Token received!')
+        _LOGGER.debug(self._token)
+
+    def _set_identities(self, r):
+        self._identities['account_id'] = r['visibility']['Id']
+        self._identities['name'] = r['Name']
+        _LOGGER.info('Received name: %s (%s)',r['Name'],r['visibility']['Visible_Account__r']['Identity_number__c'])
+        _LOGGER.debug('Account_id: %s', self._identities['account_id'])
+
+    def _batch_message (self, actions):
+        # one 'other.Controller.method=1' chunk per action, as the web client does
+        command = '&'.join(['other.' + a['descriptor'].split('//')[1].replace('/ACTION$', '.') + '=1' for a in actions])
+        data = {}
+        data['message'] = json.dumps({'actions': actions})
+        return command, data
+
+    def _batch_command (self, actions, priority=None):
+        command, data = self._batch_message(actions)
+        priority = priority if priority is not None else self._priority(actions)
+        timeout = self._timeout(actions)
+        try:
+            return self._command(command, post=data, batch=True, priority=priority, timeout=timeout)
+        except self.EdsSessionExpired:
+            if self._in_login:
+                raise
+            # login again once, and retry
+            self.login()
+            return self._command(command, post=data, batch=True, priority=priority, timeout=timeout)
+
+    def _safe_action (self, action):
+        batch = self.batch()
+        batch.add(action['id'], action)
+        r = batch.send().get(action['id'], None)
+        if r is None:
+            _LOGGER.info (batch.errors.get(action['id'], None))
             r = {}
         return r
 
+    def _action (self, id, descriptor, calling, params, long_running=False, version=False):
+        action = {'id': id, 'descriptor': descriptor, 'callingDescriptor': calling, 'params': params}
+        if version:
+            action['version'] = None
+        if long_running:
+            action['longRunning'] = True
+        return action
+
+    def batch (self, priority=None):
+        return EdsBatch(self, priority)
+
+    def budget (self):
+        """Remaining request budget of this account (see EdsScheduler)"""
+        return self._scheduler.budget(self._credentials['user'])
+
+    # Action builders, to be queued into a batch (see EdsBatch) or sent alone through the getters below
+
+    def login_info_action (self):
+        return self._action('215;a', 'apex://WP_Monitor_CTRL/ACTION$getLoginInfo', 'markup://c:WP_Monitor', {'serviceNumber': 'S011'})
+
+    def cups_action (self):
+        return self._action('270;a', 'apex://WP_ContadorICP_CTRL/ACTION$getCUPSReconectarICP', 'markup://c:WP_Reconnect_ICP', {'visSelected': self._identities['account_id']})
+
+    def cups_info_action (self, cups):
+        return self._action('489;a', 'apex://WP_ContadorICP_CTRL/ACTION$getCupsInfo', 'markup://c:WP_Reconnect_Detail', {'cupsId': cups})
+
+    def cups_all_action (self):
+        return self._action('294;a', 'apex://WP_ConsultaSuministros/ACTION$getAllCUPS', 'markup://c:WP_MySuppliesForm', {'visSelected': self._identities['account_id']})
+
+    def cups_list_action (self):
+        return self._action('1086;a', 'apex://WP_Measure_v3_CTRL/ACTION$getListCups', 'markup://c:WP_Measure_List_v4', {'sIdentificador': self._identities['account_id']})
+
+    def meter_action (self, cups):
+        return self._action('471;a', 'apex://WP_ContadorICP_F2_CTRL/ACTION$consultarContador', 'markup://c:WP_Reconnect_Detail_F2', {'cupsId': cups})
+
+    def cups_detail_action (self, cups):
+        return self._action('490;a', 'apex://WP_CUPSDetail_CTRL/ACTION$getCUPSDetail', 'markup://c:WP_cupsDetail', {'visSelected': self._identities['account_id'], 'cupsId': cups})
+
+    def cups_status_action (self, cups):
+        return self._action('629;a', 'apex://WP_CUPSDetail_CTRL/ACTION$getStatus', 'markup://c:WP_cupsDetail', {'cupsId': cups})
+
+    def atr_detail_action (self, atr):
+        return self._action('62;a', 'apex://WP_ContractATRDetail_CTRL/ACTION$getATRDetail', 'markup://c:WP_SuppliesATRDetailForm', {'atrId': atr})
+
+    def solicitud_atr_detail_action (self, sol):
+        return self._action('56;a', 'apex://WP_SolicitudATRDetail_CTRL/ACTION$getSolicitudATRDetail', 'markup://c:WP_ATR_Requests_Detail_Form', {'solId': sol})
+
+    def cycle_list_action (self, cont):
+        return self._action('1190;a', 'apex://WP_Measure_v3_CTRL/ACTION$getInfo', 'markup://c:WP_Measure_Detail_v4', {'contId': cont}, long_running=True)
+
+    def cycle_curve_action (self, cont, range, value):
+        return self._action('1295;a', 'apex://WP_Measure_v3_CTRL/ACTION$getChartPoints', 'markup://c:WP_Measure_Detail_v4', {'cupsId': cont, 'dateRange': range, 'cfactura': value}, long_running=True)
+
+    def day_curve_action (self, cont, date_start):
+        return self._action('751;a', 'apex://WP_Measure_v3_CTRL/ACTION$getChartPointsByRange', 'markup://c:WP_Measure_Detail_Filter_By_Dates_v3', {'contId': cont, 'type': '1', 'startDate': date_start}, long_running=True, version=True)
+
+    def week_curve_action (self, cont, date_start):
+        return self._action('1497;a', 'apex://WP_Measure_v3_CTRL/ACTION$getChartPointsByRange', 'markup://c:WP_Measure_Detail_Filter_By_Dates_v3', {'contId': cont, 'type': '2', 'startDate': date_start}, long_running=True, version=True)
+
+    def month_curve_action (self, cont, date_start):
+        return self._action('1461;a', 'apex://WP_Measure_v3_CTRL/ACTION$getChartPointsByRange', 'markup://c:WP_Measure_Detail_Filter_By_Dates_v3', {'contId': cont, 'type': '3', 'startDate': date_start}, long_running=True, version=True)
+
+    def custom_curve_action (self, cont, date_start, date_end):
+        return self._action('981;a', 'apex://WP_Measure_v3_CTRL/ACTION$getChartPointsByRange', 'markup://c:WP_Measure_Detail_Filter_Advanced_v3', {'contId': cont, 'type': '4', 'startDate': date_start, 'endDate': date_end}, long_running=True, version=True)
+
+    def maximeter_action (self, cups, date_start, date_end):
+        return self._action('688;a', 'apex://WP_MaximeterHistogram_CTRL/ACTION$getHistogramPoints', 'markup://c:WP_MaximeterHistogramDetail', {'mapParams': {'startDate': date_start, 'endDate': date_end, 'id': cups, 'sIdentificador': self._identities['account_id']}})
+
+    def reconnect_ICP_action (self, cups):
+        return self._action('261;a', 'apex://WP_ContadorICP_F2_CTRL/ACTION$reconectarICP', 'markup://c:WP_Reconnect_Detail_F2', {'cupsId': cups})
+
+    def go_to_reconnect_ICP_action (self, cups):
+        return self._action('287;a', 'apex://WP_ContadorICP_CTRL/ACTION$goToReconectarICP', 'markup://c:WP_Reconnect_Modal', {'cupsId': cups})
+
+    # Getters, one POST each
+
     def get_login_info(self):
-        cmd = 'other.WP_Monitor_CTRL.getLoginInfo=1'
-        msg = '{"actions":[{"id":"215;a","descriptor":"apex://WP_Monitor_CTRL/ACTION$getLoginInfo","callingDescriptor":"markup://c:WP_Monitor","params":{"serviceNumber":"S011"}}]}'
-        return self._safe_command (cmd, msg)
-        
+        return self._safe_action (self.login_info_action())
+
     def get_cups(self):
-        msg = '{"actions":[{"id":"270;a","descriptor":"apex://WP_ContadorICP_CTRL/ACTION$getCUPSReconectarICP","callingDescriptor":"markup://c:WP_Reconnect_ICP","params":{"visSelected":"'+self._identities['account_id']+'"}}]}',
-        cmd = 'other.WP_ContadorICP_CTRL.getCUPSReconectarICP=1'
-        return self._safe_command (cmd, msg)
-    
+        return self._safe_action (self.cups_action())
+
     def get_cups_info(self, cups):
-        msg = '{"actions":[{"id":"489;a","descriptor":"apex://WP_ContadorICP_CTRL/ACTION$getCupsInfo","callingDescriptor":"markup://c:WP_Reconnect_Detail","params":{"cupsId":"'+cups+'"}}]}',
-        cmd = 'other.WP_ContadorICP_CTRL.getCupsInfo=1'
-        return self._safe_command (cmd, msg)
-    
+        return self._safe_action (self.cups_info_action(cups))
+
     def get_cups_all(self):
-        msg = '{"actions":[{"id":"294;a","descriptor":"apex://WP_ConsultaSuministros/ACTION$getAllCUPS","callingDescriptor":"markup://c:WP_MySuppliesForm","params":{"visSelected":"'+self._identities['account_id']+'"}}]}',
-        cmd = 'other.WP_ConsultaSuministros.getAllCUPS=1'
-        return self._safe_command (cmd, msg)
+        return self._safe_action (self.cups_all_action())
 
     def get_cups_list(self):
-        msg = '{"actions":[{"id":"1086;a","descriptor":"apex://WP_Measure_v3_CTRL/ACTION$getListCups","callingDescriptor":"markup://c:WP_Measure_List_v4","params":{"sIdentificador":"'+self._identities['account_id']+'"}}]}',
-        cmd = 'other.WP_Measure_v3_CTRL.getListCups=1'
-        r = self._safe_command (cmd, msg)
+        return self.parse_cups_list (self._safe_action (self.cups_list_action()))
+
+    @staticmethod
+    def parse_cups_list (r):
         conts = []
         if 'data' in r and 'lstCups' in r['data']:
             for cont in r['data']['lstCups']:
@@ -246,69 +560,117 @@ class EdsConnector():
         return conts
 
     def get_meter(self, cups):
-        msg = '{"actions":[{"id":"471;a","descriptor":"apex://WP_ContadorICP_F2_CTRL/ACTION$consultarContador","callingDescriptor":"markup://c:WP_Reconnect_Detail_F2","params":{"cupsId":"'+cups+'"}}]}'
-        cmd = 'other.WP_ContadorICP_F2_CTRL.consultarContador=1'
-        return self._safe_command (cmd, msg).get('data', None)
-    
+        return self._safe_action (self.meter_action(cups)).get('data', None)
+
     def get_cups_detail(self, cups):
-        msg = '{"actions":[{"id":"490;a","descriptor":"apex://WP_CUPSDetail_CTRL/ACTION$getCUPSDetail","callingDescriptor":"markup://c:WP_cupsDetail","params":{"visSelected":"'+self._identities['account_id']+'","cupsId":"'+cups+'"}}]}',
-        cmd = 'other.WP_CUPSDetail_CTRL.getCUPSDetail=1'
-        return self._safe_command (cmd, msg)
-    
+        return self._safe_action (self.cups_detail_action(cups))
+
     def get_cups_status(self, cups):
-        msg = '{"actions":[{"id":"629;a","descriptor":"apex://WP_CUPSDetail_CTRL/ACTION$getStatus","callingDescriptor":"markup://c:WP_cupsDetail","params":{"cupsId":"'+cups+'"}}]}',
-        cmd = 'other.WP_CUPSDetail_CTRL.getStatus=1'
-        return self._safe_command (cmd, msg)
-    
+        return self._safe_action (self.cups_status_action(cups))
+
     def get_atr_detail(self, atr):
-        msg = '{"actions":[{"id":"62;a","descriptor":"apex://WP_ContractATRDetail_CTRL/ACTION$getATRDetail","callingDescriptor":"markup://c:WP_SuppliesATRDetailForm","params":{"atrId":"'+atr+'"}}]}',
-        cmd = 'other.WP_ContractATRDetail_CTRL.getATRDetail=1'
-        return self._safe_command (cmd, msg).get('data', None)
-    
+        return self._safe_action (self.atr_detail_action(atr)).get('data', None)
+
     def get_solicitud_atr_detail(self, sol):
-        msg = '{"actions":[{"id":"56;a","descriptor":"apex://WP_SolicitudATRDetail_CTRL/ACTION$getSolicitudATRDetail","callingDescriptor":"markup://c:WP_ATR_Requests_Detail_Form","params":{"solId":"'+sol+'"}}]}',
-        cmd = 'other.WP_SolicitudATRDetail_CTRL.getSolicitudATRDetail=1'
-        return self._safe_command (cmd, msg)
-    
+        return self._safe_action (self.solicitud_atr_detail_action(sol))
+
     def get_cycle_list(self, cont):
-        msg = '{"actions":[{"id":"1190;a","descriptor":"apex://WP_Measure_v3_CTRL/ACTION$getInfo","callingDescriptor":"markup://c:WP_Measure_Detail_v4","params":{"contId":"'+cont+'"},"longRunning":true}]}',
-        cmd = 'other.WP_Measure_v3_CTRL.getInfo=1'
-        return self._safe_command (cmd, msg).get('data', None)
-        
+        return self._safe_action (self.cycle_list_action(cont)).get('data', None)
+
     def get_cycle_curve(self, cont, range, value):
-        msg = '{"actions":[{"id":"1295;a","descriptor":"apex://WP_Measure_v3_CTRL/ACTION$getChartPoints","callingDescriptor":"markup://c:WP_Measure_Detail_v4","params":{"cupsId":"'+cont+'","dateRange":"'+range+'","cfactura":"'+value+'"},"longRunning":true}]}',
-        cmd = 'other.WP_Measure_v3_CTRL.getChartPoints=1'
-        return self._safe_command (cmd, msg).get('data', None)
+        return self._safe_action (self.cycle_curve_action(cont, range, value)).get('data', None)
 
     def get_day_curve (self, cont, date_start):
-        msg = '{"actions":[{"id":"751;a","descriptor":"apex://WP_Measure_v3_CTRL/ACTION$getChartPointsByRange","callingDescriptor":"markup://c:WP_Measure_Detail_Filter_By_Dates_v3","params":{"contId":"'+cont+'","type":"1","startDate":"'+date_start+'"},"version":null,"longRunning":true}]}',
-        cmd = 'other.WP_Measure_v3_CTRL.getChartPointsByRange=1'
-        return self._safe_command (cmd, msg).get('data', None)
-    
+        return self._safe_action (self.day_curve_action(cont, date_start)).get('data', None)
+
     def get_week_curve (self, cont, date_start):
-        msg = '{"actions":[{"id":"1497;a","descriptor":"apex://WP_Measure_v3_CTRL/ACTION$getChartPointsByRange","callingDescriptor":"markup://c:WP_Measure_Detail_Filter_By_Dates_v3","params":{"contId":"'+cont+'","type":"2","startDate":"'+date_start+'"},"version":null,"longRunning":true}]}',
-        cmd = 'other.WP_Measure_v3_CTRL.getChartPointsByRange=1'
-        return self._safe_command (cmd, msg).get('data', None)
+        return self._safe_action (self.week_curve_action(cont, date_start)).get('data', None)
 
     def get_month_curve (self, cont, date_start):
-        msg = '{"actions":[{"id":"1461;a","descriptor":"apex://WP_Measure_v3_CTRL/ACTION$getChartPointsByRange","callingDescriptor":"markup://c:WP_Measure_Detail_Filter_By_Dates_v3","params":{"contId":"'+cont+'","type":"3","startDate":"'+date_start+'"},"version":null,"longRunning":true}]}',
-        cmd = 'other.WP_Measure_v3_CTRL.getChartPointsByRange=1'
-        return self._safe_command (cmd, msg).get('data', None)
+        return self._safe_action (self.month_curve_action(cont, date_start)).get('data', None)
 
     def get_custom_curve (self, cont, date_start, date_end):
-        msg = '{"actions":[{"id":"981;a","descriptor":"apex://WP_Measure_v3_CTRL/ACTION$getChartPointsByRange","callingDescriptor":"markup://c:WP_Measure_Detail_Filter_Advanced_v3","params":{"contId":"'+cont+'","type":"4","startDate":"'+date_start+'","endDate":"'+date_end+'"},"version":null,"longRunning":true}]}'
-        cmd = 'other.WP_Measure_v3_CTRL.getChartPointsByRange=1'
-        return self._safe_command (cmd, msg).get('data', None)
-        
+        return self._safe_action (self.custom_curve_action(cont, date_start, date_end)).get('data', None)
+
     def get_maximeter (self, cups, date_start, date_end):
-        msg = '{"actions":[{"id":"688;a","descriptor":"apex://WP_MaximeterHistogram_CTRL/ACTION$getHistogramPoints","callingDescriptor":"markup://c:WP_MaximeterHistogramDetail","params":{"mapParams":{"startDate":"'+date_start+'","endDate":"'+date_end+'","id":"'+cups+'","sIdentificador":"'+self._identities['account_id']+'"}}}]}',
-        cmd = 'other.WP_MaximeterHistogram_CTRL.getHistogramPoints=1'
-        return self._safe_command (cmd, msg).get('data', None)
-    
+        return self._safe_action (self.maximeter_action(cups, date_start, date_end)).get('data', None)
+
     def reconnect_ICP(self, cups):
-        msg = '{"actions":[{"id":"261;a","descriptor":"apex://WP_ContadorICP_F2_CTRL/ACTION$reconectarICP","callingDescriptor":"markup://c:WP_Reconnect_Detail_F2","params":{"cupsId":"'+cups+'"}}]}',
-        cmd = 'other.WP_ContadorICP_F2_CTRL.reconectarICP=1'
-        self._safe_command (cmd, msg)
-        msg = '{"actions":[{"id":"287;a","descriptor":"apex://WP_ContadorICP_CTRL/ACTION$goToReconectarICP","callingDescriptor":"markup://c:WP_Reconnect_Modal","params":{"cupsId":"'+cups+'"}}]}',
-        cmd = 'other.WP_ContadorICP_CTRL.goToReconectarICP=1'
-        return self._safe_command (cmd, msg)
\ No newline at end of file
+        self._safe_action (self.reconnect_ICP_action(cups))
+        return self._safe_action (self.go_to_reconnect_ICP_action(cups))
+
+class EdsBatch():
+    """
+    Queues several aura actions and sends them within a single POST.
+
+    For instance:
+    >>> batch = eds.batch()
+    >>> batch.add('cycles', eds.cycle_list_action(cont))
+    >>> batch.add('maximeter', eds.maximeter_action(cups, '01/2021', '12/2021'))
+    >>> batch.send()['cycles']
+    Each returnValue is stored by key at batch.results, and each failure at batch.errors. The batch is scheduled
+    with the best priority of its actions, unless one is given (e.g. PRIORITY_REFRESH for a periodic refresh, so
+    an interactive action in it does not lift the whole POST)
+    """
+
+    def __init__(self, eds, priority=None):
+        self._eds = eds
+        self._priority = priority
+        self._actions = {}
+        self.results = {}
+        self.errors = {}
+
+    def add (self, key, action):
+        self._actions[key] = action
+        return self
+
+    def __contains__ (self, key):
+        return key in self._actions
+
+    def __len__ (self):
+        return len(self._actions)
+
+    def send (self):
+        actions = self._prepare()
+        if len(actions) == 0:
+            return self.results
+        try:
+            response = self._eds._batch_command(actions, self._priority)
+        except Exception as e:
+            response = e
+        return self._collect(response)
+
+    def _prepare (self):
+        # aura expects unique action ids within a message
+        self._keys = {}
+        actions = []
+        for key in self._actions:
+            cached = self._eds.cache.get(self._actions[key]) if self._eds.cache is not None else None
+            if cached is not None:
+                self.results[key] = cached
+                continue
+            action = dict(self._actions[key])
+            action['id'] = f'{len(actions) + 1};a'
+            self._keys[action['id']] = key
+            actions.append(action)
+        return actions
+
+    def _collect (self, response):
+        if isinstance(response, Exception):
+            for key in self._keys.values():
+                self.errors[key] = response
+            return self.results
+        for action in response:
+            key = self._keys.get(action.get('id', None), None)
+            if key is None:
+                continue
+            if action.get('state', None) == 'SUCCESS':
+                self.results[key] = action.get('returnValue', {})
+                if self._eds.cache is not None:
+                    self._eds.cache.put(self._actions[key], self.results[key])
+            else:
+                self.errors[key] = EdsConnector.EdsException (f'Error processing action: {self._actions[key]["descriptor"]} ({action.get("error", None)})')
+        for key in self._actions:
+            if key not in self.results and key not in self.errors:
+                self.errors[key] = EdsConnector.EdsException (f'No response for action: {self._actions[key]["descriptor"]}')
+        return self.results
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from .EdsCalendar import P1, P2, P3
+
+class EdsCostEngine():
+    """
+    Costs of many tariffs at once, from per-group aggregates (see EdsHourlySeries.aggregate), so the hourly
+    history is reduced once whatever the number of tariffs, and every tariff is a few array operations.
+
+    For instance:
+    >>> engine = EdsCostEngine([EdsTariff('pvpc'), flat])
+    >>> costs = engine.evaluate(series.aggregate(month_edges), {P1: 4.6, P2: 4.6})
+    >>> costs['total']  # (tariffs, groups)
+    """
+
+    def __init__(self, tariffs):
+        self.tariffs = list(tariffs)
+        self._pvpc = np.array([t.is_pvpc for t in self.tariffs])
+        self._energy = np.array([[np.nan] * 3 if t.is_pvpc else [t.energy[P1], t.energy[P2], t.energy[P3]] for t in self.tariffs], dtype=np.float64)
+        self._power = np.array([[t.power.get(P1, 0), t.power.get(P2, 0)] for t in self.tariffs], dtype=np.float64) / 365
+        self._fixed = np.array([t.fixed for t in self.tariffs], dtype=np.float64)
+
+    def _taxes(self, starts):
+        electricity_tax = np.array([[t.electricity_tax] for t in self.tariffs], dtype=np.float64).repeat(len(starts), axis=1)
+        iva = np.array([[t.iva] for t in self.tariffs], dtype=np.float64).repeat(len(starts), axis=1)
+        for ix, t in enumerate(self.tariffs):
+            for rule in t.rules:
+                inside = (starts >= np.datetime64(rule.first, 'D')) & (starts <= np.datetime64(rule.last, 'D'))
+                if rule.electricity_tax is not None:
+                    electricity_tax[ix, inside] = rule.electricity_tax
+                if rule.iva is not None:
+                    iva[ix, inside] = rule.iva
+        return electricity_tax, iva
+
+    def evaluate(self, groups, power_limits, days=None):
+        """
+        Cost terms by tariff and group, with the energy term also split by period, as (tariffs, groups[, 3]) arrays.
+        Groups are billed for days (by default, their hours with data / 24). PVPC energy terms are nan
+        unless the series had prices.
+        """
+        days = np.asarray(days if days is not None else groups['hours'] / 24, dtype=np.float64)
+        starts = np.array(groups['start'], dtype='datetime64[D]')
+        pvpc_cost = groups['cost'] if groups['cost'] is not None else np.full(groups['energy'].shape, np.nan)
+        energy = np.where(self._pvpc[:, None, None], pvpc_cost[None, :, :], groups['energy'][None, :, :] * self._energy[:, None, :])
+        power = (self._power @ np.array([power_limits[P1], power_limits[P2]], dtype=np.float64))[:, None] * days[None, :]
+        fixed = self._fixed[:, None] * days[None, :] / 30
+        electricity_tax, iva = self._taxes(starts)
+        total = ((energy.sum(axis=2) + power) * electricity_tax + fixed) * iva
+        return {'tariffs': [t.name for t in self.tariffs], 'start': groups['start'], 'end': groups['end'], 'days': days,
+            'energy': energy, 'power': power, 'fixed': fixed, 'total': total}
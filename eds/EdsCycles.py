@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from datetime import date, timedelta
+
+from .EdsCalendar import P1, P2, P3
+from .EdsSeries import EdsHourlySeries
+
+class EdsCycleAggregates():
+    """
+    Billing cycle aggregates (energy and PVPC-priced energy by period, and hours with a value), memoized and
+    persisted at the store by cycle start.
+
+    A closed cycle is aggregated again only until all its days are final (and priced). The ongoing one keeps
+    running sums up to its last final day (and last priced one, for its cost), so a refresh only reduces the days
+    after them:
+    >>> cycles = EdsCycleAggregates(store, cont_id)
+    >>> cycles.closed(date(2021, 5, 5), date(2021, 6, 4))
+    {1: 80.12, 2: 95.3, 3: 150.8, 'hours': 720, 'cost': {1: 12.1, 2: 11.7, 3: 14.3}}
+    >>> tail = EdsHourlySeries.from_points(store.load_hourly_points(cont_id, since=cycles.since(date(2021, 6, 4))))
+    >>> cycles.running(date(2021, 6, 4), tail)
+    """
+
+    def __init__(self, store, cont_id):
+        self._store = store
+        self._cont_id = cont_id
+        self._memo = store.load_cycle_aggregates(cont_id)
+
+    @staticmethod
+    def _window(energy, hours, cost):
+        return {P1: energy[0], P2: energy[1], P3: energy[2], 'hours': hours, 'cost': {P1: cost[0], P2: cost[1], P3: cost[2]} if cost is not None else None}
+
+    def _save(self, start, memo):
+        self._memo[start] = memo
+        self._store.save_cycle_aggregate(self._cont_id, start, memo)
+
+    def closed(self, start, end, priced=False):
+        """Aggregate of the closed cycle [start, end) (dates), with its cost only if priced"""
+        memo = self._memo.get(start, None)
+        if memo is None or not memo['final'] or (priced and not memo['priced']):
+            points = self._store.load_hourly_points(self._cont_id, since=start)
+            if len(points) == 0:
+                return None
+            series = EdsHourlySeries.from_points(points)
+            if priced:
+                series.set_prices(*self._store.load_prices(series.base, series.base + len(series) - 1))
+            aggregate = series.aggregate([start, end])
+            last = self._store.last_final_day(self._cont_id, start)
+            memo = {
+                'energy': aggregate['energy'][0].tolist(),
+                'hours': int(aggregate['hours'][0]),
+                'cost': aggregate['cost'][0].tolist() if priced else None,
+                'final': last is not None and last >= end - timedelta(days=1),
+                'priced': priced and len(self._store.missing_price_days(start, end - timedelta(days=1))) == 0,
+            }
+            self._save(start, memo)
+        return self._window(memo['energy'], memo['hours'], memo['cost'] if priced else None)
+
+    def _running(self, start):
+        memo = self._memo.get(start, None)
+        if memo is None or 'cursor' not in memo:
+            memo = {'energy': [0.0] * 3, 'hours': 0, 'cost': [0.0] * 3, 'cursor': start.isoformat(), 'cost_cursor': start.isoformat(), 'final': False, 'priced': False}
+        return memo
+
+    def since(self, start):
+        """First day the series given to running() must cover"""
+        memo = self._running(start)
+        return min(date.fromisoformat(memo['cursor']), date.fromisoformat(memo['cost_cursor']))
+
+    def running(self, start, series):
+        """Aggregate of the ongoing cycle since start (a date), with its cost if the series has prices"""
+        memo = self._running(start)
+        cursor = date.fromisoformat(memo['cursor'])
+        cost_cursor = date.fromisoformat(memo['cost_cursor'])
+        # only final days are summed for good, later ones may still change
+        last = self._store.last_final_day(self._cont_id, cursor)
+        upto = last + timedelta(days=1) if last is not None else cursor
+        aggregate = series.aggregate([cursor, upto, date.max])
+        memo['energy'] = [x + y for x, y in zip(memo['energy'], aggregate['energy'][0].tolist())]
+        memo['hours'] += int(aggregate['hours'][0])
+        memo['cursor'] = upto.isoformat()
+        energy = [x + y for x, y in zip(memo['energy'], aggregate['energy'][1].tolist())]
+        hours = memo['hours'] + int(aggregate['hours'][1])
+        cost = None
+        if series.prices is not None:
+            # and priced ones, prices may still arrive for the rest
+            missing = self._store.missing_price_days(cost_cursor, upto - timedelta(days=1)) if upto > cost_cursor else []
+            cost_upto = min(missing) if len(missing) > 0 else upto
+            aggregate = series.aggregate([cost_cursor, cost_upto, date.max])
+            memo['cost'] = [x + y for x, y in zip(memo['cost'], aggregate['cost'][0].tolist())]
+            memo['cost_cursor'] = cost_upto.isoformat()
+            cost = [x + y for x, y in zip(memo['cost'], aggregate['cost'][1].tolist())]
+        if upto != cursor or memo['cost_cursor'] != cost_cursor.isoformat() or start not in self._memo:
+            self._save(start, memo)
+            # the running sums of a previous cycle are no longer needed
+            for key in [k for k, m in self._memo.items() if 'cursor' in m and k < start]:
+                del self._memo[key]
+                self._store.delete_cycle_aggregate(self._cont_id, key)
+        return self._window(energy, hours, cost)
@@ -1,38 +1,36 @@
 import logging
 
 from .EdsConnector import EdsConnector
+from .EdsAsyncConnector import EdsAsyncConnector
+from .EdsStore import EdsStore, month_range
+from .EdsMaximeter import EdsPeakStats
+from .EdsBackfill import EdsBackfill, DEFAULT_CONCURRENCY
+from .EdsCalendar import P1, P2, P3
+from .EdsTariff import EdsTariff
+from .EdsRefresh import EdsRefreshQueue, EdsSingleFlight, SOURCES
+from .EdsMeter import EdsMeterPolicy, parse_meter, hourly_profile, estimate_today
+from .EdsParser import parse_hourly_points
+from .EdsScheduler import PRIORITY_REFRESH
 from datetime import datetime, timedelta
 #import calendar
-import pandas as pd
-import asyncio
-from aiopvpc import PVPCData, TARIFFS
-import pytz as tz
-import tzlocal
-
-LIST_P1 = ['10 - 11 h', '11 - 12 h', '12 - 13 h', '13 - 14 h', '18 - 19 h', '19 - 20 h', '20 - 21 h', '21 - 22 h']
-LIST_P2 = ['08 - 09 h', '09 - 10 h', '14 - 15 h', '15 - 16 h', '16 - 17 h', '17 - 18 h', '22 - 23 h', '23 - 24 h']
-LIST_P3 = ['00 - 01 h', '01 - 02 h', '02 - 03 h', '03 - 04 h', '04 - 05 h', '05 - 06 h','06 - 07 h', '07 - 08 h']
-
-DAYS_P3 = ['Saturday', 'Sunday']
-
-DEFAULT_PRICE_P1 = 30.67266 # €/kW/year
-DEFAULT_PRICE_P2 = 1.4243591 # €/kW/year
-DEFAULT_DAILY_PRICE_P1 = DEFAULT_PRICE_P1 / 365
-DEFAULT_DAILY_PRICE_P2 = DEFAULT_PRICE_P2 / 365
-DEFAULT_PRICE_CONT = 0.81 # €/month
-DEFAULT_PRICE_COMERC = 3.113 # €/kW/año
-DEFAULT_DAILY_PRICE_COMERC = DEFAULT_PRICE_COMERC / 365
-DEFAULT_TAX_ELECTR = 1.0511300560 # multiplicative
-DEFAULT_TAX_IVA = 1.21 # multiplicative
+import asyncio, math, time
+
+# the PVPC simulation of the cycle attributes, taxed at the flat rates as before the tax rules (simulate applies them)
+DEFAULT_TARIFF = EdsTariff('pvpc', rules=())
 
 DEFAULT_SHORT_INTERVAL = timedelta(minutes=30)
 DEFAULT_LONG_INTERVAL = timedelta(minutes=60)
+DEFAULT_STORAGE_DIR = '/tmp'
+# days of stored history indexed for window queries (see EdsIndex)
+DEFAULT_INDEX_DAYS = 400
 
 _LOGGER = logging.getLogger(__name__)
 logging.getLogger("aiopvpc").setLevel(logging.ERROR)
 
 class EdsHelper():
     _eds = None
+    _aeds = None
+    _store = None
     # raw data
     _username = None
     _password = None
@@ -42,266 +40,680 @@ class EdsHelper():
     _long_interval = None
     _cycles = None
 
-    _meter_yesterday = None
-
     _last_meter_update = None
     _last_cycles_update = None
     _last_energy_update = None
     _last_maximeter_update = None
     _last_pvpc_update = None
     _last_try = None
+    _queue = None
+    _flight = None
+    # live meter mode (see EdsMeter), None if disabled
+    _meter = None
+    _profile = None
 
-    _busy = False
     _should_reset_day = None
 
-    _pvpc_raw = None
     _cups_id = None
     _cont_id = None
 
-    # dataframes
-    _power_df = None
-    _energy_df = None
+    # hourly series (see EdsSeries)
+    _energy_series = None
+    _energy_index = None
+    _cycle_aggregates = None
+    _peaks = None
 
     # attributes
-    attributes = {}
+    attributes = None
 
-    _pvpc_raw = None
+    _cups = None
+    _account = None
     _pvpc_handler = None
+    _metrics = None
+
+    # published attributes, versioned (see subscribe)
+    version = 0
+    snapshot = None
+    _listeners = None
 
-    def __init__(self, user, password, cups=None, short_interval=None, long_interval=None):
-        self._eds = EdsConnector(user, password)
+    def __init__(self, user, password, cups=None, short_interval=None, long_interval=None, storage_dir=None, store=None, account=None, pvpc_source=None, meter_budget=None):
+        # connectors are shared by every helper of the same account
+        self._eds = EdsConnector.shared(user, password)
+        self._metrics = account.metrics if account is not None else self._eds.metrics
+        self._store = store if store is not None else EdsStore(storage_dir if storage_dir is not None else DEFAULT_STORAGE_DIR)
         self._username = user
         self._password = password
-        self._short_interval = DEFAULT_SHORT_INTERVAL
-        self._long_interval = DEFAULT_LONG_INTERVAL
+        self._cups = cups
+        self._account = account
+        self.attributes = {}
+        self.snapshot = {}
+        self._listeners = []
+        self._short_interval = short_interval if short_interval is not None else DEFAULT_SHORT_INTERVAL
+        self._long_interval = long_interval if long_interval is not None else DEFAULT_LONG_INTERVAL
         self._last_short_update = None
         self._last_long_update = None
-        self._loop = asyncio.get_event_loop()
-        self._pvpc_handler = PVPCData(tariff=TARIFFS[0], local_timezone='Europe/Madrid')
+        # the meter is only read if given a daily budget
+        self._meter = EdsMeterPolicy(meter_budget) if meter_budget is not None else None
+        self._queue = self._new_queue()
+        self._flight = EdsSingleFlight()
+        # anything with aiopvpc's async_download_prices_for_range (aiopvpc's own, by default)
+        self._pvpc_handler = pvpc_source
+
+    def _get_pvpc_handler (self):
+        # aiopvpc (and its holidays calendars) is only imported once prices are due
+        if self._pvpc_handler is None:
+            from aiopvpc import PVPCData, TARIFFS
+            self._pvpc_handler = PVPCData(tariff=TARIFFS[0], local_timezone='Europe/Madrid')
+        return self._pvpc_handler
 
     # To load CUPS into the helper
     def _set_cups (self, candidate=None):
         self._eds.login()
-        all_cups = self._eds.get_cups_list()
+        c = self._select_cups(self._eds.get_cups_list(), candidate)
+        if c is None:
+            return False
+        try:
+            # all ATR details are requested within a single POST
+            batch = self._eds.batch()
+            for attr_id in self._active_atrs(self._eds.get_cups_detail (self._cups_id)):
+                batch.add(attr_id, self._eds.atr_detail_action (attr_id))
+            self._set_power_limits(batch.send().values())
+        except Exception as e:
+            _LOGGER.warning (str(e) + f"; assuming {c.get('Power', None)} as P1 and P2 power limits")
+        return True
+
+    async def _async_set_cups (self, candidate=None):
+        await self._aeds.login()
+        all_cups = await self._account.async_cups_list() if self._account is not None else await self._aeds.get_cups_list()
+        c = self._select_cups(all_cups, candidate)
+        if c is None:
+            return False
+        try:
+            batch = self._aeds.batch()
+            for attr_id in self._active_atrs(await self._aeds.get_cups_detail (self._cups_id)):
+                batch.add(attr_id, self._aeds.atr_detail_action (attr_id))
+            self._set_power_limits((await batch.send()).values())
+        except Exception as e:
+            _LOGGER.warning (str(e) + f"; assuming {c.get('Power', None)} as P1 and P2 power limits")
+        return True
+
+    def _select_cups (self, all_cups, candidate):
         _LOGGER.debug ("CUPS:" + str(all_cups))
-        found = False
         for c in all_cups:
             if candidate is None or c.get('CUPS', None) == candidate:
                 self.attributes['cups'] = c.get('CUPS', None)
                 self._cups_id = c.get('CUPS_Id', None)
                 self._cont_id = c.get('Id', None)
+                self._peaks = None
+                self._cycle_aggregates = None
+                self._energy_index = None
+                self._queue = self._new_queue()
                 generic_power_limit = c.get('Power', None)
                 self.attributes['power_limit_p1'] = generic_power_limit
                 self.attributes['power_limit_p2'] = generic_power_limit
-                found = True
-                try:
-                    for atr in self._eds.get_cups_detail (self._cups_id).get('lstATR', None):
-                        if atr.get('Status', None) == 'EN VIGOR':
-                            attr_id = atr.get ('Id', None)
-                            attr = self._eds.get_atr_detail (attr_id)
-                            for item in attr:
-                                if 'title' in item:
-                                    if item['title'] == 'Potencia contratada 1 (kW)':
-                                        self.attributes['power_limit_p1'] = float(item['value'].replace(",", "."))
-                                    elif item['title'] == 'Potencia contratada 2 (kW)':
-                                        self.attributes['power_limit_p2'] = float(item['value'].replace(",", "."))
-                except Exception as e:
-                    _LOGGER.warning (e + f"; assuming {generic_power_limit} as P1 and P2 power limits")
-                    self.attributes['power_limit_p1'] = generic_power_limit
-                    self.attributes['power_limit_p2'] = generic_power_limit
-                break
-        else:
-            found = False
-        return found
-    
+                return c
+        return None
+
+    def _active_atrs (self, cups_detail):
+        return [atr.get('Id', None) for atr in cups_detail.get('lstATR', None) if atr.get('Status', None) == 'EN VIGOR']
+
+    def _set_power_limits (self, atr_details):
+        for res in atr_details:
+            for item in res.get('data', None):
+                if 'title' in item:
+                    if item['title'] == 'Potencia contratada 1 (kW)':
+                        self.attributes['power_limit_p1'] = float(item['value'].replace(",", "."))
+                    elif item['title'] == 'Potencia contratada 2 (kW)':
+                        self.attributes['power_limit_p2'] = float(item['value'].replace(",", "."))
+
+    def _new_queue (self):
+        # every source is due at once, failed ones are retried after the short interval (but the meter, see _settle)
+        sources = SOURCES + (('meter',) if self._meter is not None else ())
+        return EdsRefreshQueue({s: self._long_interval for s in sources}, retry=self._short_interval)
+
+    def _take_due (self):
+        due = self._queue.due()
+        if 'meter' in due and len(self._meter_calls()) >= self._meter.budget:
+            # the daily budget holds across restarts too
+            due.discard('meter')
+            self._queue.schedule('meter', self._next_meter_poll())
+        return due
+
+    def _meter_calls (self):
+        # every call of the day, failed ones included
+        return self._store.load_meter_readings(self._cups_id, datetime.combine(datetime.today().date(), datetime.min.time()))
+
+    def _next_meter_poll (self):
+        calls = self._meter_calls()
+        loads = [x[3] for x in calls if x[3] is not None]
+        return self._meter.next_poll(datetime.now(), len(calls), loads[-1] if len(loads) > 0 else None, loads[-2] if len(loads) > 1 else None)
+
+    @property
+    def next_refresh (self):
+        """When the next source gets due (sources being refreshed are left out)"""
+        return self._queue.next_due()
+
+    def _last_updates (self):
+        return {'cycles': self._last_cycles_update, 'maximeter': self._last_maximeter_update, 'energy': self._last_energy_update, 'pvpc': self._last_pvpc_update, 'meter': self._last_meter_update}
+
+    def _settle (self, due, before):
+        # sources that did not get updated are retried sooner
+        after = self._last_updates()
+        for source in due:
+            if source == 'meter':
+                # meter readings follow the daily budget, whatever the outcome
+                self._queue.schedule(source, self._next_meter_poll())
+            else:
+                self._queue.done(source, ok=after[source] is not None and after[source] != before[source])
+
+    def _should_switch (self, cups):
+        return self._cups_id is None or (cups is not None and self.attributes.get('cups', None) != cups)
+
     def update (self, cups=None):
-        if not self._busy:
-            self._busy = True
-            try:
-                # login in edistribucion
-                if self._cups_id is None or (self._cups_id != cups and cups is not None):
-                    self._set_cups(cups)
-                else:
+        """Refreshes every overdue source in one pass, concurrent callers wait for (and share) the refresh in flight"""
+        future, owner = self._flight.join()
+        if not owner:
+            return future.result()
+        try:
+            self._update(cups if cups is not None else self._cups)
+        except Exception as e:
+            _LOGGER.info (e)
+        finally:
+            if self._meter is not None:
+                self._estimate_meter()
+            self._publish()
+            self._flight.land(future, self.snapshot)
+        return self.snapshot
+
+    def _update (self, cups):
+        switch = self._should_switch(cups)
+        if switch:
+            # a new CUPS has every source due
+            with self._metrics.phase('login'):
+                self._set_cups(cups)
+        due = self._take_due()
+        if len(due) == 0:
+            return
+        before = self._last_updates()
+        try:
+            # pvpc alone needs no request to edistribucion
+            if not switch and due - set(['pvpc']):
+                with self._metrics.phase('login'):
                     self._eds.login()
-                # updating historical data and calculations
-                if self._last_try is None or (datetime.now() - self._last_try) > self._short_interval:
-                    if self._last_cycles_update is None or (datetime.now() - self._last_cycles_update) > self._long_interval:
-                        self._update_cycles ()
-                    if self._last_energy_update is None or (datetime.now() - self._last_energy_update) > self._long_interval:
-                        self._update_energy ()
-                        self.attributes['energy_last_update'] = self._last_energy_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_energy_update is not None else None
-                    if self._last_maximeter_update is None or (datetime.now() - self._last_maximeter_update) > self._long_interval:
-                        self._update_maximeter ()
-                        self.attributes['maximeter_last_update'] = self._last_maximeter_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_maximeter_update is not None else None
-                    if self._last_pvpc_update is None or (datetime.now() - self._last_pvpc_update) > self._long_interval:
-                        self._update_pvpc_prices ()
-                        self.attributes['pvpc_last_update'] = self._last_pvpc_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_pvpc_update is not None else None
-                    # Fetch meter data
-                    '''
-                    if self._last_meter_update is None or (datetime.now() - self._last_meter_update) > self._short_interval:
-                        self._update_meter ()
-                        self.attributes['meter_last_update'] = self._last_meter_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_meter_update is not None else None
-                    '''
-                    self._last_try = datetime.now()
-            except Exception as e:
-                _LOGGER.info (e)
-            self._busy = False
+            # cycles, maximeter and meter are independent, so they share a single POST (timed for all of them), at
+            # refresh priority even with the (otherwise interactive) meter read in it
+            batch = self._eds.batch(PRIORITY_REFRESH)
+            if 'cycles' in due:
+                batch.add('cycles', self._eds.cycle_list_action(self._cont_id))
+            if 'maximeter' in due:
+                months = self._maximeter_range()
+                batch.add('maximeter', self._eds.maximeter_action(self._cups_id, *months))
+            if 'meter' in due:
+                batch.add('meter', self._eds.meter_action(self._cups_id))
+            started = time.perf_counter()
+            batch.send()
+            shared = time.perf_counter() - started
+            if 'cycles' in batch:
+                with self._metrics.phase('cycles', shared):
+                    self._update_cycles (batch.results.get('cycles', {}).get('data', None))
+            if 'maximeter' in batch:
+                with self._metrics.phase('maximeter', shared):
+                    self._update_maximeter (batch.results.get('maximeter', {}).get('data', None), months)
+                self.attributes['maximeter_last_update'] = self._last_maximeter_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_maximeter_update is not None else None
+            if 'meter' in batch:
+                with self._metrics.phase('meter', shared):
+                    self._update_meter (batch.results.get('meter', {}).get('data', None))
+            # both energy windows depend on cycles, and share another POST
+            if 'energy' in due and self._cycles is not None:
+                with self._metrics.phase('energy'):
+                    batch = self._eds.batch()
+                    try:
+                        for key, (start, end) in self._energy_ranges().items():
+                            batch.add(key, self._eds.custom_curve_action(self._cont_id, start, end))
+                    except Exception as e:
+                        _LOGGER.info (e)
+                    batch.send()
+                    self._update_energy ([batch.results[x].get('data', None) for x in batch.results])
+                self.attributes['energy_last_update'] = self._last_energy_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_energy_update is not None else None
+            # costs follow the energy they are computed from
+            if 'pvpc' in due or 'energy' in due:
+                with self._metrics.phase('pvpc'):
+                    self._update_pvpc_prices ()
+                self.attributes['pvpc_last_update'] = self._last_pvpc_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_pvpc_update is not None else None
+            self._last_try = datetime.now()
+        finally:
+            self._settle(due, before)
 
     async def async_update (self, cups=None):
-        # update pvpc prices
-        if self._last_pvpc_update is None or (datetime.now().day - self._last_pvpc_update.day) > 0:
-            date = None
-            try:
-                date = datetime.strptime(self._cycles['lstCycles'][0]['label'].split(' - ')[0], '%d/%m/%Y').replace(hour=0,minute=0,second=0,microsecond=0)
-            except Exception as e:
-                pass
-            self._pvpc_raw = await self._pvpc_handler.async_download_prices_for_range(date if date is not None else (datetime.today() - timedelta(days=365)), datetime.today().replace(hour=23,minute=59,second=59,microsecond=59))
-        # update the sensor
-        self._loop.run_in_executor(None, self.update, cups)
+        """asyncio version of update, awaiting the refresh in flight (even if run by update, from another thread)"""
+        future, owner = self._flight.join()
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            await self._async_update(cups if cups is not None else self._cups)
+        except Exception as e:
+            _LOGGER.info (e)
+        finally:
+            if self._meter is not None:
+                await asyncio.to_thread(self._estimate_meter)
+            self._publish()
+            self._flight.land(future, self.snapshot)
+        return self.snapshot
+
+    async def _async_update (self, cups):
+        if self._aeds is None:
+            self._aeds = EdsAsyncConnector.shared(self._username, self._password)
+        switch = self._should_switch(cups)
+        if switch:
+            # a new CUPS has every source due
+            with self._metrics.phase('login'):
+                await self._async_set_cups(cups)
+        # the store (sqlite) and the series (numpy) are only touched in a worker thread, never on the event loop
+        due = await asyncio.to_thread(self._take_due)
+        if len(due) == 0:
+            return
+        before = self._last_updates()
+        try:
+            # pvpc alone needs no request to edistribucion
+            if not switch and due - set(['pvpc']):
+                with self._metrics.phase('login'):
+                    await self._aeds.login()
+            # cycles, maximeter and meter are independent, so they share a single POST, and the energy windows (of
+            # the known cycles, if any) another, both sent concurrently along with the PVPC download and timed apart;
+            # the first at refresh priority even with the (otherwise interactive) meter read in it
+            batch = self._aeds.batch(PRIORITY_REFRESH)
+            if 'cycles' in due:
+                batch.add('cycles', self._aeds.cycle_list_action(self._cont_id))
+            if 'maximeter' in due:
+                months = await asyncio.to_thread(self._maximeter_range)
+                batch.add('maximeter', self._aeds.maximeter_action(self._cups_id, *months))
+            if 'meter' in due:
+                batch.add('meter', self._aeds.meter_action(self._cups_id))
+            energy = self._aeds.batch()
+            label = self._cycles['lstCycles'][0]['label'] if self._cycles is not None else None
+            if 'energy' in due and label is not None:
+                for key, (start, end) in (await asyncio.to_thread(self._energy_ranges)).items():
+                    energy.add(key, self._aeds.custom_curve_action(self._cont_id, start, end))
+            tasks = {}
+            if len(batch) > 0:
+                tasks['batch'] = self._metrics.timed(batch.send())
+            if len(energy) > 0:
+                tasks['energy'] = self._metrics.timed(energy.send())
+            if 'pvpc' in due:
+                tasks['pvpc'] = self._metrics.timed(self._async_download_pvpc())
+            # fetch failures are recorded (once) by the phase of their source
+            elapsed = {}
+            failed = set()
+            for key, (result, seconds) in zip(tasks, await asyncio.gather(*tasks.values())):
+                elapsed[key] = seconds
+                if isinstance(result, Exception):
+                    _LOGGER.info (result)
+                    failed.add(key)
+            shared = elapsed.get('batch', 0)
+            if 'cycles' in batch:
+                with self._metrics.phase('cycles', shared):
+                    self._update_cycles (batch.results.get('cycles', {}).get('data', None))
+            if 'maximeter' in batch:
+                with self._metrics.phase('maximeter', shared):
+                    await asyncio.to_thread(self._update_maximeter, batch.results.get('maximeter', {}).get('data', None), months)
+                self.attributes['maximeter_last_update'] = self._last_maximeter_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_maximeter_update is not None else None
+            if 'meter' in batch:
+                with self._metrics.phase('meter', shared):
+                    await asyncio.to_thread(self._update_meter, batch.results.get('meter', {}).get('data', None))
+            if 'energy' in due:
+                with self._metrics.phase('energy', elapsed.get('energy', 0)):
+                    if self._cycles is not None and (len(energy) == 0 or self._cycles['lstCycles'][0]['label'] != label):
+                        # first run, or a new cycle has just started
+                        energy = self._aeds.batch()
+                        for key, (start, end) in (await asyncio.to_thread(self._energy_ranges)).items():
+                            energy.add(key, self._aeds.custom_curve_action(self._cont_id, start, end))
+                        await energy.send()
+                    await asyncio.to_thread(self._update_energy, [energy.results[x].get('data', None) for x in energy.results])
+                self.attributes['energy_last_update'] = self._last_energy_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_energy_update is not None else None
+            # costs follow the energy (and prices) they are computed from
+            if 'pvpc' in due or 'energy' in due:
+                with self._metrics.phase('pvpc', elapsed.get('pvpc', 0), failed='pvpc' in failed):
+                    await asyncio.to_thread(self._update_pvpc_prices)
+                self.attributes['pvpc_last_update'] = self._last_pvpc_update.strftime("%d-%m-%Y %H:%M:%S") if self._last_pvpc_update is not None else None
+            self._last_try = datetime.now()
+        finally:
+            await asyncio.to_thread(self._settle, due, before)
+
+    async def async_backfill (self, start, end=None, concurrency=DEFAULT_CONCURRENCY):
+        """Archives the hourly curve since start (a date) at the store, resuming any previous backfill"""
+        if self._aeds is None:
+            self._aeds = EdsAsyncConnector.shared(self._username, self._password)
+        if self._cont_id is None:
+            await self._async_set_cups(self._cups)
+        progress = await EdsBackfill(self._aeds, self._store, self._cont_id, start, end, concurrency).run()
+        # archived hours are indexed on the next energy update
+        self._energy_index = None
+        return progress
+
+    async def async_history (self, start, concurrency=DEFAULT_CONCURRENCY):
+        """Stores the history since start (a date) as daily and monthly totals, older than the hourly one (see EdsHistory)"""
+        from .EdsHistory import EdsHistory
+        if self._aeds is None:
+            self._aeds = EdsAsyncConnector.shared(self._username, self._password)
+        if self._cont_id is None:
+            await self._async_set_cups(self._cups)
+        # the days since the last cycle are already refreshed hourly
+        hourly_since = self._cycle_dates()[0].date() if self._cycles is not None else None
+        return await EdsHistory(self._aeds, self._store, self._cont_id, start, hourly_since=hourly_since, concurrency=concurrency).run()
+
+    def history (self, first, last=None, by='day'):
+        """Energy by period within [first, last] (dates), by day or month, from the finest resolution stored (see EdsHistory.query)"""
+        from .EdsHistory import EdsHistory
+        return EdsHistory(None, self._store, self._cont_id, first).query(first, last if last is not None else datetime.today().date(), by)
+
+    async def _async_download_pvpc (self):
+        date = None
+        try:
+            date = datetime.strptime(self._cycles['lstCycles'][0]['label'].split(' - ')[0], '%d/%m/%Y').replace(hour=0,minute=0,second=0,microsecond=0)
+        except Exception as e:
+            pass
+        start = (date if date is not None else (datetime.today() - timedelta(days=365))).date()
+        # only the days that are not cached yet are downloaded, grouped into contiguous ranges
+        ranges = []
+        for day in await asyncio.to_thread(self._store.missing_price_days, start, datetime.today().date()):
+            if len(ranges) > 0 and ranges[-1][1] + timedelta(days=1) == day:
+                ranges[-1][1] = day
+            else:
+                ranges.append([day, day])
+        for first, last in ranges:
+            prices = await self._get_pvpc_handler().async_download_prices_for_range(datetime.combine(first, datetime.min.time()), datetime.combine(last, datetime.max.time()))
+            if prices:
+                await asyncio.to_thread(self._store.save_prices, prices)
+        return len(ranges)
+
+    def _cycle_dates (self, cycle=None):
+        # the last cycle by default; a cycle starts the day after its label's
+        label = (cycle if cycle is not None else self._cycles['lstCycles'][0])['label']
+        d0 = datetime.strptime(label.split(' - ')[0], '%d/%m/%Y') + timedelta(days=1)
+        d1 = datetime.strptime(label.split(' - ')[1], '%d/%m/%Y')
+        d2 = d1 + timedelta(days=1)
+        d3 = datetime.today()
+        return d0, d1, d2, d3
+
+    def _energy_ranges (self):
+        d0, d1, d2, d3 = self._cycle_dates()
+        # final days are already stored, so only the most recent ones are requested
+        last = self._store.last_final_day(self._cont_id, d0.date())
+        if last is not None:
+            return {'recent': ((last + timedelta(days=1)).strftime("%Y-%m-%d"), d3.strftime("%Y-%m-%d"))}
+        return {'cycle_last': (d0.strftime("%Y-%m-%d"), d1.strftime("%Y-%m-%d")), 'cycle_current': (d2.strftime("%Y-%m-%d"), d3.strftime("%Y-%m-%d"))}
 
-    def _update_cycles (self):
+    def _maximeter_window (self):
+        return (datetime.today()-timedelta(days=395)).date().replace(day=1)
+
+    def _maximeter_range (self):
+        # closed months are stored for good, so only the open ones (usually just the current one) are requested
+        d1 = datetime.today().date()
+        d0 = self._store.first_open_month(self._cups_id, self._maximeter_window(), d1)
+        return (d0 if d0 is not None else d1).strftime("%m/%Y"), d1.strftime("%m/%Y")
+
+    def _update_cycles (self, cycles):
         try:
-            self._cycles = self._eds.get_cycle_list(self._cont_id)
-            self._last_cycles_update = datetime.now()
-            _LOGGER.debug ('cycles got updated!')
+            if cycles is not None:
+                self._cycles = cycles
+                self._last_cycles_update = datetime.now()
+                _LOGGER.debug ('cycles got updated!')
         except Exception as e:
             _LOGGER.info (e)
 
-    def _update_energy (self):
+    def _update_energy (self, curves):
         try:
-            d0 = datetime.strptime(self._cycles['lstCycles'][0]['label'].split(' - ')[0], '%d/%m/%Y') + timedelta(days=1)
-            d1 = datetime.strptime(self._cycles['lstCycles'][0]['label'].split(' - ')[1], '%d/%m/%Y')
-            d2 = d1 + timedelta(days=1)
-            d3 = datetime.today()
-            res0 = self._eds.get_custom_curve(self._cont_id, d0.strftime("%Y-%m-%d"), d1.strftime("%Y-%m-%d"))
-            res1 = self._eds.get_custom_curve(self._cont_id, d2.strftime("%Y-%m-%d"), d3.strftime("%Y-%m-%d"))
-            data = res0.get('mapHourlyPoints', {})
-            data1 = res1.get('mapHourlyPoints', {})
-            for day in data1:
-                data[day] = data1[day]
-            if data is not None and len(data) > 0:
-                good_data = []
-                for day in data:
-                    for idx in data[day]:
-                        item={}
-                        item['datetime'] = datetime.strptime(day + "_" + idx['hour'].split(" - ")[0], "%d-%m-%Y_%H")
-                        item['date'] = day
-                        for key in idx:
-                            item[key] = idx[key]
-                        good_data.append(item)
-            
-                df = pd.DataFrame (good_data)
-                df['datetime'] = pd.to_datetime(df['datetime'])
-                df['weekday'] = df['datetime'].dt.day_name()
-                self._energy_df = df
-
-                y_df = df.loc[(pd.to_datetime((d3 - timedelta(days=1))).floor('D') <= df['datetime']) & (df['datetime'] < pd.to_datetime(d3).floor('D'))]
-                self.attributes['energy_yesterday'] = round(y_df['value'].sum(), 2)
-                self.attributes['energy_yesterday_p1'] = round(y_df['value'].loc[(y_df['hour'].isin(LIST_P1)) & (~y_df['weekday'].isin(DAYS_P3))].sum(), 2)
-                self.attributes['energy_yesterday_p2'] = round(y_df['value'].loc[(y_df['hour'].isin(LIST_P2)) & (~y_df['weekday'].isin(DAYS_P3))].sum(), 2)
-                self.attributes['energy_yesterday_p3'] = round(self.attributes['energy_yesterday'] - self.attributes['energy_yesterday_p1'] - self.attributes['energy_yesterday_p2'], 2)
-
-                cc_df = df.loc[(pd.to_datetime(d2).floor('D') <= df['datetime'])]
-                self.attributes['cycle_current'] = round(cc_df['value'].sum(), 2)
-                self.attributes['cycle_current_days'] = int(cc_df['value'].count() / 24) - 1
+            d0, d1, d2, d3 = self._cycle_dates()
+            for res in curves:
+                if res is not None:
+                    self._store.save_hourly_points(self._cont_id, parse_hourly_points(res.get('mapHourlyPoints', {})))
+            # numpy is only imported along with the first curve
+            from .EdsSeries import EdsHourlySeries
+            from .EdsCycles import EdsCycleAggregates
+            if self._cycle_aggregates is None:
+                self._cycle_aggregates = EdsCycleAggregates(self._store, self._cont_id)
+            cycles = self._cycle_aggregates
+            yesterday = d3.date() - timedelta(days=1)
+            # only the days after the memoized sums are loaded (see EdsCycleAggregates)
+            points = self._store.load_hourly_points(self._cont_id, since=min(cycles.since(d2.date()), yesterday))
+            if len(points) > 0:
+                series = EdsHourlySeries.from_points(points)
+                self._energy_series = series
+                index = self._index(series)
+                if self._meter is not None:
+                    # what energy_today follows between meter readings
+                    self._profile = hourly_profile(series)
+
+                self._set_period_attributes('energy_yesterday', index.window(yesterday, d3.date()))
+
+                cc = cycles.running(d2.date(), series)
+                self._set_period_attributes('cycle_current', cc)
+                self.attributes['cycle_current_days'] = int(cc['hours'] / 24) - 1
                 self.attributes['cycle_current_daily'] = round(self.attributes['cycle_current'] / self.attributes['cycle_current_days'], 2)
-                self.attributes['cycle_current_p1'] = round(cc_df['value'].loc[(cc_df['hour'].isin(LIST_P1)) & (~cc_df['weekday'].isin(DAYS_P3))].sum(), 2)
-                self.attributes['cycle_current_p2'] = round(cc_df['value'].loc[(cc_df['hour'].isin(LIST_P2)) & (~cc_df['weekday'].isin(DAYS_P3))].sum(), 2)
-                self.attributes['cycle_current_p3'] = round(self.attributes['cycle_current'] - self.attributes['cycle_current_p1'] - self.attributes['cycle_current_p2'], 2)
 
-                cl_df = df.loc[(df['datetime'] < pd.to_datetime(d2).floor('D'))]
-                self.attributes['cycle_last'] = round(cl_df['value'].sum(), 2)
-                self.attributes['cycle_last_days'] = round(cl_df['value'].count() / 24)
+                cl = cycles.closed(d0.date(), d2.date())
+                self._set_period_attributes('cycle_last', cl)
+                self.attributes['cycle_last_days'] = round(cl['hours'] / 24)
                 self.attributes['cycle_last_daily'] = round(self.attributes['cycle_last'] / self.attributes['cycle_last_days'], 2)
-                self.attributes['cycle_last_p1'] = round(cl_df['value'].loc[(cl_df['hour'].isin(LIST_P1)) & (~cl_df['weekday'].isin(DAYS_P3))].sum(), 2)
-                self.attributes['cycle_last_p2'] = round(cl_df['value'].loc[(cl_df['hour'].isin(LIST_P2)) & (~cl_df['weekday'].isin(DAYS_P3))].sum(), 2)
-                self.attributes['cycle_last_p3'] = round(self.attributes['cycle_last'] - self.attributes['cycle_last_p1'] - self.attributes['cycle_last_p2'], 2)
-                
+
                 self._last_energy_update = datetime.now()
                 _LOGGER.debug ('energy got updated!')
         except Exception as e:
             _LOGGER.info (e)
     
-    def _update_maximeter (self):
+    def _set_period_attributes (self, key, window):
+        self.attributes[key] = round(window[P1] + window[P2] + window[P3], 2)
+        self.attributes[key + '_p1'] = round(window[P1], 2)
+        self.attributes[key + '_p2'] = round(window[P2], 2)
+        self.attributes[key + '_p3'] = round(self.attributes[key] - self.attributes[key + '_p1'] - self.attributes[key + '_p2'], 2)
+
+    def _update_maximeter (self, maximeter, months):
         try:
-            d0 = datetime.today()-timedelta(days=395)
-            d1 = datetime.today()
-            maximeter = self._eds.get_maximeter (self._cups_id, d0.strftime("%m/%Y"), d1.strftime("%m/%Y"))
             if maximeter is not None:
-                df =  pd.DataFrame([x for x in maximeter.get('lstData', None) if x['valid'] == True])
-                self._power_df = df
-                self.attributes['power_peak'] = round(df['value'].max(), 2)
-                idx_max = df['value'].idxmax()
-                self.attributes['power_peak_date'] = df.iloc[idx_max]['date'] + " " + df.iloc[idx_max]['hour']
-                self.attributes['power_peak_mean'] = round(df['value'].mean(), 2)
-                self.attributes['power_peak_tile99'] = round(df['value'].quantile(.99), 2)
-                self.attributes['power_peak_tile95'] = round(df['value'].quantile(.95), 2)
-                self.attributes['power_peak_tile90'] = round(df['value'].quantile(.90), 2)
+                first, last = [datetime.strptime(x, "%m/%Y").date() for x in months]
+                self._store.save_maximeter(self._cups_id, [x for x in maximeter.get('lstData', []) if x['valid'] == True], first, last)
+                window = self._maximeter_window()
+                if self._peaks is None:
+                    # every stored month is summarized once, afterwards only the fetched ones
+                    self._peaks = EdsPeakStats()
+                    first = window
+                stored = self._store.load_maximeter(self._cups_id, first, last)
+                for month in month_range(first, last):
+                    self._peaks.set_month(month, stored.get(month, []))
+                self._peaks.drop_before(window)
+                if len(self._peaks) > 0:
+                    value, date, hour = self._peaks.peak()
+                    self.attributes['power_peak'] = round(value, 2)
+                    self.attributes['power_peak_date'] = date.strftime("%d-%m-%Y") + " " + hour
+                    self.attributes['power_peak_mean'] = round(self._peaks.mean(), 2)
+                    self.attributes['power_peak_tile99'] = round(self._peaks.quantile(.99), 2)
+                    self.attributes['power_peak_tile95'] = round(self._peaks.quantile(.95), 2)
+                    self.attributes['power_peak_tile90'] = round(self._peaks.quantile(.90), 2)
                 self._last_maximeter_update = datetime.now()
                 _LOGGER.debug ('maximeter got updated!')
         except Exception as e:
             _LOGGER.info (e)
 
-    def _update_meter (self):
-        # fetching data
+    def _update_meter (self, meter):
+        now = datetime.now()
+        reading = (None, None, None, None)
         try:
-            meter = self._eds.get_meter(self._cups_id)
             if meter is not None:
-                self.attributes['energy_total'] = int(str(meter.get('totalizador', None)).replace(".", ""))
-                self.attributes['icp_status'] = meter.get('estadoICP', None)
-                self.attributes['power_load'] = float(meter.get('percent', None).replace("%","").replace(",", "."))
-                self.attributes['power'] = meter.get('potenciaActual', None)
-                self._last_meter_update = datetime.now()
+                reading = parse_meter(meter)
+                self._set_meter_attributes(now, *reading)
+                _LOGGER.debug ('meter got updated!')
         except Exception as e:
             _LOGGER.info (e)
-        
-        # today's calculus
+        # every call counts against the daily budget, even a failed one
+        self._store.save_meter_reading(self._cups_id, now, *reading)
+
+    def _set_meter_attributes (self, when, total, power, load, icp):
+        self.attributes['energy_total'] = total
+        self.attributes['icp_status'] = icp
+        self.attributes['power_load'] = load
+        self.attributes['power'] = power
+        self._last_meter_update = when
+        self.attributes['meter_last_update'] = when.strftime("%d-%m-%Y %H:%M:%S")
+
+    def _estimate_meter (self):
+        # energy_today between readings, from the hourly profile scaled to the last meter delta (see EdsMeter)
         try:
-            if 'energy_total' in self.attributes and self.attributes['energy_total'] is not None and (self._meter_yesterday is None or (datetime.now().day - self._last_try.day) > 0):
-                self._meter_yesterday = self.attributes['energy_total']                
-            if 'energy_total' in self.attributes and self.attributes['energy_total'] is not None and self._meter_yesterday is not None:
-                self.attributes['energy_today'] = self.attributes['energy_total'] - self._meter_yesterday
+            if self._cups_id is None:
+                return
+            now = datetime.now()
+            readings = [x for x in self._store.load_meter_readings(self._cups_id, now - timedelta(days=2)) if x[1] is not None]
+            if len(readings) == 0:
+                return
+            if self._last_meter_update is None:
+                # the last reading survives restarts
+                self._set_meter_attributes(*readings[-1])
+            energy, last = estimate_today([x[:2] for x in readings], self._profile if self._profile is not None else [None] * 24, now)
+            self.attributes['energy_today'] = round(energy, 2)
+            # minutes since the reading behind every meter value (and energy_today's estimate)
+            self.attributes['meter_age'] = int((now - last).total_seconds() // 60)
         except Exception as e:
             _LOGGER.info (e)
 
     def _update_pvpc_prices (self):
         try:
-            if self._pvpc_raw is not None and self._energy_df is not None:
-                timezone = str(tzlocal.get_localzone())
-                d0 = datetime.strptime(self._cycles['lstCycles'][0]['label'].split(' - ')[0], '%d/%m/%Y') + timedelta(days=1)
-                d1 = datetime.strptime(self._cycles['lstCycles'][0]['label'].split(' - ')[1], '%d/%m/%Y')
-                d2 = d1 + timedelta(days=1)
-                df = pd.DataFrame([{'date': x.astimezone(tz.timezone(timezone)).strftime("%d-%m-%Y"), 'hour': f"{x.astimezone(tz.timezone(timezone)).strftime('%H')} - {(x.astimezone(tz.timezone(timezone)).hour + 1):02d} h", 'price': self._pvpc_raw[x]} for x in self._pvpc_raw])
-                if 'price' in df.columns:
-                    if 'price' in self._energy_df.columns:
-                        self._energy_df.drop('price', axis=1)
-                    self._energy_df = self._energy_df.merge(df, how='left', left_on=['date', 'hour'], right_on=['date', 'hour'])
-                    self._energy_df['energy_price'] = self._energy_df['value'].ffill() * self._energy_df['price'].ffill()
-                    df = self._energy_df          
-                    
-                    # IVA fix
-                    if (d2 >= datetime(2021, 6, 26) and d2 <= (2021, 12, 31)):
-                        iva = 1.1
-                    else:
-                        iva = DEFAULT_TAX_IVA
-                    cc_df = df.loc[(pd.to_datetime(d2).floor('D') <= df['datetime'])]
-                    self.attributes['cycle_current_energy_term'] = round(cc_df['energy_price'].sum(), 2)
-                    self.attributes['cycle_current_power_term'] = round((self.attributes['power_limit_p1'] * (DEFAULT_DAILY_PRICE_P1 + DEFAULT_DAILY_PRICE_COMERC) + self.attributes['power_limit_p2'] * DEFAULT_DAILY_PRICE_P2) * self.attributes['cycle_current_days'], 2)
-                    self.attributes['cycle_current_pvpc'] = round(((self.attributes['cycle_current_energy_term'] + self.attributes['cycle_current_power_term']) * DEFAULT_TAX_ELECTR + (DEFAULT_PRICE_CONT * self.attributes['cycle_current_days'] / 30)) * DEFAULT_TAX_IVA, 2)
-                    
-                    # IVA fix
-                    if (d0 >= datetime(2021, 6, 26) and d0 <= (2021, 12, 31)):
-                        iva = 1.1
-                    else:
-                        iva = DEFAULT_TAX_IVA
-                    cl_df = df.loc[(df['datetime'] < pd.to_datetime(d2).floor('D'))]
-                    self.attributes['cycle_last_energy_term'] = round(cl_df['energy_price'].sum(), 2)
-                    self.attributes['cycle_last_power_term'] = round((self.attributes['power_limit_p1'] * (DEFAULT_DAILY_PRICE_P1 + DEFAULT_DAILY_PRICE_COMERC) + self.attributes['power_limit_p2'] * DEFAULT_DAILY_PRICE_P2) * self.attributes['cycle_last_days'], 2)
-                    self.attributes['cycle_last_pvpc'] = round(((self.attributes['cycle_last_energy_term'] + self.attributes['cycle_last_power_term']) * DEFAULT_TAX_ELECTR + (DEFAULT_PRICE_CONT * self.attributes['cycle_last_days'] / 30)) * iva, 2)
+            if self._energy_series is not None and self._cycle_aggregates is not None:
+                d0, d1, d2, d3 = self._cycle_dates()
+                series = self._energy_series
+                price_hours, price_values = self._store.load_prices(series.base, series.base + len(series) - 1)
+                if len(price_hours) > 0:
+                    series.set_prices(price_hours, price_values)
+                    self._index(series)
+                    import numpy as np
+                    from .EdsCost import EdsCostEngine
+                    cycles = self._cycle_aggregates
+                    windows = [cycles.closed(d0.date(), d2.date(), priced=True), cycles.running(d2.date(), series)]
+                    # both cycles at once, billed for the days of their attributes
+                    groups = {
+                        'start': [d0.date(), d2.date()],
+                        'end': [d2.date(), d3.date() + timedelta(days=1)],
+                        'energy': np.array([[w[P1], w[P2], w[P3]] for w in windows]),
+                        'cost': np.array([[w['cost'][P1], w['cost'][P2], w['cost'][P3]] for w in windows]),
+                        'hours': np.array([w['hours'] for w in windows]),
+                    }
+                    costs = EdsCostEngine([DEFAULT_TARIFF]).evaluate(groups, self._power_limits(), days=[self.attributes['cycle_last_days'], self.attributes['cycle_current_days']])
+                    for ix, key in enumerate(('cycle_last', 'cycle_current')):
+                        self.attributes[key + '_energy_term'] = round(float(costs['energy'][0, ix].sum()), 2)
+                        self.attributes[key + '_power_term'] = round(float(costs['power'][0, ix]), 2)
+                        self.attributes[key + '_pvpc'] = round(float(costs['total'][0, ix]), 2)
                     self._last_pvpc_update = datetime.now()
                     _LOGGER.debug ('prices got updated!')
         except Exception as e:
             _LOGGER.info (e)
 
+    def _index (self, series):
+        # built from the stored history (once, and again after a backfill), then extended with every refreshed tail
+        from .EdsIndex import EdsEnergyIndex
+        index = self._energy_index
+        if index is None:
+            index = EdsEnergyIndex()
+            index.extend(self._stored_series(datetime.today().date() - timedelta(days=DEFAULT_INDEX_DAYS)))
+            self._energy_index = index
+        index.extend(series)
+        return index
+
+    def _stored_series (self, since):
+        # the stored hourly series since a date, priced with the cached PVPC prices
+        from .EdsSeries import EdsHourlySeries
+        series = EdsHourlySeries.from_points(self._store.load_hourly_points(self._cont_id, since=since))
+        price_hours, price_values = self._store.load_prices(series.base, series.base + len(series) - 1)
+        if len(price_hours) > 0:
+            series.set_prices(price_hours, price_values)
+        return series
+
+    def window (self, start, end=None):
+        """
+        Energy by period within [start, end) (dates or local datetimes, end defaults to now), with its PVPC energy
+        cost by period and the hours with a value, in constant time (see EdsIndex):
+        {P1, P2, P3, 'hours', 'cost': {P1, P2, P3} or None}
+        Windows starting before the index (DEFAULT_INDEX_DAYS) are taken from the store instead, in time
+        proportional to their length.
+        """
+        index = self._energy_index
+        if index is None:
+            return None
+        if not index.covers(start):
+            from .EdsIndex import EdsEnergyIndex
+            index = EdsEnergyIndex()
+            index.extend(self._stored_series(start.date() if isinstance(start, datetime) else start))
+        return index.window(start, end if end is not None else datetime.now())
+
+    def _power_limits (self):
+        return {P1: self.attributes['power_limit_p1'], P2: self.attributes['power_limit_p2']}
+
+    def _cycle_edges (self):
+        # billing cycles, oldest first, plus the ongoing one, with the same boundaries as the cycle_* attributes
+        cycles = sorted([self._cycle_dates(c) for c in self._cycles['lstCycles']])
+        return [c[0].date() for c in cycles] + [cycles[-1][2].date(), datetime.today().date() + timedelta(days=1)]
+
+    def simulate (self, tariffs, by='cycle', since=None):
+        """
+        Costs of tariffs (see EdsTariff) over the whole stored history (or since a date), by billing cycle or by
+        month, computed in one pass: {tariff name: [{'start', 'end', 'days', 'energy_term_p1'..'_p3', 'energy_term',
+        'power_term', 'fixed_term', 'total'}]}, with the PVPC prices cached so far.
+        """
+        from .EdsSeries import EdsHourlySeries
+        from .EdsCost import EdsCostEngine
+        points = self._store.load_hourly_points(self._cont_id, since=since)
+        if len(points) == 0:
+            return {t.name: [] for t in tariffs}
+        series = EdsHourlySeries.from_points(points)
+        price_hours, price_values = self._store.load_prices(series.base, series.base + len(series) - 1)
+        if len(price_hours) > 0:
+            series.set_prices(price_hours, price_values)
+        if by == 'cycle':
+            edges = self._cycle_edges()
+        else:
+            months = list(month_range(series.first_day, datetime.today().date()))
+            edges = months + [(months[-1] + timedelta(days=32)).replace(day=1)]
+        costs = EdsCostEngine(tariffs).evaluate(series.aggregate(edges), self._power_limits())
+        result = {}
+        for t, name in enumerate(costs['tariffs']):
+            result[name] = []
+            for g in range(len(costs['start'])):
+                if costs['days'][g] == 0:
+                    continue
+                energy = costs['energy'][t, g]
+                result[name].append({
+                    'start': costs['start'][g],
+                    'end': costs['end'][g] - timedelta(days=1),
+                    'days': round(float(costs['days'][g]), 2),
+                    'energy_term_p1': round(float(energy[0]), 2),
+                    'energy_term_p2': round(float(energy[1]), 2),
+                    'energy_term_p3': round(float(energy[2]), 2),
+                    'energy_term': round(float(energy.sum()), 2),
+                    'power_term': round(float(costs['power'][t, g]), 2),
+                    'fixed_term': round(float(costs['fixed'][t, g]), 2),
+                    'total': round(float(costs['total'][t, g]), 2),
+                })
+        return result
+
+    def subscribe (self, listener):
+        """Calls listener(snapshot, changed) whenever an attribute changes, returns the unsubscribe function"""
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    @staticmethod
+    def _changed (old, new):
+        # nan != nan, but it is not a change
+        return old != new and not (isinstance(old, float) and isinstance(new, float) and math.isnan(old) and math.isnan(new))
+
+    def _publish (self):
+        changed = set([x for x in self.attributes if x not in self.snapshot or self._changed(self.snapshot[x], self.attributes[x])])
+        if len(changed) == 0:
+            return
+        # a new snapshot each version, so listeners can keep the one they got
+        self.snapshot = dict(self.attributes)
+        self.version += 1
+        for listener in list(self._listeners):
+            try:
+                listener(self.snapshot, changed)
+            except Exception as e:
+                _LOGGER.warning (e)
+
     def __str__ (self):
         return str(self.attributes)
\ No newline at end of file
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from .EdsCalendar import P1, P2, P3
+from .EdsStore import EdsStore, month_range
+from .EdsParser import parse_hourly_points
+from .EdsSeries import EdsHourlySeries
+from .EdsBackfill import DEFAULT_CONCURRENCY, fetch_window
+
+_LOGGER = logging.getLogger(__name__)
+
+# the most recent days are left hourly (the regular refresh, or EdsBackfill), the ones before them are kept as daily
+# totals and, from the month before those on, as monthly totals
+DEFAULT_HOURLY_DAYS = 62
+DEFAULT_DAILY_DAYS = 365
+
+# from the finest to the coarsest
+RESOLUTIONS = ('hour', 'day', 'month')
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+def reduce_curve(data, first, last, today):
+    """
+    Daily totals by period of a curve payload (mapHourlyPoints, as the week and month curves') within [first, last]
+    (dates), as {date: (p1, p2, p3, hours, final)}. Days without points are left out, so they are fetched again.
+    """
+    points = parse_hourly_points(data)
+    days = [x for x in points.days if first <= x[0] <= last]
+    totals = {}
+    if len(days) > 0:
+        series = EdsHourlySeries.from_points(points)
+        # days in between without points are just empty within the group of the previous one
+        aggregate = series.aggregate([x[0] for x in days] + [days[-1][0] + timedelta(days=1)])
+        for ix, (day, start, count) in enumerate(days):
+            energy = aggregate['energy'][ix]
+            final = EdsStore._is_final(day, points.quality[start:start + count], today)
+            totals[day] = (float(energy[0]), float(energy[1]), float(energy[2]), int(aggregate['hours'][ix]), final)
+    return totals
+
+class EdsHistory():
+    """
+    Multi-resolution history of a contract: the days since hourly_since are left hourly, the daily_days before them
+    (rounded to whole months) are fetched by week curves and stored as daily totals, and every month before those
+    by month curves, stored as monthly totals (a partial first month is fetched by weeks and kept by day). Only the
+    totals that are not final yet are fetched again:
+    >>> history = EdsHistory(aeds, store, cont_id, date(2018, 1, 1))
+    >>> await history.run()
+    {'windows': 83, 'skipped': 81, 'done': 2, 'failed': 0}
+
+    Queries take every day (or month) from the finest resolution stored:
+    >>> history.query(date(2020, 1, 1), date(2021, 6, 30), by='month')[0]
+    {'start': datetime.date(2020, 1, 1), 'source': 'month', 1: 80.12, 2: 95.3, 3: 150.8, 'hours': 744}
+    """
+
+    def __init__(self, eds, store, cont_id, start, today=None, hourly_since=None, hourly_days=DEFAULT_HOURLY_DAYS, daily_days=DEFAULT_DAILY_DAYS, concurrency=DEFAULT_CONCURRENCY):
+        self._eds = eds
+        self._store = store
+        self._cont_id = cont_id
+        self._start = start
+        self._today = today if today is not None else datetime.today().date()
+        # first day left hourly (e.g. the first one the helper refreshes), hourly_days ago by default
+        self._hourly = hourly_since if hourly_since is not None else self._today - timedelta(days=hourly_days)
+        self._daily = (self._hourly - timedelta(days=daily_days)).replace(day=1)
+        self._concurrency = concurrency
+        self.progress = None
+
+    def windows(self):
+        """Windows to fetch, as (resolution, first, last) dates, most recent first"""
+        # monthly totals are whole months only
+        windows = [('month', m, next_month(m) - timedelta(days=1)) for m in month_range(self._start, self._daily - timedelta(days=1)) if m >= self._start]
+        weeks = [(max(self._start, self._daily), self._hourly)]
+        if self._start < self._daily and self._start.day > 1:
+            weeks.append((self._start, next_month(self._start.replace(day=1))))
+        for lo, hi in weeks:
+            day = lo
+            while day < hi:
+                windows.append(('day', day, min(day + timedelta(days=6), hi - timedelta(days=1))))
+                day += timedelta(days=7)
+        return sorted(windows, key=lambda x: x[1], reverse=True)
+
+    @staticmethod
+    def _is_done(window, final):
+        resolution, first, last = window
+        # a month whose days are all final is not needed anymore either
+        if resolution == 'month' and first.replace(day=1) in final['month']:
+            return True
+        return all([first + timedelta(days=d) in final['day'] for d in range((last - first).days + 1)])
+
+    def _save(self, data, resolution, first, last):
+        days = reduce_curve(data.get('mapHourlyPoints', {}), first, last, self._today)
+        if resolution == 'day':
+            rows = [(d,) + days[d] for d in sorted(days)]
+        elif len(days) == 0:
+            rows = []
+        else:
+            total = tuple([sum([x[i] for x in days.values()]) for i in range(4)])
+            # closed months are final once all their days are there and final
+            complete = len(days) == (last - first).days + 1
+            rows = [(first.replace(day=1),) + total + (complete and all([x[4] for x in days.values()]),)]
+        self._store.save_totals(self._cont_id, resolution, rows)
+        return 'done'
+
+    def _window(self, semaphore, resolution, first, last):
+        action = self._eds.week_curve_action if resolution == 'day' else self._eds.month_curve_action
+        save = lambda data: self._save(data, resolution, first, last)
+        return fetch_window(self._eds, semaphore, action(self._cont_id, first.strftime("%Y-%m-%d")), save, self.progress, f'History window {first} - {last}')
+
+    async def run(self):
+        """Fetches every window that is not final yet, returns the progress counters"""
+        windows = self.windows()
+        final = {x: await asyncio.to_thread(self._store.final_totals, self._cont_id, x) for x in ('day', 'month')}
+        pending = [w for w in windows if not self._is_done(w, final)]
+        self.progress = {'windows': len(windows), 'skipped': len(windows) - len(pending), 'done': 0, 'failed': 0}
+        if len(pending) > 0:
+            await self._eds.login()
+            semaphore = asyncio.Semaphore(self._concurrency)
+            await asyncio.gather(*[self._window(semaphore, *w) for w in pending])
+        _LOGGER.debug (f'History finished: {self.progress}')
+        return self.progress
+
+    def _days(self, first, last):
+        # {date: (source, p1, p2, p3, hours)}, hourly points taking precedence over daily totals
+        days = {d: ('day',) + x for d, x in self._store.load_totals(self._cont_id, 'day', first, last).items()}
+        points = self._store.load_hourly_points(self._cont_id, since=first)
+        if len(points) > 0:
+            series = EdsHourlySeries.from_points(points)
+            lo = max(first, series.first_day)
+            hi = min(last, series.first_day + timedelta(days=len(series.day_starts) - 2))
+            edges = [lo + timedelta(days=d) for d in range((hi - lo).days + 2)]
+            if len(edges) > 1:
+                aggregate = series.aggregate(edges)
+                for ix, day in enumerate(edges[:-1]):
+                    if aggregate['hours'][ix] > 0:
+                        energy = aggregate['energy'][ix]
+                        days[day] = ('hour', float(energy[0]), float(energy[1]), float(energy[2]), int(aggregate['hours'][ix]))
+        return days
+
+    @staticmethod
+    def _bucket(start, source, p1, p2, p3, hours):
+        return {'start': start, 'source': source, P1: p1, P2: p2, P3: p3, 'hours': hours}
+
+    def query(self, first, last, by='day'):
+        """
+        Energy by period within [first, last] (dates), by 'day' or 'month', as [{'start', 'source', P1, P2, P3,
+        'hours'}]: source is the coarsest resolution a bucket was taken from, and monthly totals are whole months
+        """
+        days = self._days(first, last)
+        if by == 'day':
+            return [self._bucket(d, *days[d]) for d in sorted(days)]
+        by_month = {}
+        for d in sorted(days):
+            by_month.setdefault(d.replace(day=1), []).append(days[d])
+        months = self._store.load_totals(self._cont_id, 'month', first.replace(day=1), last)
+        buckets = []
+        for month in month_range(first, last):
+            inside = by_month.get(month, [])
+            covered = len(inside) == (min(last, next_month(month) - timedelta(days=1)) - max(first, month)).days + 1
+            if month in months and not covered:
+                buckets.append(self._bucket(month, 'month', *months[month]))
+            elif len(inside) > 0:
+                source = max([x[0] for x in inside], key=RESOLUTIONS.index)
+                buckets.append(self._bucket(max(first, month), source, *[sum([x[i] for x in inside]) for i in range(1, 5)]))
+        return buckets
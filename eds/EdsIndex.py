@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import numpy as np
+
+from .EdsParser import TIMEZONE, day_epoch_hour
+from .EdsCalendar import P1, P2, P3
+
+class EdsEnergyIndex():
+    """
+    Prefix sums of hourly series (see EdsSeries) by period: energy, priced energy and hours with a value (or a
+    price) up to every hour, so any [start, end) window takes constant time, whatever its length.
+
+    Every series given extends the index from its first hour on (the hours indexed from there are replaced, as the
+    last days may still change), in time proportional to the new hours:
+    >>> index = EdsEnergyIndex()
+    >>> index.extend(EdsHourlySeries.from_points(store.load_hourly_points(cont_id, since=date(2020, 6, 1))))
+    >>> index.extend(tail)
+    >>> index.window(date(2021, 6, 1), date(2021, 6, 8))
+    {1: 20.1, 2: 22.3, 3: 37.5, 'hours': 168, 'cost': {1: 3.1, 2: 2.2, 3: 2.5}}
+    """
+
+    def __init__(self, capacity=24 * 32):
+        self.base = None
+        self._length = 0
+        # row i sums the hours [0, i)
+        self._energy = np.zeros((capacity + 1, 3))
+        self._cost = np.zeros((capacity + 1, 3))
+        self._hours = np.zeros(capacity + 1, dtype=np.int64)
+        self._priced = np.zeros(capacity + 1, dtype=np.int64)
+
+    def __len__(self):
+        return self._length
+
+    def _reserve(self, length):
+        # capacity doubles, so extending is amortized to the new hours
+        if length + 1 <= len(self._hours):
+            return
+        capacity = max(length + 1, 2 * len(self._hours))
+        for name in ('_energy', '_cost', '_hours', '_priced'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._length + 1] = old[:self._length + 1]
+            setattr(self, name, new)
+
+    def extend(self, series):
+        """Indexes a series, replacing the hours indexed from its first one on"""
+        if self.base is None or series.base < self.base:
+            self.base = series.base
+            self._length = 0
+        offset = series.base - self.base
+        length = offset + len(series)
+        self._reserve(length)
+        keep = min(offset, self._length)
+        # hours between the index and the series (if any) are left empty
+        for a in (self._energy, self._cost, self._hours, self._priced):
+            a[keep + 1:offset + 1] = a[keep]
+        n = len(series)
+        valid = ~np.isnan(series.values) & (series.periods >= P1)
+        energy = np.zeros((n, 3))
+        energy[valid, series.periods[valid] - P1] = series.values[valid]
+        cost = np.zeros((n, 3))
+        priced = np.zeros(n, dtype=np.int64)
+        if series.prices is not None:
+            # as EdsHourlySeries.energy_cost, gaps filled with the previous value and price
+            present, values = series._priced()
+            inside = ~np.isnan(values) & (series.periods[present] >= P1)
+            cost[present[inside], series.periods[present[inside]] - P1] = values[inside]
+            priced[present[inside]] = 1
+        s = slice(offset + 1, length + 1)
+        self._energy[s] = self._energy[offset] + np.cumsum(energy, axis=0)
+        self._cost[s] = self._cost[offset] + np.cumsum(cost, axis=0)
+        self._hours[s] = self._hours[offset] + np.cumsum(valid)
+        self._priced[s] = self._priced[offset] + np.cumsum(priced)
+        self._length = length
+
+    @staticmethod
+    def _hour(x):
+        # dates start at their local midnight, (naive, local) datetimes at their hour
+        if isinstance(x, datetime):
+            return int((x if x.tzinfo is not None else x.replace(tzinfo=TIMEZONE)).timestamp()) // 3600
+        return day_epoch_hour(x)
+
+    def _offset(self, x):
+        return min(max(self._hour(x) - self.base, 0), self._length)
+
+    def covers(self, start):
+        """Whether the index starts by start (a date or datetime), as window() counts the hours before it as empty"""
+        return self.base is not None and self._hour(start) >= self.base
+
+    def window(self, start, end):
+        """
+        Energy and priced energy by period within [start, end) (dates or datetimes), and hours with a value; cost
+        is None without any price. Hours out of the index are clipped (see covers).
+        """
+        if self.base is None:
+            return {P1: 0.0, P2: 0.0, P3: 0.0, 'hours': 0, 'cost': None}
+        s, e = self._offset(start), self._offset(end)
+        e = max(s, e)
+        energy = self._energy[e] - self._energy[s]
+        cost = self._cost[e] - self._cost[s]
+        return {
+            P1: float(energy[0]), P2: float(energy[1]), P3: float(energy[2]),
+            'hours': int(self._hours[e] - self._hours[s]),
+            'cost': {P1: float(cost[0]), P2: float(cost[1]), P3: float(cost[2])} if self._priced[e] > self._priced[s] else None,
+        }
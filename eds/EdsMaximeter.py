@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from bisect import insort
+from heapq import merge
+import math
+
+class EdsPeakStats():
+    """
+    Maximeter statistics merged from per-month summaries, so a refresh only summarizes the months it fetched.
+
+    For instance:
+    >>> stats = EdsPeakStats()
+    >>> stats.set_month(date(2021, 5, 1), [(date(2021, 5, 12), '20:15', 3.2)])
+    >>> stats.set_month(date(2021, 6, 1), [(date(2021, 6, 3), '21:00', 4.1), (date(2021, 6, 20), '14:30', 2.9)])
+    >>> stats.peak()
+    (4.1, datetime.date(2021, 6, 3), '21:00')
+    >>> stats.quantile(.5)
+    3.2
+    """
+
+    def __init__(self):
+        self._months = {}
+
+    def set_month(self, month, points):
+        """Replaces the summary of a month (a date) with its points, as (date, hour, value)"""
+        if len(points) == 0:
+            self._months.pop(month, None)
+            return
+        values = []
+        for p in points:
+            insort(values, p[2])
+        peak = max(points, key=lambda p: p[2])
+        self._months[month] = {'count': len(values), 'sum': math.fsum(values), 'peak': peak, 'values': values}
+
+    def drop_before(self, month):
+        for m in [x for x in self._months if x < month]:
+            del self._months[m]
+
+    def __len__(self):
+        return sum([x['count'] for x in self._months.values()])
+
+    def peak(self):
+        """(value, date, hour) of the highest peak"""
+        return max([(x['peak'][2], x['peak'][0], x['peak'][1]) for x in self._months.values()], key=lambda p: p[0])
+
+    def mean(self):
+        return math.fsum([x['sum'] for x in self._months.values()]) / len(self)
+
+    def quantile(self, q):
+        """Linear interpolation between closest ranks (as pandas does)"""
+        values = list(merge(*[x['values'] for x in self._months.values()]))
+        pos = q * (len(values) - 1)
+        lo = math.floor(pos)
+        hi = min(lo + 1, len(values) - 1)
+        return values[lo] + (values[hi] - values[lo]) * (pos - lo)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+
+# meter readings (consultarContador) per local day, polling it freely gets accounts banned
+DEFAULT_METER_BUDGET = 6
+DEFAULT_METER_MIN_INTERVAL = timedelta(minutes=20)
+
+# readings come sooner under high load (%) or a load change (points) since the previous one, and later at night
+HIGH_LOAD = 50
+LOAD_CHANGE = 25
+NIGHT_HOURS = range(0, 7)
+
+# how far the last meter delta may scale the hourly profile, and the least energy (kWh, the meter counts whole ones)
+# the profile must expect over that delta
+MIN_SCALE = 0.25
+MAX_SCALE = 4
+MIN_DELTA_ENERGY = 2
+
+def parse_meter(meter):
+    """(total kWh, power kW, load %, ICP status) of a consultarContador answer"""
+    total = int(str(meter.get('totalizador', None)).replace(".", ""))
+    load = meter.get('percent', None)
+    return total, meter.get('potenciaActual', None), float(load.replace("%", "").replace(",", ".")) if load is not None else None, meter.get('estadoICP', None)
+
+class EdsMeterPolicy():
+    """
+    When to read the meter next, within a daily budget: the readings left are spread over the rest of the day,
+    twice as often under high (or changing) load and half as often at night. The first reading of a day is taken
+    right after midnight, so energy_today has a baseline.
+
+    For instance:
+    >>> policy = EdsMeterPolicy(budget=6)
+    >>> policy.next_poll(datetime(2021, 6, 1, 12, 0), used=3, load=65.0, previous_load=20.0)
+    datetime.datetime(2021, 6, 1, 14, 0)
+    """
+
+    def __init__(self, budget=DEFAULT_METER_BUDGET, min_interval=DEFAULT_METER_MIN_INTERVAL):
+        self.budget = budget
+        self.min_interval = min_interval
+
+    def next_poll(self, now, used, load=None, previous_load=None):
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        left = self.budget - used
+        if left <= 0:
+            return midnight
+        interval = (midnight - now) / left
+        if load is not None and (load >= HIGH_LOAD or (previous_load is not None and abs(load - previous_load) >= LOAD_CHANGE)):
+            interval /= 2
+        if now.hour in NIGHT_HOURS:
+            interval *= 2
+        return now + min(max(interval, self.min_interval), midnight - now)
+
+def hourly_profile(series, days=7):
+    """Mean energy (kWh) by hour of the day over the last complete days of a series (see EdsSeries), 24 values"""
+    sums = [0.0] * 24
+    counts = [0] * 24
+    # the last offset closes the last (maybe partial) day of the series
+    starts = [int(x) for x in series.day_starts]
+    for ix in range(max(1 if starts[0] < 0 else 0, len(starts) - 2 - days), len(starts) - 2):
+        values = series.values[starts[ix]:starts[ix + 1]]
+        for h in range(min(24, len(values))):
+            if values[h] == values[h]:
+                sums[h] += float(values[h])
+                counts[h] += 1
+    return [sums[h] / counts[h] if counts[h] > 0 else None for h in range(24)]
+
+def profile_energy(profile, start, end):
+    """Energy within [start, end) (local datetimes) following an hourly profile"""
+    known = [x for x in profile if x is not None]
+    fallback = sum(known) / len(known) if len(known) > 0 else 0.0
+    energy = 0.0
+    t = start
+    while t < end:
+        following = min(end, t.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1))
+        energy += (profile[t.hour] if profile[t.hour] is not None else fallback) * (following - t).total_seconds() / 3600
+        t = following
+    return energy
+
+def estimate_today(readings, profile, now):
+    """
+    Energy consumed today up to now, from the meter readings ((local datetime, total kWh), oldest first, today's
+    and the last one before) and an hourly profile scaled to the last meter delta, as (kWh, last real reading's
+    time). None if there are no readings at all.
+    """
+    if len(readings) == 0:
+        return None
+    midnight = datetime.combine(now.date(), datetime.min.time())
+    # the last delta between readings tells how far the profile is from the actual load
+    scale = 1.0
+    t1, e1 = readings[-1]
+    for t0, e0 in reversed(readings[:-1]):
+        expected = profile_energy(profile, t0, t1)
+        if expected >= MIN_DELTA_ENERGY:
+            scale = min(MAX_SCALE, max(MIN_SCALE, (e1 - e0) / expected))
+            break
+    before = [x for x in readings if x[0] < midnight]
+    today = [x for x in readings if x[0] >= midnight]
+    # the meter total at midnight, interpolated between the readings around it (following the profile)
+    if len(before) > 0 and len(today) > 0:
+        (t0, e0), (t1, e1) = before[-1], today[0]
+        expected = profile_energy(profile, t0, t1)
+        baseline = e0 + (e1 - e0) * (profile_energy(profile, t0, midnight) / expected if expected > 0 else (midnight - t0) / (t1 - t0))
+    elif len(before) > 0:
+        baseline = before[-1][1] + profile_energy(profile, before[-1][0], midnight) * scale
+    else:
+        baseline = today[0][1] - profile_energy(profile, midnight, today[0][0]) * scale
+    last, total = readings[-1]
+    return max(0.0, total + profile_energy(profile, last, now) * scale - baseline), last
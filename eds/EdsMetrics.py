@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os, tempfile, threading, time
+from contextlib import contextmanager
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# histogram upper bounds (seconds)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROMETHEUS_PREFIX = 'edistribucion'
+
+class Histogram():
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        ix = 0
+        while ix < len(self.buckets) and value > self.buckets[ix]:
+            ix += 1
+        self.counts[ix] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count > 0 else None,
+            'buckets': {str(b): c for b, c in zip(list(self.buckets) + ['+Inf'], self.counts)},
+        }
+
+    def prometheus(self, name, labels):
+        lines = []
+        cumulative = 0
+        for b, c in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += c
+            lines.append(f'{name}_bucket{{{labels},le="{b}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class EdsMetrics():
+    """
+    Instrumentation shared by every connector and helper: counters and latency histograms by aura
+    descriptor (calls, failures, redirects, response bytes, parse time), timings by update phase, and
+    connection reuse by host.
+
+    For instance:
+    >>> metrics = EdsMetrics.default()
+    >>> with metrics.phase('cycles'):
+    ...     helper._update_cycles(eds.get_cycle_list(cont))
+    >>> cycles, seconds = await metrics.timed(aeds.get_cycle_list(cont))
+    >>> with metrics.phase('cycles', seconds, failed=isinstance(cycles, Exception)):
+    ...     helper._update_cycles(cycles if not isinstance(cycles, Exception) else None)
+    >>> metrics.snapshot()['commands']['WP_Measure_v3_CTRL.getInfo']['calls']
+    2
+    >>> print(metrics.prometheus())
+    """
+    _default = None
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def reset(self):
+        with self._lock:
+            self._commands = {}
+            self._phases = {}
+            self._connections = {}
+
+    def _command(self, descriptor):
+        if descriptor not in self._commands:
+            self._commands[descriptor] = {'calls': 0, 'failures': 0, 'redirects': 0, 'bytes': 0, 'latency': Histogram(self._buckets), 'parse': Histogram(self._buckets)}
+        return self._commands[descriptor]
+
+    def command(self, descriptor, latency=None, size=0, parse=None, failed=False, redirected=False):
+        """Records an aura action (a batch shares its latency, and splits its size and parse time)"""
+        with self._lock:
+            c = self._command(descriptor)
+            c['calls'] += 1
+            c['failures'] += 1 if failed else 0
+            c['redirects'] += 1 if redirected else 0
+            c['bytes'] += size
+            if latency is not None:
+                c['latency'].observe(latency)
+            if parse is not None:
+                c['parse'].observe(parse)
+
+    def connection(self, transport, host, requests=0, opened=0):
+        """Records requests sent to host, and the connections opened for them (any other request reused one)"""
+        with self._lock:
+            c = self._connections.setdefault((transport, host), {'requests': 0, 'opened': 0})
+            c['requests'] += requests
+            c['opened'] += opened
+
+    def observe_phase(self, name, seconds, failed=False):
+        with self._lock:
+            if name not in self._phases:
+                self._phases[name] = {'failures': 0, 'duration': Histogram(self._buckets)}
+            self._phases[name]['duration'].observe(seconds)
+            self._phases[name]['failures'] += 1 if failed else 0
+
+    @contextmanager
+    def phase(self, name, extra=0, failed=False):
+        """
+        Times the enclosed block as an update phase (e.g. 'login', 'energy'), plus extra seconds spent elsewhere
+        (e.g. by timed), failed if the block raises or failed is given
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.observe_phase(name, time.perf_counter() - started + extra, failed)
+
+    async def timed(self, awaitable):
+        """
+        Awaits awaitable, returning (result or the exception raised, seconds) and recording nothing: concurrent
+        fetches are timed apart, and given to a single phase() afterwards
+        """
+        started = time.perf_counter()
+        try:
+            result = await awaitable
+        except Exception as e:
+            result = e
+        return result, time.perf_counter() - started
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'commands': {d: {
+                    'calls': c['calls'],
+                    'failures': c['failures'],
+                    'redirects': c['redirects'],
+                    'bytes': c['bytes'],
+                    'latency': c['latency'].snapshot(),
+                    'parse': c['parse'].snapshot(),
+                } for d, c in self._commands.items()},
+                'phases': {p: {
+                    'failures': x['failures'],
+                    'duration': x['duration'].snapshot(),
+                } for p, x in self._phases.items()},
+                'connections': {f'{t} {h}': {
+                    'requests': c['requests'],
+                    'opened': c['opened'],
+                    'reused': max(c['requests'] - c['opened'], 0),
+                } for (t, h), c in self._connections.items()},
+            }
+
+    def prometheus(self):
+        """Every metric, in Prometheus text exposition format"""
+        p = PROMETHEUS_PREFIX
+        lines = []
+        with self._lock:
+            for key, help in (('calls', 'Aura actions sent'), ('failures', 'Aura actions not succeeded'), ('redirects', 'Aura actions answered with a redirection to login'), ('bytes', 'Response bytes (split among the actions of a batch)')):
+                lines.append(f'# HELP {p}_command_{key}_total {help}')
+                lines.append(f'# TYPE {p}_command_{key}_total counter')
+                lines += [f'{p}_command_{key}_total{{descriptor="{d}"}} {c[key]}' for d, c in self._commands.items()]
+            for key, help in (('latency', 'Aura request latency'), ('parse', 'Aura response parse time (split among the actions of a batch)')):
+                lines.append(f'# HELP {p}_command_{key}_seconds {help}')
+                lines.append(f'# TYPE {p}_command_{key}_seconds histogram')
+                for d, c in self._commands.items():
+                    lines += c[key].prometheus(f'{p}_command_{key}_seconds', f'descriptor="{d}"')
+            lines.append(f'# HELP {p}_phase_seconds Update phase duration')
+            lines.append(f'# TYPE {p}_phase_seconds histogram')
+            for name, x in self._phases.items():
+                lines += x['duration'].prometheus(f'{p}_phase_seconds', f'phase="{name}"')
+            lines.append(f'# HELP {p}_phase_failures_total Update phases that raised')
+            lines.append(f'# TYPE {p}_phase_failures_total counter')
+            lines += [f'{p}_phase_failures_total{{phase="{name}"}} {x["failures"]}' for name, x in self._phases.items()]
+            for key, help in (('requests', 'HTTP requests sent'), ('opened', 'HTTP connections opened (the rest of the requests reused a pooled one)')):
+                lines.append(f'# HELP {p}_http_{key}_total {help}')
+                lines.append(f'# TYPE {p}_http_{key}_total counter')
+                lines += [f'{p}_http_{key}_total{{transport="{t}",host="{h}"}} {c[key]}' for (t, h), c in self._connections.items()]
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Writes prometheus() to path (e.g. for node_exporter's textfile collector)"""
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(tmp, path)
+        except Exception as e:
+            _LOGGER.info (e)
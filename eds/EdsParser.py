@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from array import array
+from datetime import datetime, date, timedelta
+import logging
+from zoneinfo import ZoneInfo
+
+_LOGGER = logging.getLogger(__name__)
+
+TIMEZONE = ZoneInfo('Europe/Madrid')
+
+# quality flags
+QUALITY_REAL = 0
+QUALITY_ESTIMATED = 1
+QUALITY_MISSING = 2
+
+def day_epoch_hour(day, tz=TIMEZONE):
+    """Hours since epoch (UTC) at the local midnight of a given date"""
+    return int(datetime(day.year, day.month, day.day, tzinfo=tz).timestamp()) // 3600
+
+def day_hours(day, tz=TIMEZONE):
+    """Hours in a local day: 23 or 25 on DST changes, 24 otherwise"""
+    return day_epoch_hour(day + timedelta(days=1), tz) - day_epoch_hour(day, tz)
+
+class EdsHourlyPoints():
+    """
+    Typed columns of hourly points: UTC epoch-hour (int64), value (float) and quality flag (uint8).
+
+    Days are kept as (date, first index, number of points), sorted by time.
+    """
+
+    def __init__(self, hours=None, values=None, quality=None, days=None):
+        self.hours = hours if hours is not None else array('q')
+        self.values = values if values is not None else array('d')
+        self.quality = quality if quality is not None else array('B')
+        self.days = days if days is not None else []
+
+    def __len__(self):
+        return len(self.hours)
+
+    def day_slice(self, ix):
+        day, first, count = self.days[ix]
+        return slice(first, first + count)
+
+def _hour_offset(item, day, base, seen, tz):
+    # hourCCH counts the hours of the day from 1 (up to 23 or 25 on DST days), so it is the offset itself
+    ordinal = item.get('hourCCH', None)
+    if ordinal is not None:
+        return int(ordinal) - 1
+    label = item.get('hour', None)
+    if label is None:
+        return None
+    # otherwise the local hour it starts at ('HH - HH h' or 'HH:MM - HH:MM'), the second time it is seen falling
+    # in the repeated hour of the 25 hours day
+    hour = int(label.strip()[0:2])
+    fold = 1 if hour in seen else 0
+    seen.add(hour)
+    return int(datetime(day.year, day.month, day.day, hour, fold=fold, tzinfo=tz).timestamp()) // 3600 - base
+
+def parse_hourly_points(data, tz=TIMEZONE):
+    """
+    Parses a mapHourlyPoints payload ({'dd-mm-YYYY': [points]}) in a single pass.
+
+    Timestamps are computed arithmetically: UTC epoch-hour of the local midnight (once per day) plus the offset
+    of the point within the day, taken from its hourCCH (or its 'hour' label), so DST days (23 or 25 hours) are
+    handled as well. Points are sorted within their day, and those out of it or repeated are dropped.
+    >>> parse_hourly_points({'01-06-2021': [{'hour': '00 - 01 h', 'hourCCH': 1, 'value': 0.2}]}).hours
+    array('q', [450694])
+    """
+    points = EdsHourlyPoints()
+    days = []
+    for key in data:
+        day = date(int(key[6:10]), int(key[3:5]), int(key[0:2]))
+        days.append((day_epoch_hour(day, tz), day, data[key]))
+    days.sort(key=lambda x: x[0])
+    hours = points.hours
+    values = points.values
+    quality = points.quality
+    for base, day, items in days:
+        length = day_hours(day, tz)
+        by_offset = {}
+        seen = set()
+        for ix, item in enumerate(items):
+            offset = _hour_offset(item, day, base, seen, tz)
+            # neither hourCCH nor a label, the position within the day
+            offset = offset if offset is not None else ix
+            if not 0 <= offset < length:
+                _LOGGER.debug (f'Point out of {day} ({length} hours) dropped: {item}')
+                continue
+            by_offset[offset] = item
+        points.days.append((day, len(hours), len(by_offset)))
+        for offset in sorted(by_offset):
+            item = by_offset[offset]
+            hours.append(base + offset)
+            value = item.get('value', None)
+            if value is None:
+                values.append(float('nan'))
+                quality.append(QUALITY_MISSING)
+            else:
+                values.append(value)
+                quality.append(QUALITY_REAL if item.get('real', True) else QUALITY_ESTIMATED)
+    return points
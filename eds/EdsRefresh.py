@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import concurrent.futures, heapq, threading
+from datetime import datetime
+
+# data sources of a helper, refreshed independently
+SOURCES = ('cycles', 'maximeter', 'energy', 'pvpc')
+
+class EdsRefreshQueue():
+    """
+    Due times of the data sources of a helper, as a heap. A refresh takes every overdue source at once, and
+    reschedules each of them after its interval (or after retry, if it could not be refreshed).
+
+    For instance:
+    >>> queue = EdsRefreshQueue({'cycles': timedelta(hours=1), 'energy': timedelta(hours=1)}, retry=timedelta(minutes=30))
+    >>> queue.due()
+    {'cycles', 'energy'}
+    >>> queue.done('cycles', ok=True)
+    >>> queue.done('energy', ok=False)
+    >>> queue.next_due()
+    datetime.datetime(2021, 6, 1, 10, 30)
+    """
+
+    def __init__(self, intervals, retry):
+        self._intervals = intervals
+        self._retry = retry
+        self._lock = threading.Lock()
+        now = datetime.now()
+        self._due = {s: now for s in intervals}
+        self._heap = [(now, s) for s in intervals]
+        heapq.heapify(self._heap)
+
+    def due(self, now=None):
+        """Takes every overdue source, each of them must be given back with done()"""
+        now = now if now is not None else datetime.now()
+        sources = set()
+        with self._lock:
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                when, source = heapq.heappop(self._heap)
+                # entries replaced by a later schedule() are just dropped
+                if self._due.get(source, None) == when:
+                    del self._due[source]
+                    sources.add(source)
+        return sources
+
+    def schedule(self, source, when):
+        with self._lock:
+            self._due[source] = when
+            heapq.heappush(self._heap, (when, source))
+
+    def done(self, source, ok=True, now=None):
+        now = now if now is not None else datetime.now()
+        self.schedule(source, now + (self._intervals[source] if ok else self._retry))
+
+    def next_due(self):
+        """Earliest due time of the sources not taken, or None"""
+        with self._lock:
+            return min(self._due.values(), default=None)
+
+class EdsSingleFlight():
+    """
+    A single call in flight: concurrent callers (threads or coroutines) get the future of the running one.
+
+    For instance:
+    >>> future, owner = flight.join()
+    >>> if owner:
+    ...     flight.land(future, refresh())
+    >>> future.result()  # or: await asyncio.wrap_future(future)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._future = None
+
+    def join(self):
+        """(future of the call in flight, whether the caller has to run it)"""
+        with self._lock:
+            if self._future is not None:
+                return self._future, False
+            self._future = concurrent.futures.Future()
+            return self._future, True
+
+    def land(self, future, result=None, exception=None):
+        with self._lock:
+            self._future = None
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
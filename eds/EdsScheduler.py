@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio, heapq, itertools, random, threading, time
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# priority classes, lower goes first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_LOGIN = 1
+PRIORITY_REFRESH = 2
+PRIORITY_BULK = 3
+
+# default budgets (requests per second, burst)
+DEFAULT_ACCOUNT_RATE = 60 / 3600
+DEFAULT_ACCOUNT_BURST = 20
+DEFAULT_HOST_RATE = 1.0
+DEFAULT_HOST_BURST = 5
+
+# backoff after 429/5xx or redirect-to-login answers (seconds)
+DEFAULT_BACKOFF_BASE = 30
+DEFAULT_BACKOFF_MAX = 3600
+
+class TokenBucket():
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self, now):
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class EdsScheduler():
+    """
+    Request scheduler shared by every connector: a token bucket per account and per host, priority
+    classes and exponential backoff (with jitter) after 429/5xx or redirect-to-login answers.
+
+    For instance:
+    >>> scheduler.acquire('user', 'zonaprivada.edistribucion.com', PRIORITY_INTERACTIVE)
+    >>> scheduler.report('user', 'zonaprivada.edistribucion.com', status=200)
+    >>> scheduler.budget('user')
+    {'account': 18.9, 'hosts': {'zonaprivada.edistribucion.com': 3.9}, 'backoff': 0}
+    """
+    _default = None
+
+    def __init__(self, account_rate=DEFAULT_ACCOUNT_RATE, account_burst=DEFAULT_ACCOUNT_BURST, host_rate=DEFAULT_HOST_RATE, host_burst=DEFAULT_HOST_BURST, backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX):
+        self._account_rate = account_rate
+        self._account_burst = account_burst
+        self._host_rate = host_rate
+        self._host_burst = host_burst
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._cond = threading.Condition()
+        self._accounts = {}
+        self._hosts = {}
+        self._backoff = {}
+        self._failures = {}
+        self._waiting = []
+        self._seq = itertools.count()
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def _buckets(self, account, host):
+        if account not in self._accounts:
+            self._accounts[account] = TokenBucket(self._account_rate, self._account_burst)
+        if host not in self._hosts:
+            self._hosts[host] = TokenBucket(self._host_rate, self._host_burst)
+        return self._accounts[account], self._hosts[host]
+
+    def _try(self, ticket, account, host):
+        """Takes the tokens if the ticket goes first, returns the seconds to wait otherwise"""
+        now = time.monotonic()
+        # only the best waiting ticket of an account may go
+        head = min([x for x in self._waiting if x[2] == account])
+        a, h = self._buckets(account, host)
+        wait = max(a.delay(now), h.delay(now), self._backoff.get(account, 0) - now)
+        if head is not ticket:
+            return max(wait, 0.05)
+        if wait > 0:
+            return wait
+        a.take(now)
+        h.take(now)
+        self._waiting.remove(ticket)
+        heapq.heapify(self._waiting)
+        self._cond.notify_all()
+        return 0
+
+    def acquire(self, account, host, priority=PRIORITY_REFRESH):
+        """Blocks until the request can be sent"""
+        with self._cond:
+            ticket = (priority, next(self._seq), account)
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                wait = self._try(ticket, account, host)
+                if wait == 0:
+                    return
+                self._cond.wait(timeout=wait)
+
+    async def async_acquire(self, account, host, priority=PRIORITY_REFRESH):
+        with self._cond:
+            ticket = (priority, next(self._seq), account)
+            heapq.heappush(self._waiting, ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try(ticket, account, host)
+                if wait == 0:
+                    return
+                await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+            raise
+
+    def report(self, account, host, status=None, expired=False):
+        """Feeds the answer back: 429/5xx answers, and expiries repeated right after a login, back off the account"""
+        with self._cond:
+            if expired or (status is not None and (status == 429 or status >= 500)):
+                failures = self._failures.get(account, 0) + 1
+                self._failures[account] = failures
+                delay = min(self._backoff_max, self._backoff_base * 2 ** (failures - 1)) * random.uniform(0.5, 1.5)
+                self._backoff[account] = time.monotonic() + delay
+                _LOGGER.warning (f'Backing off for {round(delay)} seconds (status: {status}, expired: {expired})')
+            elif status is not None and status < 400:
+                self._failures[account] = 0
+
+    def backoff(self, account):
+        """Seconds left of the account's backoff"""
+        with self._cond:
+            return max(0, self._backoff.get(account, 0) - time.monotonic())
+
+    def budget(self, account=None):
+        """Remaining tokens (and backoff seconds) of an account, or of every account"""
+        with self._cond:
+            now = time.monotonic()
+            for b in list(self._accounts.values()) + list(self._hosts.values()):
+                b._refill(now)
+            if account is None:
+                return {x: self._budget(x, now) for x in self._accounts}
+            return self._budget(account, now)
+
+    def _budget(self, account, now):
+        return {
+            'account': round(self._accounts[account].tokens, 1) if account in self._accounts else self._account_burst,
+            'hosts': {x: round(self._hosts[x].tokens, 1) for x in self._hosts},
+            'backoff': max(0, round(self._backoff.get(account, 0) - now)),
+        }
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+import numpy as np
+
+from .EdsParser import TIMEZONE, day_epoch_hour
+from .EdsCalendar import P1, P2, P3, period_calendar
+
+# quality of the hours without any point (see EdsParser for the others)
+QUALITY_ABSENT = 255
+
+class EdsHourlySeries():
+    """
+    Dense hourly series starting at a UTC epoch-hour (base): float32 values and prices, uint8 period
+    codes and quality flags, plus the offset of every local midnight, so windows are contiguous slices.
+
+    For instance:
+    >>> series = EdsHourlySeries.from_points(store.load_hourly_points(cont_id, since=date(2021, 6, 1)))
+    >>> series.window(date(2021, 6, 1), date(2021, 7, 1))
+    {1: 80.12, 2: 95.3, 3: 150.8, 'hours': 720}
+    >>> series.set_prices(*store.load_prices(series.base, series.base + len(series) - 1))
+    >>> series.energy_cost(date(2021, 6, 1), date(2021, 7, 1))
+    """
+
+    def __init__(self, base, values, quality, periods, first_day, day_starts, prices=None):
+        self.base = base
+        self.values = values
+        self.quality = quality
+        self.periods = periods
+        self.prices = prices
+        self.first_day = first_day
+        self.day_starts = day_starts
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return sum([x.nbytes for x in (self.values, self.quality, self.periods, self.day_starts) + ((self.prices,) if self.prices is not None else ())])
+
+    @classmethod
+    def from_points(cls, points, tz=TIMEZONE):
+        """Builds the series from hourly points (see EdsParser), hours without points are left absent"""
+        hours = np.frombuffer(points.hours, dtype=np.int64)
+        base = int(hours.min())
+        n = int(hours.max()) - base + 1
+        values = np.full(n, np.nan, dtype=np.float32)
+        values[hours - base] = np.frombuffer(points.values, dtype=np.float64)
+        quality = np.full(n, QUALITY_ABSENT, dtype=np.uint8)
+        quality[hours - base] = np.frombuffer(points.quality, dtype=np.uint8)
+        periods = np.zeros(n, dtype=np.uint8)
+        # local days are walked once: a regular day maps its 24 positions straight into the calendar
+        first_day = datetime.fromtimestamp(base * 3600, tz).date()
+        last_day = datetime.fromtimestamp((base + n - 1) * 3600, tz).date()
+        starts = []
+        day = first_day
+        while day <= last_day + timedelta(days=1):
+            starts.append(day_epoch_hour(day, tz) - base)
+            day += timedelta(days=1)
+        for ix in range(len(starts) - 1):
+            day = first_day + timedelta(days=ix)
+            s, e = starts[ix], starts[ix + 1]
+            local = np.arange(24, dtype=np.int64)
+            if e - s != 24:
+                # DST days, with the actual local hours
+                local = np.array([datetime.fromtimestamp((base + h) * 3600, tz).hour for h in range(s, e)], dtype=np.int64)
+            calendar = np.frombuffer(period_calendar(day.year), dtype=np.uint8)
+            codes = calendar[(day.timetuple().tm_yday - 1) * 24 + local]
+            periods[max(s, 0):min(e, n)] = codes[max(0, -s):len(codes) - max(0, e - n)]
+        return cls(base, values, quality, periods, first_day, np.array(starts, dtype=np.int64))
+
+    def index(self, day):
+        """Offset of the local midnight of a date, clipped to the series"""
+        ix = (day - self.first_day).days
+        if ix < 0:
+            return 0
+        if ix >= len(self.day_starts):
+            return len(self.values)
+        return int(min(max(self.day_starts[ix], 0), len(self.values)))
+
+    def slice(self, start=None, end=None):
+        """[start, end) dates as a slice of the arrays"""
+        return slice(self.index(start) if start is not None else 0, self.index(end) if end is not None else len(self.values))
+
+    def window(self, start=None, end=None):
+        """Energy by period within [start, end) dates, and the number of hours with a value"""
+        s = self.slice(start, end)
+        values = self.values[s]
+        valid = ~np.isnan(values)
+        sums = np.bincount(self.periods[s][valid], weights=values[valid].astype(np.float64), minlength=P3 + 1)
+        return {P1: float(sums[P1]), P2: float(sums[P2]), P3: float(sums[P3]), 'hours': int(valid.sum())}
+
+    def set_prices(self, hours, prices):
+        """Aligns prices ((UTC epoch-hours, prices) columns, as given by EdsStore.load_prices) to the series"""
+        hours = np.frombuffer(hours, dtype=np.int64) - self.base
+        prices = np.frombuffer(prices, dtype=np.float64)
+        inside = (hours >= 0) & (hours < len(self.values))
+        self.prices = np.full(len(self.values), np.nan, dtype=np.float32)
+        self.prices[hours[inside]] = prices[inside]
+
+    @staticmethod
+    def _ffill(a):
+        ix = np.where(np.isnan(a), 0, np.arange(len(a)))
+        np.maximum.accumulate(ix, out=ix)
+        return a[ix]
+
+    def _priced(self):
+        # value * price of the hours with points, gaps filled with the previous value and price
+        present = np.flatnonzero(self.quality != QUALITY_ABSENT)
+        values = self._ffill(self.values[present])
+        prices = self._ffill(self.prices[present])
+        return present, values.astype(np.float64) * prices
+
+    def energy_cost(self, start=None, end=None):
+        """Sum of value * price within [start, end) dates, gaps filled with the previous value and price"""
+        if self.prices is None:
+            return None
+        present, cost = self._priced()
+        s = self.slice(start, end)
+        inside = (present >= s.start) & (present < s.stop)
+        return float(np.nansum(cost[inside]))
+
+    def aggregate(self, edges):
+        """
+        Energy, priced energy (as energy_cost) and hours with a value, by period and group, in a single pass:
+        group i spans [edges[i], edges[i + 1]) dates (e.g. cycles or months), hours out of every group are left out
+        """
+        groups = len(edges) - 1
+        offsets = np.array([self.index(d) for d in edges], dtype=np.int64)
+        group = np.searchsorted(offsets, np.arange(len(self.values)), side='right') - 1
+        valid = (group >= 0) & (group < groups) & ~np.isnan(self.values)
+        keys = group[valid] * 4 + self.periods[valid]
+        energy = np.bincount(keys, weights=self.values[valid].astype(np.float64), minlength=groups * 4).reshape(groups, 4)[:, P1:]
+        hours = np.bincount(group[valid], minlength=groups)
+        cost = None
+        if self.prices is not None:
+            present, priced = self._priced()
+            group = group[present]
+            inside = (group >= 0) & (group < groups) & ~np.isnan(priced)
+            keys = group[inside] * 4 + self.periods[present][inside]
+            cost = np.bincount(keys, weights=priced[inside], minlength=groups * 4).reshape(groups, 4)[:, P1:]
+        return {'start': list(edges[:-1]), 'end': list(edges[1:]), 'energy': energy, 'cost': cost, 'hours': hours}
+
+    def to_frame(self, tz=TIMEZONE):
+        """
+        The series as a pandas DataFrame indexed by local datetime, for analysis or export only (pandas is an
+        optional dependency, nothing in the update path needs it)
+        """
+        try:
+            import pandas as pd
+        except ImportError as e:
+            raise ImportError('to_frame() requires pandas, which is not installed') from e
+        index = pd.to_datetime((self.base + np.arange(len(self.values))) * 3600, unit='s', utc=True).tz_convert(tz)
+        return pd.DataFrame({
+            'value': self.values,
+            'period': self.periods,
+            'quality': self.quality,
+            'price': self.prices if self.prices is not None else np.full(len(self.values), np.nan, dtype=np.float32),
+        }, index=index)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio, hashlib, json, os, tempfile, threading, time
+from contextlib import contextmanager, asynccontextmanager
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (e.g. Windows): logins are only serialized within this process
+    fcntl = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# seconds to wait for a concurrent login before giving up on the lock
+LOCK_TIMEOUT = 120
+LOCK_POLL = 0.1
+
+_LOCKS = {}
+
+class EdsSessionStore():
+    """
+    Session (cookies, token, context and identities) of an account, shared by every connector and process.
+
+    Writes are atomic (a reader never sees a half-written file), and logins are serialized with a lock
+    file, so concurrent starters log in once and the rest reuse that session:
+    >>> store = EdsSessionStore('/tmp', user)
+    >>> with store.lock():
+    ...     state = store.load()
+    ...     store.save({'token': token, 'context': context, 'identities': identities, 'cookies': cookies})
+    1
+    """
+
+    def __init__(self, path, user):
+        self.path = os.path.join(path, f'edistribucion.{hashlib.sha1(user.encode()).hexdigest()[:12]}.session')
+        if self.path not in _LOCKS:
+            _LOCKS[self.path] = threading.Lock()
+
+    def load(self):
+        """Last saved state, or None"""
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            _LOGGER.debug ('Session file not found')
+        except Exception as e:
+            _LOGGER.info (e)
+        return None
+
+    def save(self, state):
+        """Atomically replaces the saved state, returning its generation (a counter of saves)"""
+        previous = self.load()
+        state = dict(state)
+        state['generation'] = (previous.get('generation', 0) if previous is not None else 0) + 1
+        state['date'] = time.time()
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+            _LOGGER.debug('Saving session')
+        except Exception as e:
+            _LOGGER.info (e)
+        return state['generation']
+
+    def _try_lock(self):
+        if fcntl is None:
+            return _LOCKS[self.path] if _LOCKS[self.path].acquire(blocking=False) else None
+        # every attempt gets its own file description, so the lock also works between threads
+        f = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+        except OSError:
+            f.close()
+            return None
+
+    def _unlock(self, handle):
+        if handle is None:
+            return
+        if fcntl is None:
+            handle.release()
+        else:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            handle.close()
+
+    @contextmanager
+    def lock(self, delay=None):
+        """
+        Exclusive lock of this account's session (e.g. to log in), waiting up to LOCK_TIMEOUT seconds
+        plus delay(), if given: the seconds the holder is known to be held up (e.g. backing off)
+        """
+        handle = self._try_lock()
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while handle is None and time.monotonic() < deadline + (delay() if delay is not None else 0):
+            time.sleep(LOCK_POLL)
+            handle = self._try_lock()
+        if handle is None:
+            _LOGGER.warning ('Session lock timed out, going on without it')
+        try:
+            yield
+        finally:
+            self._unlock(handle)
+
+    @asynccontextmanager
+    async def async_lock(self, delay=None):
+        handle = self._try_lock()
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while handle is None and time.monotonic() < deadline + (delay() if delay is not None else 0):
+            await asyncio.sleep(LOCK_POLL)
+            handle = self._try_lock()
+        if handle is None:
+            _LOGGER.warning ('Session lock timed out, going on without it')
+        try:
+            yield
+        finally:
+            self._unlock(handle)
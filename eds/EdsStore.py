@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import sqlite3, json, os, threading
+import logging
+from datetime import datetime, timedelta
+from itertools import repeat
+from bisect import bisect_left
+from array import array
+
+from .EdsParser import EdsHourlyPoints, QUALITY_MISSING, day_epoch_hour, day_hours
+
+_LOGGER = logging.getLogger(__name__)
+
+# days older than this are not expected to change anymore (once complete)
+FINAL_DELAY = timedelta(days=2)
+
+DEFAULT_STORAGE_FILE = 'edistribucion.db'
+
+def month_range(first, last):
+    """First day of every month within [first, last] (dates)"""
+    month = first.replace(day=1)
+    while month <= last:
+        yield month
+        month = (month + timedelta(days=32)).replace(day=1)
+
+class EdsStore():
+    """
+    Persistent store (sqlite) for hourly energy points, keyed by contract and hour.
+
+    Days are marked final once complete, so they are never requested again:
+    >>> store = EdsStore('/tmp')
+    >>> store.save_hourly_points(cont_id, parse_hourly_points(res.get('mapHourlyPoints', {})))
+    >>> store.last_final_day(cont_id, date(2021, 6, 1))
+    datetime.date(2021, 6, 13)
+    """
+
+    def __init__(self, path, filename=DEFAULT_STORAGE_FILE):
+        self._lock = threading.Lock()
+        self._path = path
+        self._filename = filename
+        self._connection = None
+        self._connecting = threading.Lock()
+
+    @property
+    def _db(self):
+        # opened (and the tables created) on first use, so building a store does no I/O, e.g. on an event loop
+        with self._connecting:
+            if self._connection is None:
+                path = os.path.join(self._path, self._filename) if os.path.isdir(self._path) else self._path
+                db = sqlite3.connect(path, check_same_thread=False)
+                with db:
+                    db.execute('CREATE TABLE IF NOT EXISTS energy_hourly (cont_id TEXT, hour INTEGER, value REAL, quality INTEGER, PRIMARY KEY (cont_id, hour))')
+                    db.execute('CREATE TABLE IF NOT EXISTS energy_days (cont_id TEXT, date TEXT, final INTEGER, PRIMARY KEY (cont_id, date))')
+                    db.execute('CREATE TABLE IF NOT EXISTS pvpc_prices (hour INTEGER PRIMARY KEY, price REAL)')
+                    db.execute('CREATE TABLE IF NOT EXISTS maximeter (cups_id TEXT, month TEXT, date TEXT, hour TEXT, value REAL, PRIMARY KEY (cups_id, date, hour))')
+                    db.execute('CREATE TABLE IF NOT EXISTS maximeter_months (cups_id TEXT, month TEXT, final INTEGER, PRIMARY KEY (cups_id, month))')
+                    db.execute('CREATE TABLE IF NOT EXISTS backfill_windows (cont_id TEXT, start TEXT, end TEXT, PRIMARY KEY (cont_id, start))')
+                    db.execute('CREATE TABLE IF NOT EXISTS cycle_aggregates (cont_id TEXT, start TEXT, data TEXT, PRIMARY KEY (cont_id, start))')
+                    db.execute('CREATE TABLE IF NOT EXISTS meter_readings (cups_id TEXT, time TEXT, total INTEGER, power REAL, load REAL, icp TEXT, PRIMARY KEY (cups_id, time))')
+                    db.execute('CREATE TABLE IF NOT EXISTS energy_totals (cont_id TEXT, resolution TEXT, start TEXT, p1 REAL, p2 REAL, p3 REAL, hours INTEGER, final INTEGER, PRIMARY KEY (cont_id, resolution, start))')
+                self._connection = db
+            return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+
+    @staticmethod
+    def _is_final(day, quality, today):
+        # every hour of the day (23 or 25 on DST days)
+        return day <= today - FINAL_DELAY and len(quality) >= day_hours(day) and QUALITY_MISSING not in quality
+
+    def save_hourly_points(self, cont_id, points, today=None):
+        """Upserts parsed hourly points (see EdsParser), marking complete past days as final"""
+        today = today if today is not None else datetime.today().date()
+        with self._lock, self._db:
+            for ix, (day, first, count) in enumerate(points.days):
+                # a final day is never overwritten
+                if self._db.execute('SELECT final FROM energy_days WHERE cont_id=? AND date=? AND final=1', (cont_id, day.isoformat())).fetchone() is not None:
+                    continue
+                s = points.day_slice(ix)
+                self._db.executemany('INSERT OR REPLACE INTO energy_hourly VALUES (?, ?, ?, ?)', zip(repeat(cont_id), points.hours[s], points.values[s], points.quality[s]))
+                self._db.execute('INSERT OR REPLACE INTO energy_days VALUES (?, ?, ?)', (cont_id, day.isoformat(), 1 if self._is_final(day, points.quality[s], today) else 0))
+
+    def last_final_day(self, cont_id, since):
+        """
+        Last day of the unbroken run of final days starting at since (a date), or None if since is not final: a day
+        that was never stored is not final, so a gap is requested again
+        """
+        with self._lock:
+            days = self._db.execute('SELECT date FROM energy_days WHERE cont_id=? AND date>=? AND final=1 ORDER BY date', (cont_id, since.isoformat())).fetchall()
+        last = None
+        expected = since
+        for (day,) in days:
+            day = datetime.fromisoformat(day).date()
+            if day != expected:
+                break
+            last = day
+            expected = day + timedelta(days=1)
+        return last
+
+    def load_hourly_points(self, cont_id, since=None):
+        """Rebuilds hourly points columns from disk, starting at since (a date) if given"""
+        with self._lock:
+            rows = self._db.execute('SELECT hour, value, quality FROM energy_hourly WHERE cont_id=? AND hour>=? ORDER BY hour', (cont_id, day_epoch_hour(since) if since is not None else 0)).fetchall()
+        points = EdsHourlyPoints()
+        for hour, value, quality in rows:
+            points.hours.append(hour)
+            points.values.append(value if value is not None else float('nan'))
+            points.quality.append(quality)
+        return points
+
+    def save_prices(self, prices):
+        """Upserts PVPC prices, as given by aiopvpc ({UTC datetime: price})"""
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO pvpc_prices VALUES (?, ?)', [(int(x.timestamp()) // 3600, prices[x]) for x in prices])
+
+    def missing_price_days(self, start, end):
+        """Local days within [start, end] (dates) without a complete set of PVPC prices"""
+        bounds = [day_epoch_hour(start + timedelta(days=d)) for d in range((end - start).days + 2)]
+        with self._lock:
+            hours = [x[0] for x in self._db.execute('SELECT hour FROM pvpc_prices WHERE hour>=? AND hour<? ORDER BY hour', (bounds[0], bounds[-1])).fetchall()]
+        missing = []
+        for d in range(len(bounds) - 1):
+            # 23, 24 or 25 prices, depending on DST
+            if bisect_left(hours, bounds[d + 1]) - bisect_left(hours, bounds[d]) < bounds[d + 1] - bounds[d]:
+                missing.append(start + timedelta(days=d))
+        return missing
+
+    def load_prices(self, first_hour, last_hour):
+        """PVPC prices within [first_hour, last_hour] (UTC epoch-hours), as (hours, prices) columns"""
+        hours = array('q')
+        prices = array('d')
+        with self._lock:
+            for hour, price in self._db.execute('SELECT hour, price FROM pvpc_prices WHERE hour>=? AND hour<=? ORDER BY hour', (first_hour, last_hour)):
+                hours.append(hour)
+                prices.append(price)
+        return hours, prices
+
+    def save_maximeter(self, cups_id, points, first, last, today=None):
+        """Replaces the maximeter points (dicts with date, hour and value) of the months within [first, last] (dates)"""
+        today = today if today is not None else datetime.today().date()
+        by_month = {}
+        for p in points:
+            day = datetime.strptime(p['date'], '%d-%m-%Y').date()
+            by_month.setdefault(day.strftime('%Y-%m'), []).append((day.isoformat(), p['hour'], p['value']))
+        with self._lock, self._db:
+            final = set([x[0] for x in self._db.execute('SELECT month FROM maximeter_months WHERE cups_id=? AND final=1', (cups_id,))])
+            # months are final once closed (even if empty), and final months are never overwritten
+            for month in month_range(first, last):
+                key = month.strftime('%Y-%m')
+                if key in final:
+                    continue
+                self._db.execute('DELETE FROM maximeter WHERE cups_id=? AND month=?', (cups_id, key))
+                self._db.executemany('INSERT OR REPLACE INTO maximeter VALUES (?, ?, ?, ?, ?)', [(cups_id, key) + x for x in by_month.get(key, [])])
+                closed = (month + timedelta(days=32)).replace(day=1) + FINAL_DELAY <= today
+                self._db.execute('INSERT OR REPLACE INTO maximeter_months VALUES (?, ?, ?)', (cups_id, key, 1 if closed else 0))
+
+    def first_open_month(self, cups_id, first, last):
+        """First month within [first, last] (dates) that is not final, or None"""
+        with self._lock:
+            final = set([x[0] for x in self._db.execute('SELECT month FROM maximeter_months WHERE cups_id=? AND final=1', (cups_id,))])
+        for month in month_range(first, last):
+            if month.strftime('%Y-%m') not in final:
+                return month
+        return None
+
+    def load_maximeter(self, cups_id, first, last):
+        """Maximeter points of the months within [first, last] (dates), as {month: [(date, hour, value)]}"""
+        months = {}
+        with self._lock:
+            for month, day, hour, value in self._db.execute('SELECT month, date, hour, value FROM maximeter WHERE cups_id=? AND month>=? AND month<=? ORDER BY date, hour', (cups_id, first.strftime('%Y-%m'), last.strftime('%Y-%m'))):
+                months.setdefault(datetime.strptime(month, '%Y-%m').date(), []).append((datetime.fromisoformat(day).date(), hour, value))
+        return months
+
+    def backfill_done(self, cont_id):
+        """Start dates of the backfill windows already archived (see EdsBackfill)"""
+        with self._lock:
+            return set([datetime.fromisoformat(x[0]).date() for x in self._db.execute('SELECT start FROM backfill_windows WHERE cont_id=?', (cont_id,))])
+
+    def save_backfill_window(self, cont_id, points, start, end, today=None):
+        """
+        Upserts the hourly points of a window (as answered by the server), checkpointing it once every day in it is
+        stored as final, or once the whole window is older than FINAL_DELAY (its answer won't change, even if empty,
+        e.g. before the contract started); recent incomplete windows are fetched again. Returns whether it was
+        """
+        today = today if today is not None else datetime.today().date()
+        self.save_hourly_points(cont_id, points, today)
+        with self._lock, self._db:
+            final = self._db.execute('SELECT COUNT(*) FROM energy_days WHERE cont_id=? AND date>=? AND date<=? AND final=1', (cont_id, start.isoformat(), end.isoformat())).fetchone()[0]
+            done = final == (end - start).days + 1 or end <= today - FINAL_DELAY
+            if done:
+                self._db.execute('INSERT OR REPLACE INTO backfill_windows VALUES (?, ?, ?)', (cont_id, start.isoformat(), end.isoformat()))
+        return done
+
+    def save_cycle_aggregate(self, cont_id, start, aggregate):
+        """Upserts the aggregate (a dict, see EdsCycles) of the cycle starting at start (a date)"""
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO cycle_aggregates VALUES (?, ?, ?)', (cont_id, start.isoformat(), json.dumps(aggregate, separators=(',', ':'))))
+
+    def load_cycle_aggregates(self, cont_id):
+        """Aggregates of the cycles of a contract, as {start date: aggregate}"""
+        with self._lock:
+            return {datetime.fromisoformat(start).date(): json.loads(data) for start, data in self._db.execute('SELECT start, data FROM cycle_aggregates WHERE cont_id=?', (cont_id,))}
+
+    def delete_cycle_aggregate(self, cont_id, start):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM cycle_aggregates WHERE cont_id=? AND start=?', (cont_id, start.isoformat()))
+
+    def save_totals(self, cont_id, resolution, rows):
+        """Upserts energy totals ('day' or 'month' ones, see EdsHistory) as (start, p1, p2, p3, hours, final) rows"""
+        with self._lock, self._db:
+            final = set([x[0] for x in self._db.execute('SELECT start FROM energy_totals WHERE cont_id=? AND resolution=? AND final=1', (cont_id, resolution))])
+            # a final total is never overwritten
+            self._db.executemany('INSERT OR REPLACE INTO energy_totals VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [(cont_id, resolution, r[0].isoformat()) + tuple(r[1:5]) + (1 if r[5] else 0,) for r in rows if r[0].isoformat() not in final])
+
+    def final_totals(self, cont_id, resolution):
+        """Start dates of the final totals of a resolution"""
+        with self._lock:
+            return set([datetime.fromisoformat(x[0]).date() for x in self._db.execute('SELECT start FROM energy_totals WHERE cont_id=? AND resolution=? AND final=1', (cont_id, resolution))])
+
+    def load_totals(self, cont_id, resolution, first, last):
+        """Energy totals of a resolution starting within [first, last] (dates), as {start: (p1, p2, p3, hours)}"""
+        with self._lock:
+            return {datetime.fromisoformat(start).date(): (p1, p2, p3, hours) for start, p1, p2, p3, hours in self._db.execute('SELECT start, p1, p2, p3, hours FROM energy_totals WHERE cont_id=? AND resolution=? AND start>=? AND start<=? ORDER BY start', (cont_id, resolution, first.isoformat(), last.isoformat()))}
+
+    def save_meter_reading(self, cups_id, time, total, power, load, icp, keep=timedelta(days=7)):
+        """Stores a meter reading (local datetime, total kWh, power kW, load %, ICP status), dropping those older than keep"""
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO meter_readings VALUES (?, ?, ?, ?, ?, ?)', (cups_id, time.isoformat(), total, power, load, icp))
+            self._db.execute('DELETE FROM meter_readings WHERE cups_id=? AND time<?', (cups_id, (time - keep).isoformat()))
+
+    def load_meter_readings(self, cups_id, since):
+        """Meter readings since a local datetime, oldest first, as (time, total, power, load, icp) rows"""
+        with self._lock:
+            return [(datetime.fromisoformat(x[0]),) + tuple(x[1:]) for x in self._db.execute('SELECT time, total, power, load, icp FROM meter_readings WHERE cups_id=? AND time>=? ORDER BY time', (cups_id, since.isoformat()))]
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from datetime import date
+
+from .EdsCalendar import P1, P2
+
+DEFAULT_PRICE_P1 = 30.67266 # €/kW/year
+DEFAULT_PRICE_P2 = 1.4243591 # €/kW/year
+DEFAULT_PRICE_CONT = 0.81 # €/month
+DEFAULT_PRICE_COMERC = 3.113 # €/kW/año
+DEFAULT_TAX_ELECTR = 1.0511300560 # multiplicative
+DEFAULT_TAX_IVA = 1.21 # multiplicative
+
+# taxes (multiplicative, None keeps the tariff's) of the groups starting within [first, last] dates
+EdsTaxRule = namedtuple('EdsTaxRule', ['first', 'last', 'electricity_tax', 'iva'], defaults=(None, None))
+
+# IVA was lowered to 10% from 26-jun-2021 to the end of 2021
+IVA_RULES_2021 = (EdsTaxRule(date(2021, 6, 26), date(2021, 12, 31), iva=1.1),)
+
+class EdsTariff():
+    """
+    2.0TD tariff: energy prices (PVPC's hourly ones, or €/kWh by period), power terms (€/kW/year by period,
+    commercial margin included), a monthly fee (meter rental) and taxes, which rules may override by date.
+
+    For instance:
+    >>> pvpc = EdsTariff('pvpc')
+    >>> flat = EdsTariff('flat', energy={P1: 0.14, P2: 0.14, P3: 0.14}, power={P1: 38.04, P2: 3.11})
+    """
+
+    def __init__(self, name, energy=None, power=None, fixed=DEFAULT_PRICE_CONT, electricity_tax=DEFAULT_TAX_ELECTR, iva=DEFAULT_TAX_IVA, rules=IVA_RULES_2021):
+        self.name = name
+        # None for PVPC
+        self.energy = energy
+        self.power = power if power is not None else {P1: DEFAULT_PRICE_P1 + DEFAULT_PRICE_COMERC, P2: DEFAULT_PRICE_P2}
+        self.fixed = fixed
+        self.electricity_tax = electricity_tax
+        self.iva = iva
+        self.rules = rules
+
+    @property
+    def is_pvpc(self):
+        return self.energy is None
+
+    def __repr__(self):
+        return f'EdsTariff({self.name!r})'
@@ -1,12 +1,14 @@
 import logging
-from homeassistant.const import POWER_KILO_WATT, ENERGY_KILO_WATT_HOUR, TIME_DAYS, PERCENTAGE, CURRENCY_EURO
+from homeassistant.const import POWER_KILO_WATT, ENERGY_KILO_WATT_HOUR, TIME_DAYS, TIME_MINUTES, PERCENTAGE, CURRENCY_EURO
 from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.event import async_track_time_interval
 from homeassistant.helpers import config_validation as cv
 import voluptuous as vol
 from homeassistant.components.sensor import PLATFORM_SCHEMA
 from homeassistant.const import CONF_USERNAME, CONF_PASSWORD
-from .eds.EdsHelper import EdsHelper
+from .eds.EdsAccount import EdsAccount
 from datetime import timedelta
+from functools import partial
 
 # HA variables
 _LOGGER = logging.getLogger(__name__)
@@ -19,6 +21,12 @@ CONF_CUPS = 'cups'
 CONF_SHORT_INTERVAL = 'short_interval'
 CONF_LONG_INTERVAL = 'long_interval'
 CONF_EXPLODE_SENSORS = 'explode_sensors'
+CONF_DIAGNOSTICS = 'diagnostics'
+# meter readings per day (live meter mode, off unless set)
+CONF_METER_BUDGET = 'meter_budget'
+
+# metrics of each account are also dumped here (prometheus text format), within HA's config dir
+METRICS_FILE = 'edistribucion.{}.prom'
 
 SENSOR_TYPES = {
     "cups": ("CUPS", None),
@@ -52,6 +60,7 @@ SENSOR_TYPES = {
     "power_peak_mean": ("P. pico (media)", POWER_KILO_WATT),
     "power_peak_tile90": ("P. pico (perc. 90)", POWER_KILO_WATT),
     "meter_last_update": ("Últ. actualización (contador)", None),
+    "meter_age": ("Antigüedad (contador)", TIME_MINUTES),
     "energy_last_update": ("Últ. actualización (energía)", None),
     "maximeter_last_update": ("Últ. actualización (maxímetro)", None),
     "pvpc_last_update": ("Últ. actualización (PVPC)", None)
@@ -67,6 +76,8 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Optional(CONF_EXPLODE_SENSORS, default=[]): vol.All(
             cv.ensure_list, [vol.In([x for x in SENSOR_TYPES if SENSOR_TYPES[x][1] is not None])]
         ),
+        vol.Optional(CONF_DIAGNOSTICS, default=False): cv.boolean,
+        vol.Optional(CONF_METER_BUDGET): cv.positive_int,
     }
 )
 
@@ -75,23 +86,41 @@ async def async_setup_platform(hass, config, add_entities, discovery_info=None):
     # Define entities
     entities = []
 
-    # Declare eds helper
-    helper = EdsHelper(config[CONF_USERNAME], config[CONF_PASSWORD], short_interval=(timedelta(minutes=config[CONF_SHORT_INTERVAL]) if CONF_SHORT_INTERVAL in config else None), long_interval=(timedelta(minutes=config[CONF_LONG_INTERVAL]) if CONF_LONG_INTERVAL in config else None))
+    # Declare eds helper, platform entries with the same credentials share the account (and its login)
+    # the account reads its session and cache files, so it is built in the executor, off the event loop
+    account = await hass.async_add_executor_job(partial(EdsAccount.get, config[CONF_USERNAME], config[CONF_PASSWORD], short_interval=(timedelta(minutes=config[CONF_SHORT_INTERVAL]) if CONF_SHORT_INTERVAL in config else None), long_interval=(timedelta(minutes=config[CONF_LONG_INTERVAL]) if CONF_LONG_INTERVAL in config else None), storage_dir=hass.config.path(), meter_budget=config.get(CONF_METER_BUDGET, None)))
     cups = None
     if CONF_CUPS in config:
         cups = config[CONF_CUPS]
-    entities.append(EdsSensor(helper, cups=cups))
+    helper = account.helper(cups)
+    # a single refresh loop per account, entities are pushed the changes (see EdsHelper.subscribe)
+    refreshers = hass.data.setdefault(DOMAIN, {})
+    if config[CONF_USERNAME] not in refreshers:
+        async def _async_refresh(now=None):
+            try:
+                await account.async_update()
+            except Exception as e:
+                _LOGGER.warning (f"Uncaught exception at sensor.py: {e}")
+        refreshers[config[CONF_USERNAME]] = async_track_time_interval(hass, _async_refresh, SCAN_INTERVAL)
+        hass.async_create_task(_async_refresh())
+    entities.append(EdsSensor(helper, cups=cups, account=account))
     for sensor in config[CONF_EXPLODE_SENSORS]:
         if SENSOR_TYPES[sensor][1] is not None:
             entities.append(EdsSensor(helper, name=sensor, state=sensor, attrs=[], master=False))
+    # one diagnostics sensor per account, however many of its CUPS are set up
+    diagnosed = hass.data.setdefault(DOMAIN + '_diagnostics', set())
+    if config[CONF_DIAGNOSTICS] and account.key not in diagnosed:
+        diagnosed.add(account.key)
+        entities.append(EdsDiagnosticsSensor(account, hass.config.path(METRICS_FILE.format(account.key)), name=f'{FRIENDLY_NAME}_diagnostics_{account.key}'))
     add_entities(entities)
 
 class EdsSensor(Entity):
     """Representation of a Sensor."""
 
-    def __init__(self, eds, name=FRIENDLY_NAME, state='power', attrs=[x for x in SENSOR_TYPES], cups=None, master=True):
+    def __init__(self, eds, name=FRIENDLY_NAME, state='power', attrs=[x for x in SENSOR_TYPES], cups=None, master=True, account=None):
         """Initialize the sensor."""
         self._state = None
+        self._account = account
         self._attributes = {}
         self._cups = cups
         self._helper = eds
@@ -100,6 +129,7 @@ class EdsSensor(Entity):
         self._master = master
         self._attrs = attrs
         self._unit = SENSOR_TYPES[state][1]
+        self._unsubscribe = None
 
         for attr in attrs:
             self._attributes[SENSOR_TYPES[attr][0]] = None
@@ -130,22 +160,86 @@ class EdsSensor(Entity):
         """Return the state attributes."""
         return self._attributes
 
+    @property
+    def should_poll(self):
+        """No polling, the helper pushes its snapshots."""
+        return False
+
+    async def async_added_to_hass(self):
+        """Subscribe to the helper snapshots."""
+        self._unsubscribe = self._helper.subscribe(self._on_snapshot)
+        if self._helper.version > 0:
+            self._on_snapshot(self._helper.snapshot, set(self._helper.snapshot))
+
+    async def async_will_remove_from_hass(self):
+        """Unsubscribe from the helper snapshots."""
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+
+    def _on_snapshot(self, snapshot, changed):
+        """Re-render only the changed attributes, and write the state only if any of them is shown here."""
+        dirty = False
+        for attr in changed.intersection(self._attrs):
+            value = snapshot.get(attr, None)
+            self._attributes[SENSOR_TYPES[attr][0]] = f"{value if value is not None else '-'} {SENSOR_TYPES[attr][1] if SENSOR_TYPES[attr][1] is not None else ''}"
+            dirty = True
+        if self._statelabel in changed:
+            self._state = snapshot.get(self._statelabel, None)
+            dirty = True
+        if dirty and self.hass is not None:
+            self.async_write_ha_state()
+
+class EdsDiagnosticsSensor(Entity):
+    """Request metrics of an account: calls as state, and per-command and per-phase figures as attributes."""
+
+    def __init__(self, account, metrics_file=None, name=FRIENDLY_NAME + '_diagnostics'):
+        self._account = account
+        self._metrics_file = metrics_file
+        self._friendlyname = name
+        self._state = None
+        self._attributes = {}
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._friendlyname
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def icon(self):
+        """Return the icon to be used for this entity."""
+        return "mdi:chart-timeline-variant"
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement."""
+        return "requests"
+
+    @property
+    def device_state_attributes(self):
+        """Return the state attributes."""
+        return self._attributes
+
     async def async_update(self):
         """Fetch new state data for the sensor."""
         try:
-            if self._master:
-                await self._helper.async_update(self._cups)
+            diagnostics = self._account.diagnostics()
+            attributes = {}
+            for descriptor, c in diagnostics['commands'].items():
+                attributes[descriptor] = f"{c['calls']} calls, {c['failures']} failed, {c['redirects']} redirected, {round(c['bytes'] / 1024, 1)} kB, {round((c['latency']['mean'] or 0) * 1000)} ms"
+            for phase, x in diagnostics['phases'].items():
+                attributes[f'phase {phase}'] = f"{x['duration']['count']} runs, {x['failures']} failed, {round((x['duration']['mean'] or 0) * 1000)} ms"
+            for connection, c in diagnostics['connections'].items():
+                attributes[f'http {connection}'] = f"{c['requests']} requests, {c['opened']} connections opened, {c['reused']} reused"
+            attributes['budget'] = diagnostics['budget']
+            self._attributes = attributes
+            self._state = sum([c['calls'] for c in diagnostics['commands'].values()])
+            if self._metrics_file is not None:
+                await self.hass.async_add_executor_job(self._account.metrics.dump, self._metrics_file)
         except Exception as e:
             _LOGGER.warning (f"Uncaught exception at sensor.py: {e}")
-        # update attrs
-        for attr in self._attrs:
-            self._attributes[SENSOR_TYPES[attr][0]] = f"{self._get_attr_value(attr) if self._get_attr_value(attr) is not None else '-'} {SENSOR_TYPES[attr][1] if SENSOR_TYPES[attr][1] is not None else ''}"
-            
-        # update state
-        self._state = self._get_attr_value(self._statelabel)
-
-    def _get_attr_value (self, attr):
-        try:
-            return self._helper.attributes[attr]
-        except Exception:
-            return None
\ No newline at end of file
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+# Offline benchmark of EdsHelper.update/async_update against the stand-in server (see eds_standin.py)
+#
+# Usage: python bench_eds.py [many CUPS, default 8]
+# Reports wall time, requests, bytes (sent/received) and peak memory for cold and warm starts
+
+import sys
+import time
+import json
+import asyncio
+import tempfile
+import tracemalloc
+import urllib.request
+from multiprocessing import Process
+sys.path.append('..')
+import eds.EdsConnector as EdsConnectorModule
+import eds.EdsAccount as EdsAccountModule
+from eds.EdsConnector import EdsConnector
+from eds.EdsAsyncConnector import EdsAsyncConnector
+from eds.EdsAccount import EdsAccount
+from eds.EdsHelper import EdsHelper
+from eds.EdsStore import EdsStore
+from eds.EdsScheduler import EdsScheduler
+from eds_standin import StandInServer, StandInPVPC
+
+USER = 'standin'
+PASSWORD = 'standin'
+PORT = 18080
+
+def serve(cups):
+    StandInServer(PORT, cups).serve_forever()
+
+def control(url, path):
+    with urllib.request.urlopen(url + path) as r:
+        return json.loads(r.read())
+
+def reset_registries(storage):
+    # a fresh process, as far as the connectors know
+    EdsConnectorModule._CONNECTORS.clear()
+    EdsAccountModule._ACCOUNTS.clear()
+    EdsAsyncConnector._connector = None
+    # the stand-in must never be throttled
+    EdsScheduler._default = EdsScheduler(account_rate=1e6, account_burst=1e6, host_rate=1e6, host_burst=1e6)
+    EdsConnector.SESSION_DIR = storage
+
+async def async_run(storage, pvpc):
+    account = EdsAccount(USER, PASSWORD, storage_dir=storage, pvpc_source=pvpc)
+    await account.async_discover()
+    await account.async_update()
+    await EdsAsyncConnector.shared(USER, PASSWORD).close()
+    await EdsAsyncConnector._get_connector().close()
+
+def run(mode, storage, url):
+    reset_registries(storage)
+    control(url, '/__reset')
+    pvpc = StandInPVPC()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    if mode == 'async':
+        asyncio.run(async_run(storage, pvpc))
+    else:
+        store = EdsStore(storage)
+        eds = EdsConnector.shared(USER, PASSWORD)
+        eds.login()
+        for c in eds.get_cups_list():
+            EdsHelper(USER, PASSWORD, cups=c['CUPS'], store=store, pvpc_source=pvpc).update()
+        store.close()
+    wall = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats = control(url, '/__stats')
+    return wall, stats, peak, pvpc
+
+def main():
+    many = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    url = f'http://localhost:{PORT}'
+    EdsConnector.BASE_URL = url
+    print(f"{'scenario':<24}{'wall (s)':>10}{'requests':>10}{'conns':>7}{'logins':>8}{'sent (kB)':>11}{'recv (kB)':>11}{'peak (MB)':>11}{'pvpc':>6}")
+    for cups in (1, many):
+        server = Process(target=serve, args=(cups,), daemon=True)
+        server.start()
+        while True:
+            try:
+                control(url, '/__stats')
+                break
+            except OSError:
+                time.sleep(0.1)
+        try:
+            for mode in ('sync', 'async'):
+                with tempfile.TemporaryDirectory() as storage:
+                    for start in ('cold', 'warm'):
+                        wall, stats, peak, pvpc = run(mode, storage, url)
+                        print(f"{f'{mode} {start} {cups} CUPS':<24}{wall:>10.3f}{stats['requests']:>10}{stats['connections']:>7}{stats['logins']:>8}{stats['bytes_in'] / 1024:>11.1f}{stats['bytes_out'] / 1024:>11.1f}{peak / 2**20:>11.1f}{pvpc.calls:>6}")
+        finally:
+            server.terminate()
+            server.join()
+
+if __name__ == '__main__':
+    main()
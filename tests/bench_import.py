@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+# Import-time benchmark of the integration's entry points (what Home Assistant imports before any sensor exists)
+#
+# Usage: python bench_import.py [runs, default 5]
+# Every run is a fresh interpreter (python -X importtime); reports the median import time of each entry point,
+# the heavy modules it loaded, and the slowest imports below it
+
+import os
+import sys
+import subprocess
+from statistics import median
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+ENTRY_POINTS = ('eds.EdsAccount', 'eds.EdsHelper', 'eds.EdsConnector', 'eds.EdsSeries')
+# loaded lazily by the update path (or never, for pandas)
+HEAVY = ('pandas', 'numpy', 'aiopvpc', 'holidays', 'requests', 'pytz', 'tzlocal', 'bs4')
+
+def run(module):
+    """(total microseconds, {module: cumulative microseconds}, heavy modules loaded) for a fresh import"""
+    code = f'import sys, {module}; print(",".join([m for m in {HEAVY!r} if m in sys.modules]))'
+    r = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    cumulative = {}
+    for line in r.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cum, name = [x.strip() for x in line[len('import time:'):].split('|')]
+        cumulative[name] = int(cum)
+    return cumulative[module], cumulative, [x for x in r.stdout.strip().split(',') if x]
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"{'entry point':<20}{'median (ms)':>12}{'min (ms)':>10}  heavy modules loaded")
+    slowest = {}
+    for module in ENTRY_POINTS:
+        totals = []
+        for _ in range(runs):
+            total, cumulative, heavy = run(module)
+            totals.append(total)
+        slowest[module] = sorted([(v, k) for k, v in cumulative.items() if k != module and not k.startswith('encodings')], reverse=True)[:5]
+        print(f"{module:<20}{median(totals) / 1000:>12.1f}{min(totals) / 1000:>10.1f}  {', '.join(heavy) or '-'}")
+    for module, imports in slowest.items():
+        print(f'\n{module}, slowest imports (cumulative ms):')
+        for us, name in imports:
+            print(f'  {name:<40}{us / 1000:>8.1f}')
+
+if __name__ == '__main__':
+    main()
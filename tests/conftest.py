@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# live scripts, run by hand against the real site with a user and a password
+collect_ignore = ['test_eds.py', 'test_async_eds.py', 'test_aiopvpc.py']
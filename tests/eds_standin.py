@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+# Offline stand-in for the e-Distribución login flow, the /sfsites/aura endpoint and the PVPC source
+#
+# Usage: python eds_standin.py [port] [number of CUPS]
+# Then point the connectors at it, e.g. EdsConnector.BASE_URL = 'http://localhost:port'
+
+import sys
+import gzip
+import json
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote
+from zoneinfo import ZoneInfo
+
+TOKEN = 'standin-token'
+CONTEXT = '{"mode":"PROD","fwuid":"standin-fwuid","app":"siteforce:communityApp","loaded":{}}'
+
+MADRID = ZoneInfo('Europe/Madrid')
+
+def _local_hours(day):
+    # local hour every hour of a day starts at, 23 or 25 of them on DST days
+    t = datetime(day.year, day.month, day.day, tzinfo=MADRID).astimezone(timezone.utc)
+    end = datetime(day.year, day.month, day.day, tzinfo=MADRID) + timedelta(days=1)
+    hours = []
+    while t < end:
+        hours.append(t.astimezone(MADRID).hour)
+        t += timedelta(hours=1)
+    return hours
+
+def _value(*seed):
+    return round(random.Random('-'.join([str(x) for x in seed])).uniform(0.05, 1.5), 3)
+
+class StandInData():
+    """
+    Synthetic (deterministic) answers for every aura action used by EdsConnector: the ones it parses are shaped as
+    the real ones, those it only passes through (ICP, status, requests) are minimal
+    """
+
+    def __init__(self, cups=1, today=None):
+        self.cups = cups
+        self.today = today if today is not None else datetime.today().date()
+
+    def login_info(self, params):
+        return {'visibility': {'Id': 'ACC0', 'Visible_Account__r': {'Identity_number__c': '00000000T'}}, 'Name': 'Stand-in'}
+
+    def cups_list(self, params):
+        conts = [{'Id': f'CONT{i}', 'CUPs__r': {'Name': f'ES00310000000000{i:04d}XX', 'Id': f'CUPS{i}'}, 'Requested_power_1__c': 4.4, 'rate': '2.0TD'} for i in range(self.cups)]
+        return {'data': {'lstCups': conts, 'lstIds': [x['Id'] for x in conts]}}
+
+    def cups_icp(self, params):
+        return {'data': {'lstCups': [{'Id': f'CUPS{i}', 'Name': f'ES00310000000000{i:04d}XX'} for i in range(self.cups)]}}
+
+    def cups_info(self, params):
+        return {'data': {'cupsId': params.get('cupsId', None), 'Power': 4.4, 'rate': '2.0TD'}}
+
+    def cups_all(self, params):
+        return {'data': {'lstCups': [{'Id': f'CUPS{i}', 'Name': f'ES00310000000000{i:04d}XX', 'Status': 'EN SERVICIO'} for i in range(self.cups)]}}
+
+    def cups_status(self, params):
+        return {'data': {'status': 'EN SERVICIO', 'icp': 'Abierto'}}
+
+    def solicitud_atr_detail(self, params):
+        return {'data': {'Id': params.get('solId', None), 'Status': 'ACEPTADA'}}
+
+    def reconnect(self, params):
+        return {'data': {'result': 'OK'}}
+
+    def cups_detail(self, params):
+        return {'lstATR': [{'Id': 'ATR' + params['cupsId'], 'Status': 'EN VIGOR'}, {'Id': 'OLD' + params['cupsId'], 'Status': 'BAJA'}]}
+
+    def atr_detail(self, params):
+        return {'data': [{'title': 'Potencia contratada 1 (kW)', 'value': '4,6'}, {'title': 'Potencia contratada 2 (kW)', 'value': '3,3'}]}
+
+    def cycles(self, params):
+        end = self.today - timedelta(days=12)
+        start = end - timedelta(days=31)
+        return {'data': {'lstCycles': [{'label': f'{start:%d/%m/%Y} - {end:%d/%m/%Y}', 'value': '1'}]}}
+
+    def _hourly(self, cont, start, end):
+        points = {}
+        now = datetime.now()
+        day = start
+        while day <= min(end, self.today):
+            key = f'{day:%d-%m-%Y}'
+            hours = _local_hours(day)
+            hours = hours if day < self.today else hours[:now.hour]
+            points[key] = [{'date': key, 'hour': f'{h:02d} - {(h + 1) % 24:02d} h', 'hourCCH': ix + 1, 'value': _value(cont, key, ix), 'real': True, 'invoiced': False} for ix, h in enumerate(hours)]
+            day += timedelta(days=1)
+        return points
+
+    def curve(self, params):
+        start = datetime.strptime(params['startDate'], '%Y-%m-%d').date()
+        if params.get('type', '4') == '4':
+            end = datetime.strptime(params['endDate'], '%Y-%m-%d').date()
+        else:
+            end = start + timedelta(days={'1': 0, '2': 6, '3': 30}[params['type']])
+        return {'data': {'mapHourlyPoints': self._hourly(params['contId'], start, end)}}
+
+    def cycle_curve(self, params):
+        # a cycle's curve, its range as in the cycle labels
+        start, end = [datetime.strptime(x, '%d/%m/%Y').date() for x in params['dateRange'].split(' - ')]
+        return {'data': {'mapHourlyPoints': self._hourly(params['cupsId'], start, end)}}
+
+    def maximeter(self, params):
+        p = params['mapParams']
+        month = datetime.strptime(p['startDate'], '%m/%Y').date()
+        last = datetime.strptime(p['endDate'], '%m/%Y').date()
+        data = []
+        while month <= last:
+            data.append({'date': f'{month.replace(day=12):%d-%m-%Y}', 'hour': '20:15', 'value': _value(p['id'], month) * 3, 'valid': True})
+            month = (month + timedelta(days=32)).replace(day=1)
+        return {'data': {'lstData': data}}
+
+    def meter(self, params):
+        # about 0.5 kWh per hour
+        total = 12345 + int((datetime.now() - datetime(2021, 1, 1)).total_seconds() / 7200)
+        return {'data': {'totalizador': f'{total:,}'.replace(',', '.'), 'estadoICP': 'Abierto', 'percent': '12,5%', 'potenciaActual': 0.55}}
+
+    def empty(self, params):
+        return {}
+
+    def handle(self, method, params):
+        return {
+            'getLoginInfo': self.login_info,
+            'getCUPSReconectarICP': self.cups_icp,
+            'getCupsInfo': self.cups_info,
+            'getAllCUPS': self.cups_all,
+            'getListCups': self.cups_list,
+            'getCUPSDetail': self.cups_detail,
+            'getStatus': self.cups_status,
+            'getATRDetail': self.atr_detail,
+            'getSolicitudATRDetail': self.solicitud_atr_detail,
+            'getInfo': self.cycles,
+            'getChartPoints': self.cycle_curve,
+            'getChartPointsByRange': self.curve,
+            'reconectarICP': self.reconnect,
+            'goToReconectarICP': self.reconnect,
+            'getHistogramPoints': self.maximeter,
+            'consultarContador': self.meter,
+        }.get(method, self.empty)(params)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type='text/html', cookie=None):
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 1024:
+            body = gzip.compress(body, 6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        if cookie is not None:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(body)
+        if not self.path.startswith('/__'):
+            with self.server.lock:
+                self.server.stats['requests'] += 1
+                self.server.stats['bytes_out'] += len(body)
+                # a handler per connection
+                self.server.stats['connections'] += 0 if getattr(self, '_counted', False) else 1
+                self._counted = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/__stats':
+            return self._send(json.dumps(self.server.stats), 'application/json')
+        if url.path == '/__reset':
+            self.server.reset()
+            return self._send('{}', 'application/json')
+        with self.server.lock:
+            self.server.stats['logins'] += 1 if url.path.startswith('/areaprivada/s/login') else 0
+        if url.path.startswith('/areaprivada/s/login'):
+            return self._send('<html><script>window.auraConfig = {"token":"undefined"};</script><script src="/areaprivada/s/sfsites/l/' + quote(CONTEXT) + '/resources.js?pu=1&amp;a=1"></script></html>')
+        if url.path.startswith('/secur/frontdoor.jsp'):
+            return self._send('<html></html>', cookie='sid=standin; Path=/')
+        return self._send('<html><script>var auraConfig = {"token":"' + TOKEN + '","context":{}};</script></html>')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        with self.server.lock:
+            self.server.stats['bytes_in'] += length
+        form = parse_qs(body.decode())
+        message = json.loads(form.get('message', ['{"actions": []}'])[0])
+        token = form.get('aura.token', ['undefined'])[0]
+        actions = message.get('actions', [])
+        if len(actions) == 1 and actions[0]['descriptor'].endswith('ACTION$login'):
+            host = self.headers.get('Host')
+            return self._send(json.dumps({'events': [{'attributes': {'values': {'url': f'http://{host}/secur/frontdoor.jsp?sid=standin'}}}], 'actions': []}), 'application/json')
+        if token != TOKEN:
+            # as aura answers an expired token
+            with self.server.lock:
+                self.server.stats['expired'] += 1
+            return self._send('*/{"event":{"descriptor":"markup://aura:invalidSession","attributes":{"values":{}}},"exceptionEvent":true}/*ERROR*/', 'application/json;charset=UTF-8')
+        response = {'actions': []}
+        for action in actions:
+            method = action['descriptor'].split('$')[-1]
+            with self.server.lock:
+                self.server.stats['actions'][method] = self.server.stats['actions'].get(method, 0) + 1
+            response['actions'].append({'id': action['id'], 'state': 'SUCCESS', 'returnValue': self.server.data.handle(method, action.get('params', {}))})
+        return self._send(json.dumps(response), 'application/json;charset=UTF-8')
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, cups=1):
+        super().__init__(('127.0.0.1', port), StandInHandler)
+        self.data = StandInData(cups)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stats = {'requests': 0, 'connections': 0, 'logins': 0, 'expired': 0, 'bytes_in': 0, 'bytes_out': 0, 'actions': {}}
+
+    @property
+    def url(self):
+        return f'http://localhost:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class StandInPVPC():
+    """Stand-in for aiopvpc's PVPCData, with synthetic hourly prices"""
+
+    def __init__(self):
+        self.calls = 0
+        self.hours = 0
+
+    async def async_download_prices_for_range(self, start, end):
+        self.calls += 1
+        prices = {}
+        t = start.replace(minute=0, second=0, microsecond=0, tzinfo=timezone.utc) - timedelta(hours=2)
+        while t <= end.replace(tzinfo=timezone.utc):
+            prices[t] = round(0.08 + 0.02 * (t.hour % 6), 5)
+            t += timedelta(hours=1)
+        self.hours += len(prices)
+        return prices
+
+if __name__ == '__main__':
+    server = StandInServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8080, int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+    print(f'Serving at {server.url}')
+    server.serve_forever()
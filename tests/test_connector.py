@@ -0,0 +1,123 @@
+import asyncio
+import multiprocessing
+
+import pytest
+
+from eds.EdsScheduler import EdsScheduler
+from eds.EdsConnector import EdsConnector
+from eds.EdsAsyncConnector import EdsAsyncConnector
+from .eds_standin import StandInServer
+
+@pytest.fixture(scope='module')
+def server():
+    srv = StandInServer(0, 2).start()
+    yield srv
+    srv.shutdown()
+
+@pytest.fixture
+def connector(server, tmp_path, monkeypatch):
+    # no rate limits against the stand-in
+    monkeypatch.setattr(EdsScheduler, '_default', EdsScheduler(account_rate=1e6, account_burst=1e6, host_rate=1e6, host_burst=1e6))
+    server.reset()
+    return EdsConnector('user', 'password', base_url=server.url, session_dir=str(tmp_path))
+
+def test_batch_is_a_single_post(server, connector):
+    connector.login()
+    server.reset()
+    batch = connector.batch()
+    batch.add('cycles', connector.cycle_list_action('CONT0'))
+    batch.add('maximeter', connector.maximeter_action('CUPS0', '01/2021', '03/2021'))
+    batch.add('meter', connector.meter_action('CUPS0'))
+    batch.send()
+    assert server.stats['requests'] == 1
+    assert set(batch.results) == {'cycles', 'maximeter', 'meter'} and len(batch.errors) == 0
+    assert len(batch.results['maximeter']['data']['lstData']) == 3
+
+def test_login_again_on_invalid_session(server, connector):
+    connector.login()
+    connector.get_meter('CUPS0')
+    # the server forgets the token (a token expiring before any use would be backed off from)
+    connector._token = 'expired'
+    server.reset()
+    assert connector.get_meter('CUPS0')['estadoICP'] == 'Abierto'
+    assert server.stats['expired'] == 1
+    assert server.stats['actions'] == {'getLoginInfo': 1, 'consultarContador': 1}
+    assert EdsScheduler.default().budget('user')['backoff'] == 0
+
+def test_cache_hits(server, connector):
+    connector.login()
+    server.reset()
+    first = connector.get_cups_list()
+    assert connector.get_cups_list() == first and len(first) == 2
+    assert server.stats['actions'] == {'getListCups': 1}
+
+def test_async_cache_hits(server, connector, tmp_path):
+    async def run():
+        eds = EdsAsyncConnector('user', 'password', base_url=server.url, session_dir=str(tmp_path))
+        try:
+            await eds.login()
+            server.reset()
+            first = await eds.get_cups_list()
+            return first, await eds.get_cups_list()
+        finally:
+            await eds.close()
+            await EdsAsyncConnector._get_connector().close()
+            EdsAsyncConnector._connector = None
+    first, second = asyncio.run(run())
+    assert first == second and server.stats['actions'] == {'getListCups': 1}
+
+def _start(url, session_dir, results):
+    EdsScheduler._default = EdsScheduler(account_rate=1e6, account_burst=1e6, host_rate=1e6, host_burst=1e6)
+    eds = EdsConnector('user', 'password', base_url=url, session_dir=session_dir)
+    eds.login()
+    results.put(eds._token)
+
+def test_single_login_across_processes(server, connector, tmp_path):
+    # processes starting together log in once, the rest reuse the saved session
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_start, args=(server.url, str(tmp_path), results)) for i in range(5)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join(60)
+    assert [results.get(timeout=5) for p in processes] == ['standin-token'] * 5
+    assert server.stats['logins'] == 1
+
+def test_history_by_week_and_month_curves(server, connector, tmp_path):
+    from datetime import date, timedelta
+    from eds.EdsHistory import EdsHistory
+    from eds.EdsStore import EdsStore
+    today = date(2021, 7, 1)
+    store = EdsStore(str(tmp_path))
+    async def run():
+        eds = EdsAsyncConnector('user', 'password', base_url=server.url, session_dir=str(tmp_path))
+        try:
+            history = EdsHistory(eds, store, 'CONT0', date(2020, 12, 15), today=today, hourly_days=30, daily_days=60)
+            return history.windows(), await history.run()
+        finally:
+            await eds.close()
+            await EdsAsyncConnector._get_connector().close()
+            EdsAsyncConnector._connector = None
+    windows, progress = asyncio.run(run())
+    # whole months before the daily days by month, the partial first month and the daily days by week
+    assert [w for w in windows if w[0] == 'month'] == [('month', date(2021, 3, 1), date(2021, 3, 31)), ('month', date(2021, 2, 1), date(2021, 2, 28)), ('month', date(2021, 1, 1), date(2021, 1, 31))]
+    assert min([w[1] for w in windows if w[0] == 'day']) == date(2020, 12, 15)
+    assert progress['failed'] == 0 and progress['done'] == len(windows)
+    months = store.load_totals('CONT0', 'month', date(2021, 1, 1), date(2021, 3, 31))
+    assert sorted(months) == [date(2021, 1, 1), date(2021, 2, 1), date(2021, 3, 1)] and months[date(2021, 2, 1)][3] == 28 * 24
+
+def test_batch_priority(server, connector, monkeypatch):
+    from eds.EdsScheduler import PRIORITY_INTERACTIVE, PRIORITY_REFRESH
+    connector.login()
+    priorities = []
+    acquire = connector._scheduler.acquire
+    def spy(account, host, priority=PRIORITY_REFRESH):
+        priorities.append(priority)
+        return acquire(account, host, priority)
+    monkeypatch.setattr(connector._scheduler, 'acquire', spy)
+    for batch in (connector.batch(), connector.batch(PRIORITY_REFRESH)):
+        batch.add('cycles', connector.cycle_list_action('CONT0'))
+        batch.add('meter', connector.meter_action('CUPS0'))
+        batch.send()
+    # the meter read lifts a batch to its priority, unless the batch has its own
+    assert priorities == [PRIORITY_INTERACTIVE, PRIORITY_REFRESH]
@@ -0,0 +1,25 @@
+import asyncio
+
+from eds.EdsMetrics import EdsMetrics
+
+async def _fail():
+    raise RuntimeError('down')
+
+def test_failed_fetch_is_recorded_once():
+    metrics = EdsMetrics()
+    result, seconds = asyncio.run(metrics.timed(_fail()))
+    assert isinstance(result, RuntimeError) and seconds >= 0
+    assert metrics.snapshot()['phases'] == {}
+    with metrics.phase('pvpc', seconds, failed=isinstance(result, Exception)):
+        pass
+    phase = metrics.snapshot()['phases']['pvpc']
+    assert phase['failures'] == 1 and phase['duration']['count'] == 1
+
+def test_accounts_keep_their_own_metrics(tmp_path):
+    from eds.EdsAccount import EdsAccount
+    first = EdsAccount('first', 'password', storage_dir=str(tmp_path))
+    second = EdsAccount('second', 'password', storage_dir=str(tmp_path))
+    assert first.metrics is not second.metrics and first.key != second.key
+    with first.metrics.phase('login'):
+        pass
+    assert 'login' in first.diagnostics()['phases'] and second.diagnostics()['phases'] == {}
@@ -0,0 +1,26 @@
+import threading, time
+
+from eds import EdsSession
+from eds.EdsSession import EdsSessionStore
+from eds.EdsScheduler import EdsScheduler
+
+def test_lock_waits_as_long_as_the_backoff(tmp_path, monkeypatch):
+    monkeypatch.setattr(EdsSession, 'LOCK_TIMEOUT', 0.2)
+    scheduler = EdsScheduler()
+    scheduler._backoff['user'] = time.monotonic() + 1
+    store = EdsSessionStore(str(tmp_path), 'user')
+    held = threading.Event()
+    def holder():
+        # the lock is held while the backoff lasts, as a login would
+        with store.lock():
+            held.set()
+            time.sleep(scheduler.backoff('user'))
+    t = threading.Thread(target=holder)
+    t.start()
+    held.wait()
+    start = time.monotonic()
+    with store.lock(delay=lambda: scheduler.backoff('user')):
+        waited = time.monotonic() - start
+    t.join()
+    # it got the lock once the holder was done, not at LOCK_TIMEOUT
+    assert waited >= 0.5 and scheduler.backoff('user') == 0
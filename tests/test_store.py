@@ -0,0 +1,58 @@
+from datetime import date, timedelta
+
+from eds.EdsConnector import EdsConnector
+from eds.EdsHelper import EdsHelper
+from eds.EdsParser import parse_hourly_points, day_hours
+from eds.EdsStore import EdsStore
+
+CONT = 'CONT0'
+
+def _points(days):
+    return parse_hourly_points({f'{d:%d-%m-%Y}': [{'hourCCH': h + 1, 'value': 0.5} for h in range(day_hours(d))] for d in days})
+
+def test_last_final_day_stops_at_a_gap(tmp_path):
+    store = EdsStore(str(tmp_path))
+    first = date(2021, 6, 1)
+    store.save_hourly_points(CONT, _points([first, first + timedelta(days=2)]), today=date(2021, 7, 1))
+    assert store.last_final_day(CONT, first) == first
+    assert store.last_final_day(CONT, first + timedelta(days=1)) is None
+    assert store.last_final_day(CONT, first + timedelta(days=2)) == first + timedelta(days=2)
+
+def test_energy_ranges_request_a_gap_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(EdsConnector, 'SESSION_DIR', str(tmp_path))
+    store = EdsStore(str(tmp_path))
+    today = date.today()
+    start = today - timedelta(days=20)
+    gap = start + timedelta(days=4)
+    store.save_hourly_points(CONT, _points([start + timedelta(days=d) for d in range(10) if start + timedelta(days=d) != gap]), today=today)
+    helper = EdsHelper('user', 'password', store=store)
+    helper._cont_id = CONT
+    # cycle days start the day after the label's
+    helper._cycles = {'lstCycles': [{'label': f'{start - timedelta(days=1):%d/%m/%Y} - {today - timedelta(days=5):%d/%m/%Y}'}]}
+    assert helper._energy_ranges() == {'recent': (gap.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d'))}
+
+def test_empty_old_windows_are_checkpointed(tmp_path):
+    store = EdsStore(str(tmp_path))
+    today = date(2021, 7, 1)
+    # before the contract started, the server answers with no points
+    assert store.save_backfill_window(CONT, _points([]), date(2021, 5, 1), date(2021, 5, 31), today=today)
+    # a recent window waits for its days to become final
+    assert not store.save_backfill_window(CONT, _points([]), date(2021, 6, 1), date(2021, 6, 30), today=today)
+    assert store.backfill_done(CONT) == {date(2021, 5, 1)}
+
+def test_cycle_edges_match_the_cycle_attributes(tmp_path, monkeypatch):
+    monkeypatch.setattr(EdsConnector, 'SESSION_DIR', str(tmp_path))
+    helper = EdsHelper('user', 'password', store=EdsStore(str(tmp_path)))
+    helper._cycles = {'lstCycles': [{'label': '14/05/2021 - 14/06/2021'}, {'label': '14/04/2021 - 14/05/2021'}]}
+    d0, d1, d2, d3 = helper._cycle_dates()
+    edges = helper._cycle_edges()
+    assert edges[:3] == [date(2021, 4, 15), d0.date(), d2.date()]
+    assert edges[-1] == date.today() + timedelta(days=1)
+
+def test_reduce_curve_leaves_days_without_points_out():
+    from eds.EdsHistory import reduce_curve
+    first = date(2021, 6, 1)
+    data = {f'{d:%d-%m-%Y}': [{'hourCCH': h + 1, 'value': 0.5} for h in range(24)] for d in (first, first + timedelta(days=2))}
+    days = reduce_curve(data, first, first + timedelta(days=2), date(2021, 7, 1))
+    assert sorted(days) == [first, first + timedelta(days=2)]
+    assert days[first][3:] == (24, True)